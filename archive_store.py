@@ -0,0 +1,165 @@
+import os
+import gzip
+import json
+import shutil
+import hashlib
+from datetime import datetime, timedelta
+from config import ARCHIVE_PATH, ARCHIVE_KEEP_SNAPSHOTS, ARCHIVE_MAX_AGE_DAYS, ARCHIVE_COMPRESSION_LEVEL
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+def objects_dir(path=ARCHIVE_PATH):
+    return os.path.join(path, 'objects')
+
+
+def snapshots_dir(path=ARCHIVE_PATH):
+    return os.path.join(path, 'snapshots')
+
+
+def object_path(sha256, path=ARCHIVE_PATH):
+    """Returns where the compressed content with a given SHA-256 is stored."""
+    return os.path.join(objects_dir(path), sha256[:2], f'{sha256}.gz')
+
+
+def load_hash_cache(path=ARCHIVE_PATH):
+    """Returns the cache of file hashes keyed by path, valid while size and mtime match."""
+    cache_file = os.path.join(path, 'hash_cache.json')
+    if not os.path.exists(cache_file):
+        return {}
+    with open(cache_file, mode='r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def save_hash_cache(cache, path=ARCHIVE_PATH):
+    cache_file = os.path.join(path, 'hash_cache.json')
+    with open(f"{cache_file}.tmp", mode='w', encoding='utf-8') as file:
+        json.dump(cache, file)
+    os.replace(f"{cache_file}.tmp", cache_file)
+
+
+def file_sha256(file_path, cache):
+    """Hashes a file, reusing the cached hash when its size and mtime are unchanged."""
+    stat = os.stat(file_path)
+    key = os.path.abspath(file_path)
+    cached = cache.get(key)
+    if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return cached[2]
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        while block := file.read(READ_BLOCK_SIZE):
+            sha256.update(block)
+    cache[key] = [stat.st_size, stat.st_mtime_ns, sha256.hexdigest()]
+    return cache[key][2]
+
+
+def store_object(file_path, sha256, path=ARCHIVE_PATH):
+    """Stores a gzip-compressed copy of a file under its hash unless it is already there.
+
+    Returns whether a new object was written.
+    """
+    target = object_path(sha256, path)
+    if os.path.exists(target):
+        return False
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    # A fast level: archiving runs before the new tables go live
+    with open(file_path, 'rb') as source, \
+            gzip.open(f"{target}.tmp", 'wb', compresslevel=ARCHIVE_COMPRESSION_LEVEL) as compressed:
+        shutil.copyfileobj(source, compressed, READ_BLOCK_SIZE)
+    os.replace(f"{target}.tmp", target)
+    return True
+
+
+def archive_snapshot(file_paths, data_timestamp=None, path=ARCHIVE_PATH):
+    """Archives the current contents of file_paths as one timestamped snapshot.
+
+    Content is stored once per distinct SHA-256, so a table that did not change
+    since an earlier snapshot costs only a manifest entry. Returns the snapshot ID,
+    or None if none of the files exist yet.
+    """
+    file_paths = [file_path for file_path in file_paths if os.path.exists(file_path)]
+    if not file_paths:
+        return None
+    os.makedirs(snapshots_dir(path), exist_ok=True)
+    cache = load_hash_cache(path)
+    created_at = datetime.now()
+    snapshot_id = created_at.strftime('%Y%m%dT%H%M%S%f')
+    files = {}
+    new_objects = 0
+    for file_path in file_paths:
+        sha256 = file_sha256(file_path, cache)
+        new_objects += store_object(file_path, sha256, path)
+        files[os.path.basename(file_path)] = {'sha256': sha256, 'bytes': os.path.getsize(file_path)}
+    save_hash_cache(cache, path)
+
+    manifest_path = os.path.join(snapshots_dir(path), f'{snapshot_id}.json')
+    with open(f"{manifest_path}.tmp", mode='w', encoding='utf-8') as file:
+        json.dump({'id': snapshot_id, 'created_at': created_at.isoformat(timespec='seconds'),
+                   'data_timestamp': data_timestamp, 'files': files}, file, indent=2)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+    print(f"Archived snapshot {snapshot_id}: {len(files)} files, {new_objects} new.")
+    prune_snapshots(path=path)
+    return snapshot_id
+
+
+def list_snapshots(path=ARCHIVE_PATH):
+    """Returns the manifests of all archived snapshots, oldest first."""
+    if not os.path.exists(snapshots_dir(path)):
+        return []
+    manifests = []
+    for name in sorted(os.listdir(snapshots_dir(path))):
+        if name.endswith('.json'):
+            with open(os.path.join(snapshots_dir(path), name), mode='r', encoding='utf-8') as file:
+                manifests.append(json.load(file))
+    return manifests
+
+
+def get_snapshot(snapshot_id, path=ARCHIVE_PATH):
+    """Returns the manifest of one archived snapshot."""
+    with open(os.path.join(snapshots_dir(path), f'{snapshot_id}.json'), mode='r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def open_snapshot_file(snapshot_id, name, mode='rt', path=ARCHIVE_PATH):
+    """Opens one file of an archived snapshot for reading, decompressing on the fly."""
+    sha256 = get_snapshot(snapshot_id, path)['files'][name]['sha256']
+    if 't' in mode:
+        return gzip.open(object_path(sha256, path), mode, encoding='utf-8', newline='')
+    return gzip.open(object_path(sha256, path), mode)
+
+
+def restore_snapshot(snapshot_id, target_dir, path=ARCHIVE_PATH):
+    """Decompresses every file of an archived snapshot into target_dir."""
+    os.makedirs(target_dir, exist_ok=True)
+    for name in get_snapshot(snapshot_id, path)['files']:
+        with open_snapshot_file(snapshot_id, name, 'rb', path) as source, \
+                open(os.path.join(target_dir, name), 'wb') as target:
+            shutil.copyfileobj(source, target, READ_BLOCK_SIZE)
+    print(f"Restored snapshot {snapshot_id} to {target_dir}")
+
+
+def prune_snapshots(keep=ARCHIVE_KEEP_SNAPSHOTS, max_age_days=ARCHIVE_MAX_AGE_DAYS, path=ARCHIVE_PATH):
+    """Applies the retention policy, then deletes objects no remaining snapshot uses.
+
+    Keeps at most `keep` snapshots and none older than max_age_days; either limit
+    can be None. The newest snapshot is always kept.
+    """
+    manifests = list_snapshots(path)
+    expired = manifests[:-keep] if keep and len(manifests) > keep else []
+    if max_age_days is not None:
+        cutoff = datetime.now() - timedelta(days=max_age_days)
+        expired += [manifest for manifest in manifests[:-1]
+                    if datetime.fromisoformat(manifest['created_at']) < cutoff and manifest not in expired]
+    if not expired:
+        return
+
+    for manifest in expired:
+        os.remove(os.path.join(snapshots_dir(path), f"{manifest['id']}.json"))
+    referenced = {entry['sha256'] for manifest in list_snapshots(path) for entry in manifest['files'].values()}
+    removed_objects = 0
+    for prefix in os.listdir(objects_dir(path)):
+        for name in os.listdir(os.path.join(objects_dir(path), prefix)):
+            if name.endswith('.gz') and name[:-3] not in referenced:
+                os.remove(os.path.join(objects_dir(path), prefix, name))
+                removed_objects += 1
+    print(f"Pruned {len(expired)} snapshot(s) and {removed_objects} unreferenced object(s).")
@@ -0,0 +1,219 @@
+import os
+import json
+import random
+from datetime import date, timedelta
+
+# Vocabulary for generated free text; medical-sounding so tokenizers see realistic input
+WORDS = ('patients treatment study phase randomized placebo controlled trial efficacy safety dose '
+         'cancer tumor chronic disease therapy clinical response survival progression adult '
+         'pediatric cohort baseline week month outcome primary secondary endpoint adverse event '
+         'inhibitor antibody vaccine infection diabetes cardiac heart failure renal hepatic lung '
+         'breast prostate leukemia lymphoma blood pressure glucose insulin quality life score '
+         'assessment visit screening eligible informed consent history prior concomitant').split()
+CONDITIONS = ['Breast Cancer', 'Type 2 Diabetes', 'Hypertension', 'Asthma', 'HIV Infections', 'Obesity',
+              'Prostate Cancer', 'Heart Failure', 'Depression', 'Alzheimer Disease', 'COVID-19',
+              'Non-small Cell Lung Cancer', 'Rheumatoid Arthritis', 'Chronic Kidney Disease', 'Stroke']
+SPONSORS = [f'{name} {kind}' for name in ('Northwind', 'Contoso', 'Fabrikam', 'Globex', 'Initech', 'Umbrella',
+                                          'Stark', 'Wayne', 'Tyrell', 'Cyberdyne', 'Aperture', 'Hooli')
+            for kind in ('University', 'Pharmaceuticals', 'Medical Center', 'Research Institute')]
+CITIES = [('Boston', 'Massachusetts', 'United States', 42.36, -71.06), ('Houston', 'Texas', 'United States', 29.76, -95.37),
+          ('Toronto', 'Ontario', 'Canada', 43.65, -79.38), ('London', None, 'United Kingdom', 51.51, -0.13),
+          ('Paris', None, 'France', 48.86, 2.35), ('Berlin', None, 'Germany', 52.52, 13.40),
+          ('Tokyo', None, 'Japan', 35.68, 139.69), ('Shanghai', None, 'China', 31.23, 121.47),
+          ('Sao Paulo', None, 'Brazil', -23.55, -46.63), ('Sydney', 'New South Wales', 'Australia', -33.87, 151.21),
+          ('Cairo', None, 'Egypt', 30.04, 31.24), ('Mumbai', None, 'India', 19.08, 72.88)]
+STATUSES = ['COMPLETED', 'RECRUITING', 'UNKNOWN', 'ACTIVE_NOT_RECRUITING', 'TERMINATED', 'NOT_YET_RECRUITING',
+            'WITHDRAWN', 'ENROLLING_BY_INVITATION']
+PHASES = [[], ['PHASE1'], ['PHASE2'], ['PHASE3'], ['PHASE4'], ['PHASE1', 'PHASE2'], ['PHASE2', 'PHASE3']]
+FIRST_POST_START = date(1999, 9, 17)
+FIRST_POST_DAYS = (date(2025, 12, 31) - FIRST_POST_START).days
+
+
+def text(rng, words):
+    return ' '.join(rng.choices(WORDS, k=words)).capitalize() + '.'
+
+
+def first_post_date(index, seed=0):
+    """Returns the study's first-post date; spread over the registry's lifetime."""
+    days = (index * 2654435761 + seed * 40503) % 2 ** 32 * FIRST_POST_DAYS // 2 ** 32
+    return (FIRST_POST_START + timedelta(days=days)).isoformat()
+
+
+def last_update_date(index, seed=0):
+    """Returns the study's last-update date, some time after its first post."""
+    first_post = date.fromisoformat(first_post_date(index, seed))
+    days = (index * 40503 + seed) % max((date(2025, 12, 31) - first_post).days, 1)
+    return (first_post + timedelta(days=days)).isoformat()
+
+
+def make_study(index, seed=0):
+    """Builds a synthetic study in the shape of a ClinicalTrials.gov v2 'studies' item.
+
+    The same index and seed always give the same study. Sizes and list lengths are
+    skewed the way registry data is: most studies have a few sites, some hundreds,
+    and about a third carry a resultsSection.
+    """
+    rng = random.Random(seed * 1000003 + index)
+    nct_id = f'NCT{index:08d}'
+    first_post = first_post_date(index, seed)
+    last_update = last_update_date(index, seed)
+    sponsor = rng.choice(SPONSORS)
+    arms = [{'label': f'Arm {chr(65 + arm)}', 'type': rng.choice(['EXPERIMENTAL', 'PLACEBO_COMPARATOR', 'ACTIVE_COMPARATOR']),
+             'description': text(rng, 25)} for arm in range(rng.randint(1, 4))]
+    locations = []
+    for _ in range(min(int(rng.paretovariate(1.2)), 300)):
+        city, state, country, lat, lon = rng.choice(CITIES)
+        locations.append({'facility': f'{rng.choice(SPONSORS)} Site {rng.randint(1, 99)}',
+                          'status': rng.choice(['RECRUITING', 'COMPLETED', 'NOT_YET_RECRUITING']),
+                          'city': city, 'state': state, 'zip': f'{rng.randint(10000, 99999)}', 'country': country,
+                          'geoPoint': {'lat': round(lat + rng.uniform(-0.5, 0.5), 5),
+                                       'lon': round(lon + rng.uniform(-0.5, 0.5), 5)}})
+    study = {
+        'protocolSection': {
+            'identificationModule': {
+                'nctId': nct_id, 'orgStudyIdInfo': {'id': f'ORG-{index}'},
+                'organization': {'fullName': sponsor, 'class': 'OTHER'},
+                'briefTitle': text(rng, 12), 'officialTitle': text(rng, 24),
+            },
+            'statusModule': {
+                'statusVerifiedDate': last_update[:7], 'overallStatus': rng.choice(STATUSES),
+                'expandedAccessInfo': {'hasExpandedAccess': rng.random() < 0.02},
+                'startDateStruct': {'date': first_post[:7], 'type': 'ACTUAL'},
+                'primaryCompletionDateStruct': {'date': last_update[:7], 'type': 'ESTIMATED'},
+                'completionDateStruct': {'date': last_update[:7], 'type': 'ESTIMATED'},
+                'studyFirstSubmitDate': first_post, 'studyFirstSubmitQcDate': first_post,
+                'studyFirstPostDateStruct': {'date': first_post, 'type': 'ACTUAL'},
+                'lastUpdateSubmitDate': last_update,
+                'lastUpdatePostDateStruct': {'date': last_update, 'type': 'ACTUAL'},
+            },
+            'sponsorCollaboratorsModule': {
+                'responsibleParty': {'type': rng.choice(['SPONSOR', 'PRINCIPAL_INVESTIGATOR'])},
+                'leadSponsor': {'name': sponsor, 'class': rng.choice(['INDUSTRY', 'OTHER', 'NIH'])},
+                'collaborators': [{'name': rng.choice(SPONSORS), 'class': 'OTHER'} for _ in range(rng.randint(0, 3))],
+            },
+            'oversightModule': {'oversightHasDmc': rng.random() < 0.4, 'isFdaRegulatedDrug': rng.random() < 0.3,
+                                'isFdaRegulatedDevice': rng.random() < 0.1},
+            'descriptionModule': {'briefSummary': text(rng, rng.randint(40, 120)),
+                                  'detailedDescription': text(rng, rng.randint(0, 600))},
+            'conditionsModule': {'conditions': rng.sample(CONDITIONS, rng.randint(1, 3)),
+                                 'keywords': rng.sample(WORDS, rng.randint(0, 6))},
+            'designModule': {
+                'studyType': rng.choice(['INTERVENTIONAL', 'INTERVENTIONAL', 'OBSERVATIONAL']),
+                'phases': rng.choice(PHASES),
+                'designInfo': {'allocation': rng.choice(['RANDOMIZED', 'NON_RANDOMIZED']),
+                               'interventionModel': rng.choice(['PARALLEL', 'SINGLE_GROUP', 'CROSSOVER']),
+                               'primaryPurpose': rng.choice(['TREATMENT', 'PREVENTION', 'DIAGNOSTIC']),
+                               'maskingInfo': {'masking': rng.choice(['NONE', 'DOUBLE', 'QUADRUPLE'])}},
+                'enrollmentInfo': {'count': rng.randint(10, 5000), 'type': rng.choice(['ACTUAL', 'ESTIMATED'])},
+            },
+            'armsInterventionsModule': {
+                'armGroups': arms,
+                'interventions': [{'type': rng.choice(['DRUG', 'BIOLOGICAL', 'DEVICE', 'BEHAVIORAL']),
+                                   'name': f'{rng.choice(WORDS).capitalize()}-{rng.randint(100, 999)}',
+                                   'description': text(rng, 20), 'armGroupLabels': [arm['label'] for arm in arms],
+                                   'otherNames': [f'XR-{rng.randint(1000, 9999)}' for _ in range(rng.randint(0, 2))]}
+                                  for _ in range(rng.randint(1, 3))],
+            },
+            'outcomesModule': {
+                'primaryOutcomes': [{'measure': text(rng, 8), 'description': text(rng, 30),
+                                     'timeFrame': f'{rng.randint(1, 52)} weeks'} for _ in range(rng.randint(1, 3))],
+                'secondaryOutcomes': [{'measure': text(rng, 8), 'description': text(rng, 30),
+                                       'timeFrame': f'{rng.randint(1, 24)} months'} for _ in range(rng.randint(0, 8))],
+            },
+            'eligibilityModule': {
+                'eligibilityCriteria': 'Inclusion Criteria:\n\n' + '\n'.join(f'* {text(rng, 12)}' for _ in range(rng.randint(2, 12))) +
+                                       '\n\nExclusion Criteria:\n\n' + '\n'.join(f'* {text(rng, 12)}' for _ in range(rng.randint(2, 15))),
+                'healthyVolunteers': rng.random() < 0.2, 'sex': rng.choice(['ALL', 'ALL', 'ALL', 'FEMALE', 'MALE']),
+                'minimumAge': f'{rng.choice([18, 18, 12, 40, 6])} Years',
+                'maximumAge': rng.choice([None, '65 Years', '80 Years', '17 Years']),
+                'stdAges': ['ADULT', 'OLDER_ADULT'],
+            },
+            'contactsLocationsModule': {
+                'centralContacts': [{'name': 'Study Contact', 'role': 'CONTACT', 'phone': '555-0100',
+                                     'email': f'trial{index}@example.org'}],
+                'overallOfficials': [{'name': f'Dr. {rng.choice(WORDS).capitalize()}', 'role': 'PRINCIPAL_INVESTIGATOR',
+                                      'affiliation': sponsor}],
+                'locations': locations,
+            },
+            'referencesModule': {'references': [{'pmid': str(rng.randint(10 ** 7, 4 * 10 ** 7)), 'type': 'BACKGROUND',
+                                                 'citation': text(rng, 30)} for _ in range(rng.randint(0, 5))]},
+        },
+        'derivedSection': {
+            'miscInfoModule': {'versionHolder': '2025-12-31'},
+            'conditionBrowseModule': {'meshes': [{'id': f'D{rng.randint(1000, 9999)}', 'term': rng.choice(CONDITIONS)}
+                                                 for _ in range(rng.randint(1, 6))]},
+        },
+        'hasResults': False,
+    }
+    if rng.random() < 0.3:
+        study['hasResults'] = True
+        study['resultsSection'] = {'outcomeMeasuresModule': {'outcomeMeasures': [
+            {'type': 'PRIMARY', 'title': text(rng, 8), 'unitOfMeasure': 'participants',
+             'classes': [{'categories': [{'measurements': [{'groupId': f'OG00{group}', 'value': str(rng.randint(0, 500))}
+                                                           for group in range(len(arms))]}]}]}
+            for _ in range(rng.randint(1, 10))]}}
+    return study
+
+
+class SyntheticSource:
+    """A registry of `count` synthetic studies, generated on demand."""
+
+    def __init__(self, count, seed=0):
+        self.count = count
+        self.seed = seed
+
+    def __len__(self):
+        return self.count
+
+    def study(self, position):
+        return make_study(position + 1, self.seed)
+
+    def first_post_date(self, position):
+        return first_post_date(position + 1, self.seed)
+
+    def last_update_date(self, position):
+        return last_update_date(position + 1, self.seed)
+
+    def pages(self, page_size):
+        """Yields the studies in pages of page_size, as fetch_data() would."""
+        for start in range(0, self.count, page_size):
+            yield [self.study(position) for position in range(start, min(start + page_size, self.count))]
+
+
+class FixtureSource(SyntheticSource):
+    """A registry made of pages recorded from the live API by record_fixtures()."""
+
+    def __init__(self, directory):
+        self.studies = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.json'):
+                with open(os.path.join(directory, name), mode='r', encoding='utf-8') as file:
+                    self.studies.extend(json.load(file)['studies'])
+        super().__init__(len(self.studies))
+
+    def study(self, position):
+        return self.studies[position]
+
+    def first_post_date(self, position):
+        status_module = self.studies[position]['protocolSection']['statusModule']
+        return status_module.get('studyFirstPostDateStruct', {}).get('date', '')
+
+    def last_update_date(self, position):
+        status_module = self.studies[position]['protocolSection']['statusModule']
+        return status_module.get('lastUpdatePostDateStruct', {}).get('date', '')
+
+
+def record_fixtures(directory, count, url, page_size=1000):
+    """Saves about `count` full studies from the live API as page files for FixtureSource."""
+    import data_fetcher
+
+    os.makedirs(directory, exist_ok=True)
+    recorded = 0
+    with data_fetcher.create_session(1) as session:
+        for page_number, (studies, _) in enumerate(data_fetcher.fetch_pages(session, url, {'pageSize': page_size})):
+            with open(os.path.join(directory, f'page-{page_number:05d}.json'), mode='w', encoding='utf-8') as file:
+                json.dump({'studies': studies}, file)
+            recorded += len(studies)
+            if recorded >= count:
+                break
+    print(f"Recorded {recorded} studies to {directory}")
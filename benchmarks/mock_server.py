@@ -0,0 +1,191 @@
+import re
+import json
+import time
+import threading
+import multiprocessing
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import urlopen
+try:
+    import orjson
+except ImportError:  # Optional; responses are encoded with the json module instead
+    orjson = None
+
+# The filter.advanced terms data_fetcher.py sends: shard and incremental date ranges
+RANGE_FILTER = re.compile(r'AREA\[(StudyFirstPostDate|LastUpdatePostDate)\]RANGE\[([^,\]]+),([^\]]+)\]')
+DATA_TIMESTAMP = '2025-12-31T12:00:00'
+
+
+def encode_json(data):
+    if orjson:
+        return orjson.dumps(data)
+    return json.dumps(data).encode('utf-8')
+
+
+def field_tree(fields):
+    """Turns a comma-separated `fields` parameter into a nested dict of path parts."""
+    tree = {}
+    for path in fields.split(','):
+        node = tree
+        for part in path.strip().split('.'):
+            node = node.setdefault(part, {})
+    return tree
+
+
+def project(value, tree):
+    """Keeps only the paths in tree, descending into lists like the API does."""
+    if not tree:
+        return value
+    if isinstance(value, list):
+        return [project(item, tree) for item in value]
+    if isinstance(value, dict):
+        return {key: project(value[key], subtree) for key, subtree in tree.items() if key in value}
+    return value
+
+
+class MockRegistry:
+    """Serves a fixtures source the way the ClinicalTrials.gov v2 API pages it.
+
+    Keeps counters of requests and bytes for the benchmark to read from /stats.
+    """
+
+    def __init__(self, source, data_timestamp=DATA_TIMESTAMP, throttle=None):
+        self.source = source
+        self.throttle = throttle
+        self.tokens = throttle or 0
+        self.refilled = time.monotonic()
+        self.data_timestamp = data_timestamp
+        self.dates = {'StudyFirstPostDate': [source.first_post_date(i) for i in range(len(source))],
+                      'LastUpdatePostDate': [source.last_update_date(i) for i in range(len(source))]}
+        self.matches = {}
+        self.lock = threading.Lock()
+        self.stats = Counter()
+
+    def admit(self):
+        """Takes a token from a bucket refilled at `throttle` requests per second;
+        False means the request should get a 429."""
+        if not self.throttle:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.throttle, self.tokens + (now - self.refilled) * self.throttle)
+            self.refilled = now
+            if self.tokens < 1:
+                self.stats['throttled'] += 1
+                return False
+            self.tokens -= 1
+            return True
+
+    def count(self, **counts):
+        with self.lock:
+            self.stats.update(counts)
+
+    def matching(self, expression):
+        """Returns the source positions matching a filter.advanced expression."""
+        with self.lock:
+            if expression in self.matches:
+                return self.matches[expression]
+        positions = range(len(self.source))
+        for area, low, high in RANGE_FILTER.findall(expression or ''):
+            dates = self.dates[area]
+            positions = [i for i in positions
+                         if (low == 'MIN' or dates[i] >= low) and (high == 'MAX' or dates[i] <= high)]
+        positions = list(positions)
+        with self.lock:
+            self.matches[expression] = positions
+        return positions
+
+    def studies_page(self, query):
+        positions = self.matching(query.get('filter.advanced'))
+        page_size = int(query.get('pageSize', 10))
+        start = int(query.get('pageToken') or 0)
+        tree = field_tree(query['fields']) if query.get('fields') else None
+        studies = [self.source.study(i) for i in positions[start:start + page_size]]
+        page = {'studies': [project(study, tree) for study in studies] if tree else studies}
+        if start + page_size < len(positions):
+            page['nextPageToken'] = str(start + page_size)
+        return encode_json(page)
+
+
+def make_handler(registry):
+    class MockHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def send_body(self, body, status=200):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if url.path.endswith('/studies'):
+                if not registry.admit():
+                    self.send_response(429)
+                    self.send_header('Retry-After', '1')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = registry.studies_page(query)
+                registry.count(source_requests=1, source_bytes=len(body))
+            elif url.path.endswith('/version'):
+                body = encode_json({'apiVersion': '2.0.0', 'dataTimestamp': registry.data_timestamp})
+            elif url.path == '/stats':
+                body = encode_json(dict(registry.stats))
+            else:
+                body = encode_json({'error': 'not found'})
+                return self.send_body(body, 404)
+            self.send_body(body)
+
+        def read_body(self):
+            """Reads a request body sent with Content-Length or chunked, as the uploader streams chunks."""
+            if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+                return len(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            size = 0
+            while chunk_size := int(self.rfile.readline().split(b';')[0], 16):
+                size += len(self.rfile.read(chunk_size))
+                self.rfile.readline()
+            while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                pass
+            return size
+
+        def do_POST(self):
+            registry.count(target_requests=1, target_bytes=self.read_body())
+            self.send_body(b'{}')
+
+        def log_message(self, format, *args):
+            pass
+
+    return MockHandler
+
+
+def serve(source, port, ready=None, throttle=None):
+    """Serves source on 127.0.0.1:port until the process is terminated; with throttle,
+    /studies answers 429 beyond that many requests per second."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(MockRegistry(source, throttle=throttle)))
+    server.daemon_threads = True
+    if ready is not None:
+        ready.set()
+    server.serve_forever()
+
+
+def start(source, port, throttle=None):
+    """Starts the mock in a separate process, so serving does not compete with the
+    code being measured for the GIL. Returns the process; terminate() it when done."""
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    process = context.Process(target=serve, args=(source, port, ready, throttle), daemon=True)
+    process.start()
+    if not ready.wait(600):
+        process.terminate()
+        raise RuntimeError("The mock server did not start.")
+    return process
+
+
+def read_stats(port):
+    """Returns the mock's request and byte counters."""
+    with urlopen(f'http://127.0.0.1:{port}/stats') as response:
+        return Counter(json.loads(response.read()))
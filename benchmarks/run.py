@@ -0,0 +1,350 @@
+"""Benchmarks the sync pipeline against a local mock of the ClinicalTrials.gov API.
+
+    python -m benchmarks.run --studies 10000 --output benchmarks/results.jsonl
+    python -m benchmarks.run --fixtures fixtures/ --stages fetch,transform
+    python -m benchmarks.run --record fixtures/ --studies 5000
+
+Run from the repository root. Each stage runs in a fresh process with the config
+pointed at the mock and a scratch directory, so its peak memory is its own.
+Results are printed as JSON and, with --output, appended as one line to a JSON
+Lines file for tracking over time.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import hashlib
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime
+from benchmarks import mock_server
+from benchmarks.fixtures import FixtureSource, SyntheticSource, record_fixtures
+
+STAGES = ['fetch', 'transform', 'diff', 'save', 'upload', 'process_data']
+
+# Share of studies the diff stage changes, removes and adds relative to the index
+DIFF_CHANGED = 0.01
+DIFF_REMOVED = 0.005
+DIFF_ADDED = 0.005
+
+
+class TimedIterable:
+    """Wraps an iterable and adds up the time spent producing its items, so that
+    generating a stage's input can be left out of the stage's timing."""
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self.iterator)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+def make_source(options):
+    if options['fixtures']:
+        return FixtureSource(options['fixtures'])
+    return SyntheticSource(options['studies'], options['seed'])
+
+
+def configure(options, workdir, port):
+    """Points the config at the mock and every path setting into workdir.
+
+    Must run before any pipeline module is imported, since they copy settings from
+    config at import time.
+    """
+    import config
+
+    base_url = f'http://127.0.0.1:{port}'
+    config.SOURCE_URL = f'{base_url}/api/v2/studies'
+    config.VERSION_URL = f'{base_url}/api/v2/version'
+    config.TARGET_URL = f'{base_url}/upload'
+    for name, value in vars(config).copy().items():
+        if name.endswith('_PATH') and isinstance(value, str) and value.startswith('./'):
+            setattr(config, name, os.path.join(workdir, value[2:]))
+    for name in ['PAGE_SIZE', 'FETCH_SHARDS', 'FETCH_WORKERS', 'TRANSFORM_WORKERS', 'UPLOAD_WORKERS']:
+        if options[name.lower()] is not None:
+            setattr(config, name, options[name.lower()])
+    if options['output_formats']:
+        config.OUTPUT_FORMATS = options['output_formats'].split(',')
+    if options['no_projection']:
+        config.FETCH_PROJECTION = False
+    os.makedirs(config.DATA_PATH, exist_ok=True)
+    return config
+
+
+def file_bytes(paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+def bench_fetch(options, config, port):
+    """fetch_data() over every shard of the mock registry."""
+    import data_fetcher
+
+    before = mock_server.read_stats(port)
+    studies = 0
+    start = time.perf_counter()
+    for page in data_fetcher.fetch_data(config.SOURCE_URL, shards=config.FETCH_SHARDS):
+        studies += len(page)
+    seconds = time.perf_counter() - start
+    served = mock_server.read_stats(port) - before
+    return {'seconds': seconds, 'items': studies, 'bytes': served['source_bytes'],
+            'requests': served['source_requests'], 'throttled': served['throttled']}
+
+
+def bench_transform(options, config, port):
+    """flatten_pages() over pages of studies, as decoded from the API."""
+    import data_fetcher
+
+    pages = TimedIterable(make_source(options).pages(config.PAGE_SIZE))
+    studies, rows = 0, {table: 0 for table in data_fetcher.TABLES}
+    start = time.perf_counter()
+    for processed, digests in data_fetcher.flatten_pages(pages, data_fetcher.load_dimension_keys()):
+        studies += len(digests)
+        for table, table_rows in processed.items():
+            rows[table] += len(table_rows)
+    seconds = time.perf_counter() - start - pages.seconds
+    return {'seconds': seconds, 'items': studies, 'rows': rows}
+
+
+def bench_diff(options, config, port):
+    """Staging a run's digests in the study hash index, diff_run() and commit_run().
+
+    The index first holds every study; the run then changes, removes and adds the
+    DIFF_* shares of them. Digests are synthetic, since only their bytes matter.
+    """
+    import data_fetcher
+    import study_index
+
+    tables = list(data_fetcher.TABLES)
+    count = len(make_source(options))
+
+    def digests(numbers, version):
+        # A changed study gets a new status, as most registry updates do
+        return {f'NCT{number:08d}': b''.join(
+                    hashlib.blake2b(f'{number}:{table}:{version(number) if table == "statuses" else 0}'.encode(),
+                                    digest_size=study_index.DIGEST_SIZE).digest() for table in tables)
+                for number in numbers}
+
+    def pages(numbers):
+        numbers = list(numbers)
+        for start in range(0, len(numbers), config.PAGE_SIZE):
+            yield numbers[start:start + config.PAGE_SIZE]
+
+    index = study_index.open_index()
+    for numbers in pages(range(1, count + 1)):
+        study_index.stage_studies(index, digests(numbers, lambda number: 0))
+    study_index.commit_run(index, full=True)
+
+    changed_every, removed_every = round(1 / DIFF_CHANGED), round(1 / DIFF_REMOVED)
+    run_numbers = [number for number in range(1, count + int(count * DIFF_ADDED) + 1) if number % removed_every]
+    version = lambda number: 1 if number % changed_every == 1 else 0
+    seconds = 0.0
+    for numbers in pages(run_numbers):
+        page = digests(numbers, version)
+        start = time.perf_counter()
+        study_index.stage_studies(index, page)
+        seconds += time.perf_counter() - start
+    start = time.perf_counter()
+    diff = study_index.diff_run(index, tables, full=True)
+    study_index.commit_run(index, full=True)
+    seconds += time.perf_counter() - start
+    index.close()
+    return {'seconds': seconds, 'items': len(run_numbers), 'added': len(diff['added']),
+            'changed': len(diff['changed']), 'removed': len(diff['removed'])}
+
+
+def bench_save(options, config, port):
+    """Writing flattened rows to the latest table files in every output format.
+
+    This is the table writing that save_data() used to do for every table; the
+    rows are flattened beforehand, outside the timing.
+    """
+    import data_fetcher
+    import table_writers
+
+    paths = {(table, fmt): data_fetcher.table_path(table, fmt)
+             for table in data_fetcher.TABLES for fmt in config.OUTPUT_FORMATS}
+    pages = data_fetcher.flatten_pages(make_source(options).pages(config.PAGE_SIZE),
+                                       data_fetcher.load_dimension_keys(), workers=1)
+    rows = 0
+    start = time.perf_counter()
+    with ExitStack() as stack:
+        writers = {(table, fmt): stack.enter_context(table_writers.open_table_writer(
+            path, data_fetcher.TABLES[table], fmt, data_fetcher.COLUMN_TYPES)) for (table, fmt), path in paths.items()}
+        seconds = time.perf_counter() - start
+        for processed, _ in TimedIterable(pages):
+            start = time.perf_counter()
+            for (table, fmt), writer in writers.items():
+                writer.writerows(processed[table])
+                rows += len(processed[table])
+            seconds += time.perf_counter() - start
+        start = time.perf_counter()
+    seconds += time.perf_counter() - start
+    data_fetcher.save_data([{'apiVersion': '2.0.0', 'dataTimestamp': mock_server.DATA_TIMESTAMP}],
+                           os.path.join(config.DATA_PATH, 'latest_version_data.csv'), data_fetcher.VERSION_FIELDNAMES)
+    return {'seconds': seconds, 'items': rows, 'bytes': file_bytes(paths.values())}
+
+
+def bench_upload(options, config, port):
+    """upload_data() of every latest table in the upload format; the tables are
+    written first, outside the timing."""
+    import data_fetcher
+    import uploader
+
+    bench_save(options, config, port)
+    paths = [data_fetcher.table_path(table, config.UPLOAD_FORMAT) for table in data_fetcher.TABLES]
+    before = mock_server.read_stats(port)
+    start = time.perf_counter()
+    results = uploader.upload_files(paths, config.TARGET_URL)
+    seconds = time.perf_counter() - start
+    received = mock_server.read_stats(port) - before
+    return {'seconds': seconds, 'items': len(paths), 'bytes': file_bytes(paths),
+            'wire_bytes': received['target_bytes'], 'requests': received['target_requests'],
+            'failed': sum(not succeeded for succeeded in results.values())}
+
+
+def bench_process_data(options, config, port):
+    """A first process_data() run end to end: version check, full sync, index
+    builds and upload. Includes the run report's per-stage breakdown."""
+    import data_fetcher
+
+    start = time.perf_counter()
+    data_fetcher.process_data()
+    seconds = time.perf_counter() - start
+    with open(config.METRICS_REPORT_PATH, mode='r', encoding='utf-8') as file:
+        report = json.load(file)
+    return {'seconds': seconds, 'items': len(make_source(options)), 'outcome': report['outcome'],
+            'stages': {name: stage['seconds'] for name, stage in report['stages'].items()}}
+
+
+def max_rss_mb(who):
+    """Returns the peak resident set size of this process or its children in MB."""
+    max_rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return round(max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_stage(stage, options, workdir, port):
+    """Runs one stage in this (fresh) process and returns its measurements."""
+    sys.stdout = open(os.devnull, 'w')
+    config = configure(options, workdir, port)
+    rss_before = max_rss_mb(resource.RUSAGE_SELF)
+    result = globals()[f'bench_{stage}'](options, config, port)
+    seconds = result['seconds']
+    result['items_per_second'] = round(result['items'] / seconds, 1) if seconds else None
+    if 'bytes' in result:
+        result['mb_per_second'] = round(result['bytes'] / seconds / 1e6, 2) if seconds else None
+    result['seconds'] = round(seconds, 4)
+    result['rss_before_mb'] = rss_before
+    result['peak_rss_mb'] = max_rss_mb(resource.RUSAGE_SELF)
+    result['peak_children_rss_mb'] = max_rss_mb(resource.RUSAGE_CHILDREN)
+    return result
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the sync pipeline against a local mock API.")
+    parser.add_argument('--studies', type=int, default=10000, help="number of synthetic studies (default 10000)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic studies")
+    parser.add_argument('--fixtures', help="serve studies recorded with --record from this directory instead")
+    parser.add_argument('--record', metavar='DIRECTORY',
+                        help="record --studies studies from the live API into DIRECTORY and exit")
+    parser.add_argument('--stages', default=','.join(STAGES), help=f"comma-separated stages (default {','.join(STAGES)})")
+    parser.add_argument('--repeat', type=int, default=1, help="runs of each stage; all are reported")
+    parser.add_argument('--output', help="append the results as one JSON line to this file")
+    parser.add_argument('--workdir', help="scratch directory (default: a temporary one, removed afterwards)")
+    parser.add_argument('--port', type=int, help="port of the mock API (default: any free port)")
+    parser.add_argument('--throttle', type=float,
+                        help="make the mock answer 429 beyond this many page requests per second")
+    parser.add_argument('--page-size', type=int, help="override PAGE_SIZE")
+    parser.add_argument('--fetch-shards', type=int, help="override FETCH_SHARDS")
+    parser.add_argument('--fetch-workers', type=int, help="override FETCH_WORKERS")
+    parser.add_argument('--transform-workers', type=int, help="override TRANSFORM_WORKERS")
+    parser.add_argument('--upload-workers', type=int, help="override UPLOAD_WORKERS")
+    parser.add_argument('--output-formats', help="override OUTPUT_FORMATS (comma-separated)")
+    parser.add_argument('--no-projection', action='store_true', help="fetch whole studies (FETCH_PROJECTION = False)")
+    args = parser.parse_args(argv)
+    unknown = set(args.stages.split(',')) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.record:
+        import config
+        record_fixtures(args.record, args.studies, config.SOURCE_URL)
+        return
+
+    options = vars(args)
+    source = make_source(options)
+    port = args.port or free_port()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='clinical-api-benchmark-')
+    report = {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'source': 'fixtures' if args.fixtures else 'synthetic',
+        'studies': len(source),
+        'options': {name: value for name, value in options.items()
+                    if name not in ('output', 'workdir', 'record') + (('studies', 'seed') if args.fixtures else ())},
+        'stages': {},
+    }
+
+    print(f"Starting the mock API with {len(source)} studies on port {port}...", file=sys.stderr)
+    mock = mock_server.start(source, port, args.throttle)
+    context = multiprocessing.get_context('spawn')
+    try:
+        for stage in args.stages.split(','):
+            runs = []
+            for run in range(args.repeat):
+                stage_dir = os.path.join(workdir, f'{stage}-{run}')
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    runs.append(executor.submit(run_stage, stage, options, stage_dir, port).result())
+                shutil.rmtree(stage_dir, ignore_errors=True)
+                print(f"{stage}: {runs[-1]['seconds']}s, {runs[-1]['items_per_second']} items/s, "
+                      f"peak {runs[-1]['peak_rss_mb']} MB", file=sys.stderr)
+            report['stages'][stage] = runs[0] if args.repeat == 1 else runs
+    finally:
+        mock.terminate()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, mode='a', encoding='utf-8') as file:
+            file.write(json.dumps(report) + '\n')
+
+
+if __name__ == "__main__":
+    main()
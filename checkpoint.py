@@ -0,0 +1,86 @@
+import os
+import gzip
+import json
+import shutil
+from config import CHECKPOINT_PATH
+
+RUN_FILE = 'run.json'
+CURSOR_FILE = 'cursor.json'
+
+
+def write_json(path, data):
+    """Atomically writes data as JSON to path."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, mode='w', encoding='utf-8') as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+
+def open_run(key, path=CHECKPOINT_PATH):
+    """Returns the checkpoint directory for a fetch run identified by key.
+
+    A checkpoint left by an interrupted run with the same key (same snapshot and
+    query) is kept so the run can resume; one left for any other key is discarded,
+    since its pages and page tokens belong to a different snapshot.
+    """
+    run_file = os.path.join(path, RUN_FILE)
+    if os.path.exists(run_file):
+        with open(run_file, mode='r', encoding='utf-8') as file:
+            if json.load(file) == key:
+                print(f"Resuming fetch from checkpoint in {path}")
+                return path
+        discard_run(path)
+    os.makedirs(path, exist_ok=True)
+    write_json(run_file, key)
+    return path
+
+
+def discard_run(path=CHECKPOINT_PATH):
+    """Deletes a run's checkpoint once its snapshot has been written (or is stale)."""
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+
+def shard_dir(run_path, shard):
+    """Returns (creating it if needed) the checkpoint directory of one shard."""
+    path = os.path.join(run_path, f'shard-{shard:03d}')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def load_cursor(path):
+    """Returns a shard's cursor: pages received so far, the next page token and whether
+    the last page was reached."""
+    cursor_file = os.path.join(path, CURSOR_FILE)
+    if not os.path.exists(cursor_file):
+        return {'pages': 0, 'next_page_token': None, 'done': False}
+    with open(cursor_file, mode='r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def page_path(path, index):
+    """Returns the path of a checkpointed page."""
+    return os.path.join(path, f'page-{index:06d}.json.gz')
+
+
+def save_page(path, cursor, studies, next_page_token):
+    """Checkpoints a received page, then advances the shard's cursor past it."""
+    with gzip.open(page_path(path, cursor['pages']), mode='wt', encoding='utf-8', compresslevel=1) as file:
+        json.dump(studies, file)
+    cursor = {'pages': cursor['pages'] + 1, 'next_page_token': next_page_token, 'done': not next_page_token}
+    write_json(os.path.join(path, CURSOR_FILE), cursor)
+    return cursor
+
+
+def saved_pages(path, cursor):
+    """Yields the pages a shard had already received, in order."""
+    for index in range(cursor['pages']):
+        with gzip.open(page_path(path, index), mode='rt', encoding='utf-8') as file:
+            yield json.load(file)
+
+
+def reset_shard(path):
+    """Forgets everything received for a shard so it is fetched from the start."""
+    shutil.rmtree(path)
+    os.makedirs(path)
+    return load_cursor(path)
@@ -1,14 +1,139 @@
+import os
+
 # URL endpoints
 SOURCE_URL = 'https://clinicaltrials.gov/api/v2/studies'
 VERSION_URL = 'https://clinicaltrials.gov/api/v2/version'
 
 
 # Update with website url
-TARGET_URL = 'yourwebsite.com/clinicaldata' #http://127.0.0.1:5000/api/upload
+TARGET_URL = 'yourwebsite.com/clinicaldata' #http://127.0.0.1:5000/api/upload (tests/upload_receiver.py)
 
 # File paths
 ARCHIVE_PATH = './archives/'
+DELTA_PATH = './deltas/'
 DATA_PATH = './data/clinicaldata/'
+SYNC_STATE_PATH = './data/clinicaldata/sync_state.json'
+STUDY_INDEX_PATH = './data/clinicaldata/study_index.sqlite'
+CHECKPOINT_PATH = './data/clinicaldata/checkpoint/'
+TEXT_INDEX_PATH = './data/clinicaldata/text_index.sqlite'
+DIMENSIONS_PATH = './data/clinicaldata/dimensions.sqlite'
+ELIGIBILITY_MATRIX_PATH = './data/clinicaldata/eligibility_matrix.npz'
+
+# Sync mode: 'incremental' fetches only studies updated since the last sync,
+# 'full' downloads the whole registry every run
+SYNC_MODE = 'incremental'
+
+# Upload mode: 'delta' uploads only the rows of changed studies plus a list of
+# removed ones, 'full' uploads every changed table in full
+UPLOAD_MODE = 'delta'
+
+# Output formats for the latest tables: 'csv' is always written (incremental
+# merges read it); add 'parquet' for typed, compressed columnar copies (needs
+# pyarrow). UPLOAD_FORMAT picks which of them deltas and uploads use.
+OUTPUT_FORMATS = ['csv']
+UPLOAD_FORMAT = 'csv'
+PARQUET_COMPRESSION = 'zstd'
+PARQUET_ROW_GROUP_SIZE = 100000
+
+# Uploads: files are sent by UPLOAD_WORKERS threads as gzip-compressed chunks of
+# UPLOAD_CHUNK_SIZE bytes, each retried UPLOAD_RETRIES times with exponential
+# backoff from UPLOAD_BACKOFF seconds. Acknowledged chunks are tracked under
+# UPLOAD_STATE_PATH so an interrupted upload resumes where it stopped.
+UPLOAD_WORKERS = 4
+UPLOAD_CHUNK_SIZE = 64 * 1024 * 1024
+UPLOAD_RETRIES = 3
+UPLOAD_BACKOFF = 2
+UPLOAD_STATE_PATH = './data/clinicaldata/uploads/'
+
+# Archive: before latest tables are replaced, their previous contents are kept
+# as a snapshot under ARCHIVE_PATH, each distinct file stored once (gzip at
+# ARCHIVE_COMPRESSION_LEVEL, keyed by SHA-256). Only byte-identical files are
+# shared: a table that changed at all is stored again in full, so with
+# ARCHIVE_KEEP_SNAPSHOTS snapshots expect up to that many compressed copies of the
+# large tables. The newest ARCHIVE_KEEP_SNAPSHOTS snapshots younger than
+# ARCHIVE_MAX_AGE_DAYS are retained; set either to None to disable that limit.
+ARCHIVE_KEEP_SNAPSHOTS = 30
+ARCHIVE_MAX_AGE_DAYS = 90
+ARCHIVE_COMPRESSION_LEVEL = 1
+
+# Read API (read_api.py): served on READ_API_HOST:READ_API_PORT, caching up to
+# READ_API_CACHE_SIZE results per query type and checking for a newly completed
+# sync every READ_API_RELOAD_INTERVAL seconds
+READ_API_HOST = '127.0.0.1'
+READ_API_PORT = 8080
+READ_API_CACHE_SIZE = 4096
+READ_API_RELOAD_INTERVAL = 60
+
+# Site search (geo_index.py): trial sites are bucketed into grid cells of
+# GEO_CELL_DEGREES degrees of latitude and longitude. Needs numpy.
+GEO_CELL_DEGREES = 0.5
+
+# Full-text search (text_index.py): BM25 weight of each indexed field
+TEXT_INDEX_WEIGHTS = {'brief_summary': 2.0, 'detailed_description': 1.0, 'eligibility': 0.5}
+
+# Eligibility matching (eligibility_matrix.py): patients are screened in blocks
+# of at most ELIGIBILITY_MATCH_BLOCK_CELLS patient-study pairs. Needs numpy.
+ELIGIBILITY_MATCH_BLOCK_CELLS = 16 * 1024 * 1024
+
+# SQLite target (sqlite_target.py): set SQLITE_TARGET_PATH (for example
+# './data/clinicaldata/clinical.sqlite') to also load every table into a local
+# SQLite database in WAL mode. Each run applies only the studies that changed, in
+# one transaction, so readers keep seeing the previous load until it commits.
+# Rows are staged SQLITE_BATCH_SIZE at a time in a temporary database (under
+# SQLITE_TMPDIR or the system temp directory) and the target is locked for writing
+# only while they are applied at the end of the run.
+SQLITE_TARGET_PATH = None
+SQLITE_BATCH_SIZE = 10000
+
+# Run metrics (metrics.py): every run's report (stage times, HTTP latency, rows,
+# bytes, retries, peak memory) is written to METRICS_REPORT_PATH and appended to
+# METRICS_HISTORY_PATH. Set METRICS_PORT to serve them in the Prometheus text
+# format on METRICS_HOST:METRICS_PORT/metrics while the scheduler runs.
+METRICS_REPORT_PATH = './data/clinicaldata/run_report.json'
+METRICS_HISTORY_PATH = './data/clinicaldata/run_reports.jsonl'
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = None
+
+# Scheduler (scheduler.py): /version is polled at least every
+# SCHEDULER_MAX_POLL_INTERVAL and at most every SCHEDULER_MIN_POLL_INTERVAL
+# seconds, timed by how often new data has been published, and a sync runs only
+# when there is a new snapshot. Every SCHEDULER_FULL_SYNC_DAYS one of them is a
+# full sync to pick up removed studies. Failed runs are retried after a jittered
+# backoff doubling from SCHEDULER_RETRY_BACKOFF up to SCHEDULER_MAX_RETRY_BACKOFF
+# seconds. SCHEDULER_LOCK_PATH keeps two processes from syncing at once.
+SCHEDULER_MIN_POLL_INTERVAL = 5 * 60
+SCHEDULER_MAX_POLL_INTERVAL = 60 * 60
+SCHEDULER_FULL_SYNC_DAYS = 7
+SCHEDULER_RETRY_BACKOFF = 60
+SCHEDULER_MAX_RETRY_BACKOFF = 6 * 60 * 60
+SCHEDULER_LOCK_PATH = './data/clinicaldata/sync.lock'
+SCHEDULER_STATE_PATH = './data/clinicaldata/scheduler_state.json'
+
+# Fetching: a full download is split into FETCH_SHARDS StudyFirstPostDate ranges
+# (starting at FETCH_SHARD_START) that FETCH_WORKERS threads page through at once.
+# Pages are handed to the writers in a fixed order, one page of each running shard
+# in turn, and each shard is fetched at most FETCH_QUEUE_PAGES pages ahead.
+PAGE_SIZE = 1000
+FETCH_SHARDS = 16
+FETCH_SHARD_START = '1999-09-01'
+FETCH_WORKERS = 8
+FETCH_QUEUE_PAGES = 4
+# Page requests go through an AIMD limiter (http_client.py): concurrency starts
+# at FETCH_CONCURRENCY_START, grows by one per round of successful requests up to
+# FETCH_WORKERS and halves on a 429 or when latency exceeds FETCH_LATENCY_TOLERANCE
+# times the fastest seen. Throttled and transient failures (429, 5xx, connection
+# errors) are retried FETCH_RETRIES times, after Retry-After when the API sends
+# one and otherwise after a jittered backoff doubling from FETCH_BACKOFF seconds.
+FETCH_CONCURRENCY_START = 2
+FETCH_LATENCY_TOLERANCE = 3.0
+FETCH_RETRIES = 5
+FETCH_BACKOFF = 1
+# Request only the study fields the table extractors read (see study_fields()
+# in data_fetcher.py) instead of every module of every study
+FETCH_PROJECTION = True
+
+# Transform: fetched pages are flattened into table rows by TRANSFORM_WORKERS
+# processes; 1 flattens in the fetching process
+TRANSFORM_WORKERS = os.cpu_count() or 1
  
  
-
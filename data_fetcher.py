@@ -1,49 +1,336 @@
 import os
+import json
 import requests
-import schedule
+try:
+    import orjson
+except ImportError:  # Optional; pages are decoded with the json module instead
+    orjson = None
 import time
 import uuid
+import hashlib
 import csv
-from config import SOURCE_URL, TARGET_URL, VERSION_URL, ARCHIVE_PATH, DATA_PATH
+import queue
+import threading
+import multiprocessing
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import date, datetime, timedelta
+import archive_store
+import checkpoint
+import delta_export
+import dimensions
+import eligibility_matrix
+import http_client
+import metrics
+import numpy_support
+import sqlite_target
+import study_index
+import table_schema
+import table_writers
+import text_index
+import uploader
+from config import (SOURCE_URL, TARGET_URL, VERSION_URL, DATA_PATH, ELIGIBILITY_MATRIX_PATH,
+                    SYNC_MODE, SYNC_STATE_PATH, PAGE_SIZE, FETCH_SHARDS, FETCH_SHARD_START,
+                    FETCH_WORKERS, FETCH_QUEUE_PAGES, FETCH_PROJECTION, TRANSFORM_WORKERS, UPLOAD_MODE,
+                    OUTPUT_FORMATS, UPLOAD_FORMAT, METRICS_PORT, SQLITE_TARGET_PATH)
+
+# Output tables and their CSV columns, in the order they are written (see table_schema.SCHEMA)
+TABLES = table_schema.table_columns(table_schema.SCHEMA)
+
+# Dimension tables of the names the output tables refer to by key, published with them
+DIMENSION_TABLES = {f'{dimension}_dimension': columns for dimension, columns in table_schema.DIMENSIONS.items()}
+
+# The schema compiled once per process into the study extractor and the lookup of
+# the values it gives IDs to
+extract_rows = table_schema.compile_schema(table_schema.SCHEMA)
+key_values = table_schema.compile_key_values(table_schema.SCHEMA)
+
+# Set to stop a fetch in progress at the next page; see scheduler.run()
+shutdown_requested = threading.Event()
+
+# Namespace for row IDs derived from a study ID and the row's natural key
+ROW_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'https://clinicaltrials.gov/api/v2/studies')
+
+# Column types for typed output formats (see table_writers.COLUMN_CONVERTERS);
+# columns not listed are strings
+COLUMN_TYPES = {
+    'start_date': 'date', 'primary_completion_date': 'date', 'completion_date': 'date',
+    'study_first_submit_date': 'date', 'study_first_submit_qc_date': 'date',
+    'study_first_post_date': 'date', 'last_update_submit_date': 'date',
+    'last_update_post_date': 'date', 'status_verified_date': 'date',
+    'oversight_has_dmc': 'bool', 'is_fda_regulated_drug': 'bool', 'is_fda_regulated_device': 'bool',
+    'is_us_export': 'bool', 'has_expanded_access': 'bool', 'healthy_volunteers': 'bool',
+    'gender_based': 'bool',
+    'organization_id': 'int', 'sponsor_organization_id': 'int', 'collaborator_organization_id': 'int',
+    'condition_key': 'int', 'intervention_key': 'int',
+    'enrollment_count': 'int', 'minimum_age_days': 'int', 'maximum_age_days': 'int',
+    'lat': 'float', 'lon': 'float',
+    'phases': 'list', 'std_ages': 'list', 'other_names': 'list',
+}
+
+VERSION_FIELDNAMES = ['apiVersion', 'dataTimestamp']
+
+# Tables holding the text kept in the full-text index (see text_index.py)
+TEXT_TABLES = {'studies', 'eligibility'}
+
+
+def table_path(table, fmt='csv'):
+    """Returns the path of the latest file for a table in an output format."""
+    return os.path.join(DATA_PATH, f'latest_{table}_data.{table_writers.file_extension(fmt)}')
+
+
+class FetchError(Exception):
+    """Raised when pagination stops before the last page was read."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def create_session(pool_size=FETCH_WORKERS):
+    """Creates the pooled session pages are fetched over. Its requests share an
+    adaptive concurrency limit and are retried when throttled; see http_client.py."""
+    return http_client.create_session(pool_size, http_client.AdaptiveLimiter(pool_size))
+
+
+def shard_filters(shard_count, start=FETCH_SHARD_START, end=None):
+    """Splits the registry into shard_count disjoint StudyFirstPostDate ranges
+    between start and end (a date, today by default); the last range is open-ended.
+
+    The first post date never changes once a study is public, so a study cannot move
+    between shards while a run is in progress.
+    """
+    if shard_count <= 1:
+        return [None]
+    first = date.fromisoformat(start)
+    step = ((end or date.today()) - first) / shard_count
+    bounds = [first + step * i for i in range(1, shard_count)]
+    lows = ['MIN'] + [bound.isoformat() for bound in bounds]
+    highs = [(bound - timedelta(days=1)).isoformat() for bound in bounds] + ['MAX']
+    return [f"AREA[StudyFirstPostDate]RANGE[{low},{high}]" for low, high in zip(lows, highs)]
+
+
+def add_filter(params, expression):
+    """Returns a copy of params with expression ANDed into its filter.advanced."""
+    params = dict(params)
+    if expression:
+        existing = params.get('filter.advanced')
+        params['filter.advanced'] = f"({existing}) AND ({expression})" if existing else expression
+    return params
+
+
+def decode_json(content):
+    """Decodes a JSON response body, using orjson when it is installed."""
+    if orjson:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def fetch_pages(session, url, params, page_token=None):
+    """Follows nextPageToken for a single query, starting at page_token if given.
+
+    Yields (studies, next_page_token) for each page. Raises FetchError if a page
+    cannot be fetched.
+    """
+    params = dict(params)
+    if page_token:
+        params['pageToken'] = page_token
 
-def fetch_data(url):
-    """Fetches data from the provided URL with pagination support and avoids duplicates."""
-    all_data = []
-    unique_study_ids = set() 
-    
     while url:
+        start = time.perf_counter()
         try:
-            response = requests.get(url)
-            if response.status_code == 200:
-                print("Data fetched successfully.")
-                data = response.json()
-                
-                for study in data.get('studies', []):
-                    # Extract the study ID (or any other unique identifier)
-                    study_id = study.get('protocolSection', {}).get('identificationModule', {}).get('nctId', None)
-                    
-                    if study_id and study_id not in unique_study_ids:
-                        unique_study_ids.add(study_id)
-                        all_data.append(study)
-                
-                # Get the next page token from the response
-                next_page_token = data.get('nextPageToken', None)
-                if next_page_token:
-                    
-                    url = f"{SOURCE_URL}?pageToken={next_page_token}"
-                else:
-                   
-                    url = None
-            else:
-                print(f"Failed to fetch data. Status Code: {response.status_code}")
-                break
+            response = session.get(url, params=params)
         except requests.exceptions.RequestException as e:
-            print(f"Error fetching data: {e}")
-            break
+            metrics.record_request('studies', time.perf_counter() - start, error=True)
+            raise FetchError(f"Error fetching data: {e}") from e
+        metrics.record_request('studies', time.perf_counter() - start, len(response.content),
+                               error=response.status_code != 200)
+        if response.status_code != 200:
+            raise FetchError(f"Failed to fetch data. Status Code: {response.status_code}",
+                             response.status_code)
+        metrics.count('pages_fetched')
+        metrics.count('bytes_fetched', len(response.content))
+
+        data = decode_json(response.content)
+
+        # Get the next page token from the response, keeping the original query
+        next_page_token = data.get('nextPageToken', None)
+        yield data.get('studies', []), next_page_token
+        if next_page_token:
+            params['pageToken'] = next_page_token
+        else:
+            url = None
+
+
+def fetch_shard(session, url, query, checkpoint_path=None):
+    """Yields the studies of each page of one shard.
+
+    With a checkpoint_path, every page is saved there before it is yielded and the
+    shard's cursor advanced, so an interrupted run replays the pages it already has
+    from disk and continues from the saved page token.
+    """
+    if not checkpoint_path:
+        for studies, _ in fetch_pages(session, url, query):
+            yield studies
+        return
+
+    cursor = checkpoint.load_cursor(checkpoint_path)
+    yield from checkpoint.saved_pages(checkpoint_path, cursor)
+    if cursor['done']:
+        return
+
+    resumed = cursor['pages'] > 0
+    try:
+        for studies, next_page_token in fetch_pages(session, url, query, cursor['next_page_token']):
+            resumed = False
+            cursor = checkpoint.save_page(checkpoint_path, cursor, studies, next_page_token)
+            yield studies
+    except FetchError as e:
+        # A saved page token the API no longer accepts; start the shard over
+        if not (resumed and e.status_code and 400 <= e.status_code < 500 and e.status_code != 429):
+            raise
+        print(f"Checkpointed page token rejected ({e}); refetching shard.")
+        checkpoint.reset_shard(checkpoint_path)
+        yield from fetch_shard(session, url, query, checkpoint_path)
+
+
+def fetch_shards(session, url, queries, workers, checkpoint_paths):
+    """Fetches several queries concurrently and yields their pages in a fixed order.
+
+    Up to `workers` queries are paginated at once by worker threads into one shared
+    queue, each at most FETCH_QUEUE_PAGES pages ahead of the writers. Pages are
+    tagged with their query and page number and put back in order: one page of each
+    running query in turn, a finished query's turn passing to the next query. The
+    order therefore depends only on the pages, not on which request returned first,
+    so two runs over the same snapshot yield the same pages in the same order.
+    """
+    if len(queries) == 1:
+        yield from fetch_shard(session, url, queries[0], checkpoint_paths[0])
+        return
+
+    stop = threading.Event()
+    arrived = queue.Queue()
+    credits = [threading.Semaphore(FETCH_QUEUE_PAGES) for _ in queries]
+
+    def run(shard):
+        index = 0
+        try:
+            for page in fetch_shard(session, url, queries[shard], checkpoint_paths[shard]):
+                while not credits[shard].acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                arrived.put((shard, index, page))
+                index += 1
+            arrived.put((shard, index, None))
+        except Exception as e:
+            arrived.put((shard, index, e))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        waiting = deque(range(len(queries)))
+        # Running shards in turn order; each ends with None, or with the exception
+        # that stopped it, which is raised as soon as it arrives
+        rotation = deque()
+        next_pages = [0] * len(queries)
+        buffered = {}
 
-    return {'studies': all_data}
+        def start():
+            shard = waiting.popleft()
+            executor.submit(run, shard)
+            rotation.append(shard)
 
+        while waiting and len(rotation) < workers:
+            start()
+        try:
+            while rotation:
+                shard = rotation.popleft()
+                while (shard, next_pages[shard]) not in buffered:
+                    page_shard, index, item = arrived.get()
+                    if isinstance(item, Exception):
+                        raise item
+                    buffered[page_shard, index] = item
+                page = buffered.pop((shard, next_pages[shard]))
+                if page is None:
+                    if waiting:
+                        start()
+                    continue
+                next_pages[shard] += 1
+                rotation.append(shard)
+                credits[shard].release()
+                yield page
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def study_nct_id(study):
+    """Returns a study's nctId, or None if it has none."""
+    return study.get('protocolSection', {}).get('identificationModule', {}).get('nctId', None)
+
+
+def fetch_data(url, params=None, shards=1, workers=FETCH_WORKERS, snapshot=None):
+    """Fetches data from the provided URL with pagination support and avoids duplicates.
+
+    The query is split into shards fetched concurrently over one pooled session.
+    Yields the new studies of each page, in an order that does not depend on request
+    timing (see fetch_shards()), so callers never hold more than a few pages in
+    memory. Raises FetchError if a page cannot be fetched.
 
+    When the dataTimestamp of the snapshot being fetched is given, progress is
+    checkpointed (see checkpoint.py) and a fetch of the same snapshot and query that
+    was interrupted resumes where it stopped.
+    """
+    params = dict(params or {})
+    params.setdefault('pageSize', PAGE_SIZE)
+    if FETCH_PROJECTION:
+        params.setdefault('fields', ','.join(study_fields()))
+    # Shard bounds follow from the snapshot rather than today's date, so the
+    # checkpoint key stays the same when a run is resumed on a later day
+    end = date.fromisoformat(snapshot[:10]) if snapshot else None
+    queries = [add_filter(params, expression) for expression in shard_filters(shards, end=end)]
+    checkpoint_paths = [None] * len(queries)
+    if snapshot:
+        run_path = checkpoint.open_run({'url': url, 'snapshot': snapshot, 'queries': queries})
+        checkpoint_paths = [checkpoint.shard_dir(run_path, shard) for shard in range(len(queries))]
+    unique_study_ids = set()
+    page_count = 0
+
+    with create_session(workers) as session:
+        for studies in fetch_shards(session, url, queries, workers, checkpoint_paths):
+            page_count += 1
+            if shutdown_requested.is_set():
+                # Leaving fetch_shards() lets its threads checkpoint the pages in flight
+                raise FetchError("Fetch stopped by a shutdown request.")
+            page = []
+            for study in studies:
+                study_id = study_nct_id(study)
+
+                if study_id and study_id not in unique_study_ids:
+                    unique_study_ids.add(study_id)
+                    page.append(study)
+            metrics.count('studies_fetched', len(page))
+            yield page
+        fetch_limits = session.limiter.stats()
+    metrics.annotate(fetch_limits=fetch_limits)
+    print(f"Fetched {len(unique_study_ids)} studies in {page_count} pages, "
+          f"finishing at a limit of {fetch_limits['limit']} concurrent requests; "
+          f"{fetch_limits.get('throttled', 0)} throttled, {fetch_limits.get('errors', 0)} failed.")
+
+
+def fetch_version(url):
+    """Fetches the registry version info ({'apiVersion', 'dataTimestamp'})."""
+    start = time.perf_counter()
+    try:
+        response = requests.get(url)
+        metrics.record_request('version', time.perf_counter() - start, len(response.content),
+                               error=response.status_code != 200)
+        if response.status_code == 200:
+            return response.json()
+        print(f"Failed to fetch version. Status Code: {response.status_code}")
+    except requests.exceptions.RequestException as e:
+        metrics.record_request('version', time.perf_counter() - start, error=True)
+        print(f"Error fetching version: {e}")
+    return None
 
 
 def save_data(data, file_path, fieldnames):
@@ -55,7 +342,7 @@ def save_data(data, file_path, fieldnames):
             # Create a dictionary with default values for missing fieldnames
             processed_item = {field: item.get(field, '') for field in fieldnames}
             processed_data.append(processed_item)
-        
+
         # Write data to CSV
         with open(file_path, mode='w', newline='', encoding='utf-8') as file:
             writer = csv.DictWriter(file, fieldnames=fieldnames)
@@ -66,28 +353,22 @@ def save_data(data, file_path, fieldnames):
 
 
 def upload_data(file_path, url):
-    """Uploads data to a target URL (real file upload to Flask)."""
-    print(f"Uploading data to {url}...")
-    try:
-        with open(file_path, 'rb') as file:
-            files = {'file': file}
-            response = requests.post(url, files=files)
-            
-        if response.status_code == 200:
-            print("File uploaded successfully.")
-        else:
-            print(f"Failed to upload file. Status code: {response.status_code}")
-    except requests.exceptions.RequestException as e:
-        print(f"Error uploading file: {e}")
-        
+    """Uploads a single file to a target URL; see uploader.upload_file() for the protocol."""
+    return uploader.upload_files([file_path], url)[file_path]
+
+
+def archive_latest():
+    """Archives every latest table and the version file as one snapshot.
 
+    Called before a run replaces any latest table, so the archive holds each
+    published state; see archive_store.py for storage and retention.
+    """
+    version_path = os.path.join(DATA_PATH, 'latest_version_data.csv')
+    version_rows = get_existing_data(version_path)
+    file_paths = [table_path(table, fmt) for table in [*TABLES, *DIMENSION_TABLES] for fmt in OUTPUT_FORMATS]
+    file_paths.append(version_path)
+    return archive_store.archive_snapshot(file_paths, version_rows[0]['dataTimestamp'] if version_rows else None)
 
-def move_to_archive(file_path):
-    """Moves the file to the archive folder."""
-    if not os.path.exists(ARCHIVE_PATH):
-        os.makedirs(ARCHIVE_PATH)
-    os.rename(file_path, os.path.join(ARCHIVE_PATH, os.path.basename(file_path)))
-    print(f"Moved file to archive: {os.path.basename(file_path)}")
 
 def get_existing_data(file_path):
     """Read existing data from a CSV file."""
@@ -96,483 +377,687 @@ def get_existing_data(file_path):
     with open(file_path, mode='r', encoding='utf-8') as file:
         reader = csv.DictReader(file)
         return list(reader)
-    
-    
-def process_data():
-    """Main function to process data from both endpoints."""
-    # Fetch and process studies data
-    studies_data = fetch_data(SOURCE_URL)
-    
-    if studies_data:
-        
-        processed_studies = []
-        processed_organizations = []
-        processed_statuses = []
-        processed_sponsors = []
-        processed_collaborators = []
-        processed_conditions = []
-        processed_designs = []
-        processed_arms = []
-        processed_interventions = []
-        processed_outcomes = []
-        processed_eligibility = []
-        processed_contacts = []
-        processed_locations = []
-
-        # Dictionary to map organization names to IDs
-        organization_id_map = {}
-        next_organization_id = 1
-
-        for study in studies_data.get('studies', []):
-            protocol_section = study.get('protocolSection', {})
-            identification_module = protocol_section.get('identificationModule', {})
-            status_module = protocol_section.get('statusModule', {})
-            sponsor_collaborators_module = protocol_section.get('sponsorCollaboratorsModule', {})
-            oversight_module = protocol_section.get('oversightModule', {})
-            description_module = protocol_section.get('descriptionModule', {})
-            design_module = study.get('designModule', {})
-            arms_interventions_module = study.get('armsInterventionsModule', {})
-            intervention = study.get('interventionsModule', {})
-            outcomes_module = study.get('outcomesModule', {})
-            eligibility_module = study.get('eligibilityModule', {})
-            contacts_locations_module = study.get('contactsModule', {})
-            locations_module = protocol_section.get('contactsLocationsModule', {}).get('locations', [])  
-
-            study_id = identification_module.get('nctId', None)
-            brief_title = identification_module.get('briefTitle', None)
-            official_title = identification_module.get('officialTitle', None)
-            acronym = identification_module.get('orgStudyIdInfo', {}).get('id', None)
-            start_date = status_module.get('startDateStruct', {}).get('date', None)
-            primary_completion_date = status_module.get('primaryCompletionDateStruct', {}).get('date', None)
-            completion_date = status_module.get('completionDateStruct', {}).get('date', None)
-            study_first_submit_date = status_module.get('studyFirstSubmitDate', None)
-            study_first_submit_qc_date = status_module.get('studyFirstSubmitQcDate', None)
-            study_first_post_date = status_module.get('studyFirstPostDateStruct', {}).get('date', None)
-            last_update_submit_date = status_module.get('lastUpdateSubmitDate', None)
-            last_update_post_date = status_module.get('lastUpdatePostDateStruct', {}).get('date', None)
-            oversight_has_dmc = oversight_module.get('oversightHasDmc', None)
-            is_fda_regulated_drug = oversight_module.get('isFdaRegulatedDrug', None)
-            is_fda_regulated_device = oversight_module.get('isFdaRegulatedDevice', None)
-            is_us_export = oversight_module.get('isUsExport', None)  # This field was not present in the provided JSON
-            brief_summary = description_module.get('briefSummary', None)
-            detailed_description = description_module.get('detailedDescription', None)
-            
-            
-            
-            
-            
-        
-            for org in sponsor_collaborators_module.get('collaborators', []):
-                org_name = org.get('name', None)
-                org_class = org.get('class', None)
-                
-                # Create a unique ID for each organization
-                if org_name not in organization_id_map:
-                    organization_id_map[org_name] = next_organization_id
-                    next_organization_id += 1
-
-                organization_id = organization_id_map[org_name]
-
-                processed_organizations.append({
-                    'organization_id': organization_id,
-                    'organization_name': org_name,
-                    'organization_class': org_class,
-                    'study_id': study_id  # Foreign Key
-                })
-
-            processed_studies.append({
-                'study_id': study_id,
-                'brief_title': brief_title,
-                'official_title': official_title,
-                'acronym': acronym,
-                'start_date': start_date,
-                'primary_completion_date': primary_completion_date,
-                'completion_date': completion_date,
-                'study_first_submit_date': study_first_submit_date,
-                'study_first_submit_qc_date': study_first_submit_qc_date,
-                'study_first_post_date': study_first_post_date,
-                'last_update_submit_date': last_update_submit_date,
-                'last_update_post_date': last_update_post_date,
-                'oversight_has_dmc': oversight_has_dmc,
-                'is_fda_regulated_drug': is_fda_regulated_drug,
-                'is_fda_regulated_device': is_fda_regulated_device,
-                'is_us_export': is_us_export,  # This field was not present in the provided JSON
-                'brief_summary': brief_summary,
-                'detailed_description': detailed_description
-            })
-            
-            
-            # Process Statuses
-            status_id = f"{study_id}_status"  
-            status_verified_date = status_module.get('statusVerifiedDate', None)
-            overall_status = status_module.get('overallStatus', None)
-            has_expanded_access = status_module.get('expandedAccessInfo', {}).get('hasExpandedAccess', None)
-            processed_statuses.append({
-                'status_id': status_id,
-                'study_id': study_id,
-                'status_verified_date': status_verified_date,
-                'overall_status': overall_status,
-                'has_expanded_access': has_expanded_access
-            })
-
-            # Process Sponsors
-            sponsor_id = str(uuid.uuid4()) 
-            responsible_party_type = sponsor_collaborators_module.get('responsibleParty', {}).get('type', None)
-            lead_sponsor = sponsor_collaborators_module.get('leadSponsor', {})
-            sponsor_name = lead_sponsor.get('name', None)
-            sponsor_class = lead_sponsor.get('class', None)
-            processed_sponsors.append({
-                'sponsor_id': sponsor_id,
-                'study_id': study_id,
-                'sponsor_name': sponsor_name,
-                'sponsor_class': sponsor_class,
-                'responsible_party_type': responsible_party_type
-            })
-
-            # Process Collaborators
-            for collab in sponsor_collaborators_module.get('collaborators', []):
-                collaborator_id = str(uuid.uuid4()) 
-                collaborator_name = collab.get('name', None)
-                collaborator_class = collab.get('class', None)
-                processed_collaborators.append({
-                    'collaborator_id': collaborator_id,
-                    'sponsor_id': sponsor_id,
-                    'collaborator_name': collaborator_name,
-                    'collaborator_class': collaborator_class
-                })
-
-            
-
-            # Process Design Module
-            design_module = protocol_section.get('designModule', {})
-            design_id = str(uuid.uuid4()) 
-            processed_designs.append({
-                "design_id": design_id, 
-                'study_id': study_id,
-                'study_type': design_module.get('studyType', None),
-                'phases': design_module.get('phases', []),
-                'allocation': design_module.get('designInfo', {}).get('allocation', None),
-                'intervention_model': design_module.get('designInfo', {}).get('interventionModel', None),
-                'intervention_model_description': design_module.get('designInfo', {}).get('interventionModelDescription', None),
-                'primary_purpose': design_module.get('designInfo', {}).get('primaryPurpose', None),
-                'masking': design_module.get('designInfo', {}).get('maskingInfo', {}).get('masking', None),
-                'enrollment_count': design_module.get('enrollmentInfo', {}).get('count', None),
-                'enrollment_type': design_module.get('enrollmentInfo', {}).get('type', None)
-            })
-            
-            #condtion
-            conditions_module = protocol_section.get('conditionsModule', {})
-            for condition in conditions_module.get('conditions', []):
-                condition_id=str(uuid.uuid4()) 
-                processed_conditions.append({
-                    "condition_id": condition_id,  # Unique ID, could use a combination of study_id and condition_name
-                    "study_id": study_id,
-                    "condition_name": condition
-                })
-
-            # Process Arms
-            # Process Arms
-            arms_interventions_module = protocol_section.get('armsInterventionsModule', {})
-            for arm in arms_interventions_module.get('armGroups', []):
-                arm_id = str(uuid.uuid4())  
-                processed_arms.append({
-                    'arm_id': arm_id,
-                    'study_id': study_id,
-                    'label': arm.get('label', None),
-                    'type': arm.get('type', None)
-                })
-
-            # Process Interventions
-            arms_interventions_module = protocol_section.get('armsInterventionsModule', {})
-            for intervention in arms_interventions_module.get('interventions', []):
-                intervention_id = str(uuid.uuid4())  
-                intervention_id = f"{arm_id}_{intervention.get('name')}"  
-                processed_interventions.append({
-                    'intervention_id': intervention_id,
-                    'arm_id': arm_id,
-                    'type': intervention.get('type', None),
-                    'name': intervention.get('name', None),
-                    'description': intervention.get('description', None),
-                    'other_names': intervention.get('otherNames', None)
-                })
-
-            # Process Outcomes
-            outcomes_module = protocol_section.get('outcomesModule', {})
-            for outcome_type in ['primaryOutcomes', 'secondaryOutcomes']:
-                for outcome in outcomes_module.get(outcome_type, []):
-                    outcome_id = str(uuid.uuid4()) 
-                    
-                    # Set outcome_type based on the key
-                    if outcome_type == 'primaryOutcomes':
-                        outcome_type_label = 'primary'
-                    elif outcome_type == 'secondaryOutcomes':
-                        outcome_type_label = 'secondary'
-                        
-                    processed_outcomes.append({
-                        'outcome_id': outcome_id,
-                        'study_id': study_id,
-                        'measure': outcome.get('measure', None),
-                        'time_frame': outcome.get('timeFrame', None),
-                        'outcome_type': outcome_type_label 
-                    })
-
-            # Process Eligibility Module
-            eligibility_module = protocol_section.get('eligibilityModule', {})
-            eligibility_id = str(uuid.uuid4())  
-            processed_eligibility.append({
-                'eligibility_id': eligibility_id,  # Primary Key
-                'study_id': study_id,              # Foreign Key
-                'criteria_type': 'Inclusion/Exclusion',  # Assuming this field is fixed or derived
-                'description': eligibility_module.get('eligibilityCriteria', None),  # Eligibility criteria text
-                'healthy_volunteers': eligibility_module.get('healthyVolunteers', None),
-                'sex': eligibility_module.get('sex', None),
-                'gender_based': None,  # This field does not exist in the provided data
-                'minimum_age': eligibility_module.get('minimumAge', None),
-                'maximum_age': eligibility_module.get('maximumAge', None),
-                'std_ages': eligibility_module.get('stdAges', [])  # Assuming this is a list
-            })
-
-
-            # Process Contacts
-            contacts_locations_module = protocol_section.get('contactsLocationsModule', {})
-            
-            
-            # Fetch phone and email from 'centralContacts'
-            central_contact = contacts_locations_module.get('centralContacts', [])
-            phone = central_contact[0].get('phone', None) if central_contact else None
-            email = central_contact[0].get('email', None) if central_contact else None
-            
-            
-            for contact in contacts_locations_module.get('overallOfficials', []): # centralContacts
-                contact_id = str(uuid.uuid4()) 
-                
-                
-                processed_contacts.append({
-                    'contact_id': contact_id,
-                    'study_id': study_id,
-                    'name': contact.get('name', None),
-                    'role': contact.get('role', None),
-                    'phone': phone,
-                    'email': email
-                })
-                
-                
-                
-            # Process Locations
-            for location in locations_module:
-                location_id = str(uuid.uuid4())   
-                processed_locations.append({
-                    'location_id': location_id,                     
-                    'study_id': study_id,                          
-                    'facility': location.get('facility', None),
-                    'status': location.get('status', None),          
-                    'city': location.get('city', None),
-                    'state': location.get('state', None),
-                    'zip': location.get('zip', None),                
-                    'country': location.get('country', None),
-                    'lat': location.get('geoPoint', {}).get('lat', None),  
-                    'lon': location.get('geoPoint', {}).get('lon', None)   
-                })
-                
-           
-            
-        
-
-        # Prepare file paths for studies data
-        latest_studies_path = os.path.join(DATA_PATH, 'latest_studies_data.csv')
-        latest_organizations_path = os.path.join(DATA_PATH, 'latest_organizations_data.csv')
-        latest_statuses_path = os.path.join(DATA_PATH, 'latest_statuses_data.csv')
-        latest_sponsors_path = os.path.join(DATA_PATH, 'latest_sponsors_data.csv')
-        latest_collaborators_path = os.path.join(DATA_PATH, 'latest_collaborators_data.csv')
-        latest_conditions_path = os.path.join(DATA_PATH, 'latest_conditions_data.csv')
-        latest_designs_path = os.path.join(DATA_PATH, 'latest_designs_data.csv')
-        latest_arms_path = os.path.join(DATA_PATH, 'latest_arms_data.csv')
-        latest_interventions_path = os.path.join(DATA_PATH, 'latest_interventions_data.csv')
-        latest_outcomes_path = os.path.join(DATA_PATH, 'latest_outcomes_data.csv')
-        latest_eligibility_path = os.path.join(DATA_PATH, 'latest_eligibility_data.csv')
-        latest_contacts_path = os.path.join(DATA_PATH, 'latest_contacts_data.csv')
-        latest_locations_path = os.path.join(DATA_PATH, 'latest_locations_data.csv')
-        
-        # Define fieldnames for CSV files
-        studies_fieldnames = ['study_id', 'brief_title', 'official_title', 'acronym', 'start_date', 
-                      'primary_completion_date', 'completion_date', 'study_first_submit_date', 
-                      'study_first_submit_qc_date', 'study_first_post_date', 'last_update_submit_date',
-                      'last_update_post_date', 'oversight_has_dmc', 'is_fda_regulated_drug', 
-                      'is_fda_regulated_device', 'is_us_export', 'brief_summary', 'detailed_description']
-
-        organizations_fieldnames = ['organization_id', 'organization_name', 'organization_class', 'study_id']
-        
-        statuses_fieldnames = ['status_id', 'study_id', 'status_verified_date', 'overall_status', 'has_expanded_access']
-        
-        sponsors_fieldnames = ['sponsor_id', 'study_id', 'sponsor_name', 'sponsor_class', 'responsible_party_type']
-        
-        collaborators_fieldnames = ['collaborator_id', 'sponsor_id', 'collaborator_name', 'collaborator_class']
-        
-        design_fieldnames = ['design_id', 'study_id', 'study_type', 'phases', 'allocation', 'intervention_model', 
-                     'intervention_model_description', 'primary_purpose', 'masking', 'enrollment_count', 
-                     'enrollment_type']
-
-        conditions_fieldnames = ['condition_id', 'study_id', 'condition_name']
-
-        arms_fieldnames = ['arm_id', 'study_id', 'label', 'type']
-
-        interventions_fieldnames = ['intervention_id', 'arm_id', 'type', 'name', 'description', 'other_names']
-
-        outcomes_fieldnames = ['outcome_id', 'study_id', 'measure', 'time_frame', 'outcome_type']
-
-        eligibility_fieldnames = ['eligibility_id', 'study_id', 'criteria_type', 'description', 'healthy_volunteers', 
-                          'sex', 'gender_based', 'minimum_age', 'maximum_age', 'std_ages']
-
-        contacts_fieldnames = ['contact_id', 'study_id', 'name', 'role', 'phone', 'email']
-
-        locations_fieldnames = ['location_id', 'study_id', 'facility', 'status', 'city', 'state', 'zip', 'country', 
-                        'lat', 'lon']
-
-
-
-
-
-        
-
-        # Get existing data to compare
-        existing_studies_data = get_existing_data(latest_studies_path)
-        existing_organizations_data = get_existing_data(latest_organizations_path)
-        existing_statuses_data = get_existing_data(latest_statuses_path)
-        existing_sponsors_data = get_existing_data(latest_sponsors_path)
-        existing_collaborators_data = get_existing_data(latest_collaborators_path)
-        existing_conditions_data = get_existing_data(latest_conditions_path)
-        existing_designs_data = get_existing_data(latest_designs_path)
-        existing_arms_data = get_existing_data(latest_arms_path)
-        existing_interventions_data = get_existing_data(latest_interventions_path)
-        existing_outcomes_data = get_existing_data(latest_outcomes_path)
-        existing_eligibility_data = get_existing_data(latest_eligibility_path)
-        existing_contacts_data = get_existing_data(latest_contacts_path)
-        existing_locations_data = get_existing_data(latest_locations_path)
-       
-
-        # Check if the fetched data is different from existing data
-        if (existing_studies_data != processed_studies or
-            existing_organizations_data != processed_organizations or
-            existing_statuses_data != processed_statuses or
-            existing_sponsors_data != processed_sponsors or
-            existing_collaborators_data != processed_collaborators or
-            existing_conditions_data != processed_conditions or
-            existing_designs_data != processed_designs or
-            existing_arms_data != processed_arms or
-            existing_interventions_data != processed_interventions or
-            existing_outcomes_data != processed_outcomes or
-            existing_eligibility_data != processed_eligibility or
-            existing_contacts_data != processed_contacts or
-            existing_locations_data != processed_locations): 
-
-            # Archive old data if it exists
-            if existing_studies_data:
-                move_to_archive(latest_studies_path)
-            if existing_organizations_data:
-                move_to_archive(latest_organizations_path)
-            if existing_statuses_data:
-                move_to_archive(latest_statuses_path)
-            if existing_sponsors_data:
-                move_to_archive(latest_sponsors_path)
-            if existing_collaborators_data:
-                move_to_archive(latest_collaborators_path)
-            if existing_conditions_data:
-                move_to_archive(latest_conditions_path)
-            if existing_designs_data:
-                move_to_archive(latest_designs_path)
-            if existing_arms_data:
-                move_to_archive(latest_arms_path)
-            if existing_interventions_data:
-                move_to_archive(latest_interventions_path)
-            if existing_outcomes_data:
-                move_to_archive(latest_outcomes_path)
-            if existing_eligibility_data:
-                move_to_archive(latest_eligibility_path)
-            if existing_contacts_data:
-                move_to_archive(latest_contacts_path)
-            if existing_locations_data:
-                move_to_archive(latest_locations_path)
-
-            # Save new data
-            save_data(processed_studies, latest_studies_path, studies_fieldnames)
-            save_data(processed_organizations, latest_organizations_path, organizations_fieldnames)
-            save_data(processed_statuses, latest_statuses_path, statuses_fieldnames)
-            save_data(processed_sponsors, latest_sponsors_path,sponsors_fieldnames)
-            save_data(processed_collaborators, latest_collaborators_path,collaborators_fieldnames)
-            save_data(processed_conditions, latest_conditions_path,conditions_fieldnames)
-            save_data(processed_designs, latest_designs_path,design_fieldnames)
-            save_data(processed_arms, latest_arms_path,arms_fieldnames)
-            save_data(processed_interventions, latest_interventions_path,interventions_fieldnames)
-            save_data(processed_outcomes, latest_outcomes_path,outcomes_fieldnames)
-            save_data(processed_eligibility, latest_eligibility_path,eligibility_fieldnames)
-            save_data(processed_contacts, latest_contacts_path,contacts_fieldnames)
-            save_data(processed_locations, latest_locations_path,locations_fieldnames)
-
-            # Upload new data
-            upload_data(latest_studies_path, TARGET_URL)
-            upload_data(latest_organizations_path, TARGET_URL)
-            upload_data(latest_statuses_path, TARGET_URL)
-            upload_data(latest_sponsors_path, TARGET_URL)
-            upload_data(latest_collaborators_path, TARGET_URL)
-            upload_data(latest_conditions_path, TARGET_URL)
-            upload_data(latest_designs_path, TARGET_URL)
-            upload_data(latest_arms_path, TARGET_URL)
-            upload_data(latest_interventions_path, TARGET_URL)
-            upload_data(latest_outcomes_path, TARGET_URL)
-            upload_data(latest_eligibility_path, TARGET_URL)
-            upload_data(latest_contacts_path, TARGET_URL)
-            upload_data(latest_locations_path, TARGET_URL) 
-        else:
-            print("No updates in Studies data.")
 
 
+def load_sync_state():
+    """Loads the state of the last successful sync, or an empty dict if there was none."""
+    if not os.path.exists(SYNC_STATE_PATH):
+        return {}
+    with open(SYNC_STATE_PATH, mode='r', encoding='utf-8') as file:
+        return json.load(file)
 
-    # Fetch and process version data
-    # Define fieldnames for version data
-    version_fieldnames = ['apiVersion', 'dataTimestamp']
-    version_data = fetch_data(VERSION_URL)
-    
-    if version_data:
-        # Ensure version_data is in the correct format
-        if isinstance(version_data, dict):
-            version_data = [version_data]  # Wrap in list if it's a single dictionary
-        
-        # Prepare file paths for version data
-        latest_version_path = os.path.join(DATA_PATH, 'latest_version_data.csv')
 
-        existing_version_data = get_existing_data(latest_version_path)
+def save_sync_state(state):
+    """Atomically records the state of a successful sync."""
+    tmp_path = f"{SYNC_STATE_PATH}.tmp"
+    with open(tmp_path, mode='w', encoding='utf-8') as file:
+        json.dump(state, file, indent=2)
+    os.replace(tmp_path, SYNC_STATE_PATH)
+
+
+def load_dimension_keys():
+    """Loads the keys every dimension has given out so far.
+
+    Organization IDs used to be carried over from the latest organizations table;
+    a store that has none yet is seeded from such a table, so they stay the same.
+    """
+    conn = dimensions.open_store()
+    try:
+        keys = dimensions.load_keys(conn, table_schema.DIMENSIONS)
+    finally:
+        conn.close()
+    organizations = keys['organizations']
+    if not organizations:
+        for row in get_existing_data(table_path('organizations')):
+            if 'organization_name' in row:
+                organizations.setdefault(row['organization_name'], int(row['organization_id']))
+        organizations.added.update(organizations)
+        organizations.next_key = max(organizations.values(), default=0) + 1
+    return keys
+
+
+def save_dimensions(keys, delta_path=None, target=None):
+    """Stores the dimension keys given out in this run and writes the dimension
+    tables that gained any (or are missing) to temporary files; with a delta_path,
+    the new rows are also written to that delta directory, and with a target, loaded
+    into it.
+
+    Called before any latest table referring to the new keys is replaced, so a key
+    in a published table is always in the store. The caller swaps the temporary
+    files in along with the other tables, after archiving the previous ones.
+    Returns the number of new rows per dimension table and {temporary path: latest
+    path} for the files written.
+    """
+    new_rows = {}
+    tmp_paths = {}
+    conn = dimensions.open_store()
+    try:
+        added = dimensions.commit_keys(conn, keys)
+        for dimension, (key_column, name_column) in table_schema.DIMENSIONS.items():
+            table = f'{dimension}_dimension'
+            if target:
+                with metrics.stage('load'):
+                    target.load_dimension(table, ({key_column: key, name_column: name} for key, name in
+                                                  (dimensions.rows(conn, dimension) if target.reload
+                                                   else added.get(dimension, []))))
+            if dimension not in added and all(os.path.exists(table_path(table, fmt)) for fmt in OUTPUT_FORMATS):
+                continue
+            for fmt in OUTPUT_FORMATS:
+                tmp_path = f"{table_path(table, fmt)}.tmp"
+                with table_writers.open_table_writer(tmp_path, DIMENSION_TABLES[table], fmt, COLUMN_TYPES) as writer:
+                    writer.writerows([{key_column: key, name_column: name}
+                                      for key, name in dimensions.rows(conn, dimension)])
+                tmp_paths[tmp_path] = table_path(table, fmt)
+            if delta_path and dimension in added:
+                with ExitStack() as stack:
+                    delta_writers = delta_export.open_delta_writers(stack, delta_path, {table: DIMENSION_TABLES[table]},
+                                                                    UPLOAD_FORMAT, COLUMN_TYPES)
+                    delta_writers[table].writerows([{key_column: key, name_column: name}
+                                                    for key, name in added[dimension]])
+            new_rows[table] = len(added.get(dimension, []))
+    finally:
+        conn.close()
+    return new_rows, tmp_paths
+
+
+def row_id_factory(study_id):
+    """Returns a function building stable row IDs for one study.
+
+    IDs are UUIDs derived from the study ID, the table and the row's natural key, so
+    unchanged upstream data produces the same IDs on every run. Repeated keys within
+    a study are numbered in order of appearance.
+    """
+    seen = Counter()
+    # uuid5() by hand, with the namespace and study ID hashed once per study
+    study_hash = hashlib.sha1(ROW_ID_NAMESPACE.bytes + f'{study_id}\x1f'.encode('utf-8'))
+
+    def row_id(table, *key):
+        key = (table,) + tuple(str(part) for part in key)
+        seen[key] += 1
+        row_hash = study_hash.copy()
+        row_hash.update('\x1f'.join(key + (str(seen[key]),)).encode('utf-8'))
+        digest = row_hash.digest()
+        # Version 5 and RFC 4122 variant bits, as uuid.UUID(version=5) sets them
+        hex_id = (digest[:6] + bytes([digest[6] & 0x0f | 0x50, digest[7], digest[8] & 0x3f | 0x80])
+                  + digest[9:16]).hex()
+        return f'{hex_id[:8]}-{hex_id[8:12]}-{hex_id[12:16]}-{hex_id[16:20]}-{hex_id[20:]}'
+
+    return row_id
+
+
+def study_fields():
+    """Returns the API field paths the table schema reads, for the 'fields' parameter."""
+    return table_schema.api_fields(table_schema.SCHEMA)
+
+
+def flatten_study(study, keys):
+    """Flattens one study into rows for each output table.
+
+    keys maps each dimension to its name -> key map; new names are given keys in place.
+    """
+    return extract_rows(study, row_id_factory(study_nct_id(study)), keys)
+
+
+def flatten_page(studies, keys):
+    """Flattens a page of studies into rows for each output table.
+
+    Also returns the per-table digests of each study for the study hash index.
+    """
+    processed = {table: [] for table in TABLES}
+    digests = {}
+    for study in studies:
+        rows = flatten_study(study, keys)
+        digests[rows['studies'][0]['study_id']] = study_index.study_digests(rows, TABLES)
+        for table, table_rows in rows.items():
+            processed[table].extend(table_rows)
+    return processed, digests
 
-        # Check if the fetched data is different from existing data
-        if existing_version_data != version_data:
-            # Archive old data if it exists
-            if existing_version_data:
-                move_to_archive(latest_version_path)
 
-            save_data(version_data, latest_version_path, version_fieldnames)
+def transform_page(studies, keys):
+    """Runs flatten_page() in a transform worker, also returning the worker's peak
+    memory so far (its process lives only as long as the pool)."""
+    return flatten_page(studies, keys), metrics.peak_rss_bytes()
 
-            upload_data(latest_version_path, TARGET_URL)
+
+def flatten_pages(pages, keys, workers=TRANSFORM_WORKERS):
+    """Yields flatten_page() results for pages, in order, flattening up to twice
+    `workers` pages at a time in a process pool.
+
+    Each page's studies are sorted by nctId, and the names they refer to that have
+    no dimension key yet are given keys here in sorted order, before the page is
+    handed to a worker along with just the keys it needs. Rows come out in page
+    order and, within a page, in nctId order, with the same keys for any number of
+    workers; as fetch_shards() fixes the page order, a run over the same snapshot
+    reproduces its tables byte for byte.
+    """
+    def prepare(page):
+        page = sorted(page, key=lambda study: study_nct_id(study) or '')
+        names = {dimension: {} for dimension in keys}
+        for study in page:
+            for dimension, values in key_values(study).items():
+                names[dimension].update(dict.fromkeys(values))
+        page_keys = {}
+        for dimension, dimension_names in names.items():
+            new_names = [name for name in dimension_names if name not in keys[dimension]]
+            for name in sorted(new_names, key=lambda name: (name is not None, name or '')):
+                keys[dimension][name]
+            page_keys[dimension] = {name: keys[dimension][name] for name in dimension_names}
+        return page, page_keys
+
+    if workers <= 1:
+        for page in pages:
+            yield flatten_page(*prepare(page))
+        return
+
+    # Fetch threads are running, so workers are started from a clean server process
+    # rather than forked from this one
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method)) as executor:
+        pending = deque()
+
+        def next_result():
+            result, worker_peak_rss = pending.popleft().result()
+            metrics.record_worker_rss(worker_peak_rss)
+            return result
+
+        for page in pages:
+            pending.append(executor.submit(transform_page, *prepare(page)))
+            if len(pending) >= 2 * workers:
+                yield next_result()
+        while pending:
+            yield next_result()
+
+
+def merge_table(table, new_rows, changed_study_ids):
+    """Replaces the rows of the changed studies in a table's latest files with new_rows.
+
+    The existing file is streamed into a temporary file rather than loaded, so the
+    merge never holds more than the new rows in memory. In the CSV a changed study's
+    new rows take the place of its old ones, keeping the file order stable; other
+    formats get them appended. Either way the whole table is rewritten, however few
+    studies changed: for the studies table of the full registry that is about 1.1 GB.
+    """
+    fieldnames = TABLES[table]
+    for fmt in OUTPUT_FORMATS:
+        if fmt != 'csv':
+            latest_path = table_path(table, fmt)
+            tmp_path = f"{latest_path}.tmp"
+            table_writers.merge_parquet(latest_path, tmp_path, new_rows, changed_study_ids,
+                                        fieldnames, COLUMN_TYPES)
+            os.replace(tmp_path, latest_path)
+
+    latest_path = table_path(table)
+    tmp_path = f"{latest_path}.tmp"
+
+    new_rows_by_study = {}
+    for item in new_rows:
+        new_rows_by_study.setdefault(item['study_id'], []).append(item)
+
+    with open(tmp_path, mode='w', newline='', encoding='utf-8') as out_file:
+        writer = csv.DictWriter(out_file, fieldnames=fieldnames, extrasaction='ignore')
+        writer.writeheader()
+        if os.path.exists(latest_path):
+            with open(latest_path, mode='r', encoding='utf-8') as in_file:
+                for row in csv.DictReader(in_file):
+                    if row['study_id'] not in changed_study_ids:
+                        writer.writerow(row)
+                    elif row['study_id'] in new_rows_by_study:
+                        writer.writerows(new_rows_by_study.pop(row['study_id']))
+        # Studies that had no rows in this table yet
+        for study_rows in new_rows_by_study.values():
+            writer.writerows(study_rows)
+
+    os.replace(tmp_path, latest_path)
+
+
+def tables_match_schema():
+    """Checks that every latest table exists in every output format and that the CSVs
+    have the columns listed in TABLES."""
+    for table, fieldnames in TABLES.items():
+        if not all(os.path.exists(table_path(table, fmt)) for fmt in OUTPUT_FORMATS):
+            return False
+        with open(table_path(table), mode='r', encoding='utf-8') as file:
+            if csv.DictReader(file).fieldnames != fieldnames:
+                return False
+    return True
+
+
+def text_changed(indexed, digests):
+    """Returns the studies in digests whose text may differ from the full-text index:
+    new ones and those whose studies or eligibility rows changed."""
+    return {study_id for study_id, digest in digests.items()
+            if study_id not in indexed or study_index.changed_tables(indexed[study_id], digest, list(TABLES)) & TEXT_TABLES}
+
+
+def finish_text_index(text_conn, removed_study_ids):
+    """Commits a run's full-text index updates, or builds the index from the latest
+    tables if it has never been built."""
+    if text_index.is_built(text_conn):
+        text_index.remove_studies(text_conn, removed_study_ids)
+        text_conn.commit()
+    else:
+        text_index.rebuild(text_conn, table_path('studies'), table_path('eligibility'))
+
+
+def write_tables(pages, paths, keys, index, delta_path=None, text_conn=None, target=None):
+    """Streams the rows of every study in pages into one open writer per table and
+    output format; paths maps (table, format) to the file to write.
+
+    The digests of each study are staged in the study hash index as pages go by. With
+    a delta_path, the rows of studies whose digests changed are also written to that
+    delta directory; with a text_conn, their text is updated in the full-text index;
+    with a target, they are loaded into it (every study, if it is being reloaded).
+    Returns the number of delta rows written per table.
+    """
+    delta_rows = Counter()
+    with ExitStack() as stack:
+        writers = {}
+        for (table, fmt), path in paths.items():
+            writers[table, fmt] = stack.enter_context(
+                table_writers.open_table_writer(path, TABLES[table], fmt, COLUMN_TYPES))
+        delta_writers = None
+        if delta_path:
+            delta_writers = delta_export.open_delta_writers(stack, delta_path, TABLES, UPLOAD_FORMAT, COLUMN_TYPES)
+
+        pages = metrics.iterate('fetch', pages)
+        for processed, digests in metrics.iterate('transform', flatten_pages(pages, keys)):
+            with metrics.stage('write'):
+                for (table, fmt), writer in writers.items():
+                    writer.writerows(processed[table])
+            for table, table_rows in processed.items():
+                metrics.count_rows(table, len(table_rows))
+            with metrics.stage('diff'):
+                study_index.stage_studies(index, digests)
+                if delta_writers or text_conn or target:
+                    indexed = study_index.lookup(index, digests)
+
+            if text_conn:
+                with metrics.stage('index'):
+                    text_index.update_studies(text_conn,
+                                              text_index.study_documents(processed, text_changed(indexed, digests)))
+            if delta_writers or target:
+                changed = {study_id for study_id, digest in digests.items() if indexed.get(study_id) != digest}
+            if target:
+                loaded = set(digests) if target.reload else changed
+                with metrics.stage('load'):
+                    target.replace_studies({table: [row for row in table_rows if row['study_id'] in loaded]
+                                            for table, table_rows in processed.items()}, loaded)
+            if delta_writers:
+                with metrics.stage('write'):
+                    for table, table_rows in processed.items():
+                        changed_rows = [row for row in table_rows if row['study_id'] in changed]
+                        delta_writers[table].writerows(changed_rows)
+                        delta_rows[table] += len(changed_rows)
+
+    return delta_rows
+
+
+def remove_files(paths):
+    """Removes the given files, ignoring those that do not exist."""
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def print_diff(diff):
+    """Prints a one-line summary of a study index diff."""
+    print(f"Studies: {len(diff['added'])} added, {len(diff['changed'])} changed, "
+          f"{diff['unchanged']} unchanged, {len(diff['removed'])} removed.")
+
+
+def sync_full(delta_path=None, snapshot=None, target=None):
+    """Downloads the whole registry and replaces the latest tables that changed.
+
+    Rows are written to temporary files as pages arrive and only swapped in once the
+    last page has been read; an incomplete fetch never touches the latest tables. The
+    study hash index decides which tables changed, so the previous files are never
+    read back. Fetch progress for the snapshot's dataTimestamp is checkpointed so an
+    interrupted run resumes. Changed studies are loaded into target (a
+    sqlite_target.SqliteLoader), if given, for the caller to commit. Returns a dict
+    with the changed 'tables' and 'dimensions', the index 'diff' and the
+    'delta_rows' written per table, or None if the fetch did not complete.
+    """
+    tmp_paths = {(table, fmt): f"{table_path(table, fmt)}.tmp" for table in TABLES for fmt in OUTPUT_FORMATS}
+    keys = load_dimension_keys()
+    index = study_index.open_index()
+    text_conn = text_index.open_index()
+    try:
+        try:
+            delta_rows = write_tables(fetch_data(SOURCE_URL, shards=FETCH_SHARDS, snapshot=snapshot), tmp_paths,
+                                      keys, index, delta_path,
+                                      text_conn if text_index.is_built(text_conn) else None, target)
+        except BaseException as e:
+            remove_files(tmp_paths.values())
+            if not isinstance(e, FetchError):
+                raise
+            print(e)
+            if snapshot:
+                print("Fetch progress is checkpointed; the next run resumes from it.")
+            return None
+
+        with metrics.stage('write'):
+            dimension_rows, dimension_paths = save_dimensions(keys, delta_path, target)
+        delta_rows.update(dimension_rows)
+        with metrics.stage('diff'):
+            diff = study_index.diff_run(index, list(TABLES), full=True)
+        print_diff(diff)
+        if target:
+            with metrics.stage('load'):
+                target.delete_studies(diff['removed'])
+        # Tables from an older schema (or missing ones) are rewritten regardless
+        rebuild = not tables_match_schema()
+        changed_tables = [table for table in TABLES if rebuild or table in diff['tables']]
+        if changed_tables or dimension_paths:
+            with metrics.stage('archive'):
+                archive_latest()
+        for tmp_path, path in dimension_paths.items():
+            os.replace(tmp_path, path)
+        for (table, fmt), tmp_path in tmp_paths.items():
+            if table in changed_tables:
+                os.replace(tmp_path, table_path(table, fmt))
+            else:
+                os.remove(tmp_path)
+        # The text index commits first so it can never lag behind the study index
+        with metrics.stage('index'):
+            finish_text_index(text_conn, diff['removed'])
+        with metrics.stage('diff'):
+            study_index.commit_run(index, full=True)
+    finally:
+        index.close()
+        text_conn.close()
+    checkpoint.discard_run()
+
+    return {'tables': changed_tables, 'dimensions': [table for table, rows in dimension_rows.items() if rows],
+            'diff': diff, 'delta_rows': delta_rows}
+
+
+def sync_incremental(since_date, delta_path=None, target=None):
+    """Fetches only studies updated on or after since_date and merges them into the latest tables.
+
+    Studies removed from the registry are not detected in this mode; a periodic full
+    sync picks those up. Changed studies are loaded into target, if given; a target
+    being reloaded is loaded from the merged latest tables instead. Returns the same
+    dict as sync_full() plus the changed studies' 'eligibility_rows', or None if the
+    fetch did not complete.
+    """
+    params = {'filter.advanced': f"AREA[LastUpdatePostDate]RANGE[{since_date},MAX]"}
+    try:
+        pages = list(metrics.iterate('fetch', fetch_data(SOURCE_URL, params)))
+    except FetchError as e:
+        print(e)
+        return None
+    print(f"{sum(len(page) for page in pages)} studies updated since {since_date}.")
+
+    processed, digests = {table: [] for table in TABLES}, {}
+    # A single page is not worth starting a process pool for
+    workers = TRANSFORM_WORKERS if len(pages) > 1 else 1
+    keys = load_dimension_keys()
+    transformed = flatten_pages(pages, keys, workers)
+    for page_rows, page_digests in metrics.iterate('transform', transformed):
+        for table, table_rows in page_rows.items():
+            processed[table].extend(table_rows)
+        digests.update(page_digests)
+    with metrics.stage('write'):
+        dimension_rows, dimension_paths = save_dimensions(keys, delta_path, target)
+    index = study_index.open_index()
+    text_conn = text_index.open_index()
+    try:
+        with metrics.stage('diff'):
+            study_index.stage_studies(index, digests)
+            diff = study_index.diff_run(index, list(TABLES), full=False)
+        print_diff(diff)
+
+        # Only studies whose flattened rows actually changed are merged
+        changed_study_ids = set(diff['added']) | set(diff['changed'])
+        changed_rows = {table: [row for row in processed[table] if row['study_id'] in changed_study_ids]
+                        for table in TABLES}
+        changed_tables = [table for table in TABLES if table in diff['tables']]
+        if changed_tables or dimension_paths:
+            with metrics.stage('archive'):
+                archive_latest()
+        for tmp_path, path in dimension_paths.items():
+            os.replace(tmp_path, path)
+        for table in changed_tables:
+            with metrics.stage('write'):
+                merge_table(table, changed_rows[table], changed_study_ids)
+            metrics.count_rows(table, len(changed_rows[table]))
+        if target:
+            with metrics.stage('load'):
+                if target.reload:
+                    for table in TABLES:
+                        target.load_csv(table, table_path(table))
+                else:
+                    target.replace_studies(changed_rows, changed_study_ids)
+        with metrics.stage('index'):
+            if text_index.is_built(text_conn):
+                text_index.update_studies(text_conn, text_index.study_documents(
+                    processed, text_changed(study_index.lookup(index, digests), digests)))
+            finish_text_index(text_conn, diff['removed'])
+        with metrics.stage('diff'):
+            study_index.commit_run(index, full=False)
+    finally:
+        index.close()
+        text_conn.close()
+
+    delta_rows = Counter(dimension_rows)
+    if delta_path:
+        with metrics.stage('write'), ExitStack() as stack:
+            delta_writers = delta_export.open_delta_writers(stack, delta_path, TABLES, UPLOAD_FORMAT, COLUMN_TYPES)
+            for table, table_rows in changed_rows.items():
+                delta_writers[table].writerows(table_rows)
+                delta_rows[table] = len(table_rows)
+
+    return {'tables': changed_tables, 'dimensions': [table for table, rows in dimension_rows.items() if rows],
+            'diff': diff, 'delta_rows': delta_rows, 'eligibility_rows': changed_rows['eligibility']}
+
+
+def upload_batches(batches, url):
+    """Uploads queued batches in order and returns the ones still pending.
+
+    A batch is {'files': [...], 'manifest': path or None}. Its files go up
+    concurrently and its manifest only once they all succeeded. Uploading stops at
+    the first incomplete batch so consumers never receive deltas out of order.
+    """
+    for position, batch in enumerate(batches):
+        results = uploader.upload_files(batch['files'], url)
+        if not all(results.values()):
+            return batches[position:]
+        if batch['manifest'] and not upload_data(batch['manifest'], url):
+            return batches[position:]
+    return []
+
+
+def snapshot_batch(snapshot):
+    """Builds the upload batch for a full snapshot of every latest table."""
+    table_files = {table: table_path(table, UPLOAD_FORMAT) for table in [*DIMENSION_TABLES, *TABLES]
+                   if os.path.exists(table_path(table, UPLOAD_FORMAT))}
+    manifest_path = delta_export.snapshot_manifest(delta_export.delta_dir(snapshot), table_files, UPLOAD_FORMAT, snapshot)
+    return {'files': list(table_files.values()), 'manifest': manifest_path}
+
+
+def upload_snapshot(snapshot):
+    """Uploads every latest table followed by a manifest describing the full snapshot."""
+    return not upload_batches([snapshot_batch(snapshot)], TARGET_URL)
+
+
+def publish_changes(result, upload_mode, delta_path, snapshot, base_snapshot):
+    """Builds the upload batch for the outcome of a sync, or None if nothing changed.
+
+    In 'delta' mode that is the delta written on top of base_snapshot, or a full
+    snapshot when there was no base to apply one to. In 'full' mode it is every
+    latest table that changed. Dimension tables that gained names come first, so
+    consumers know every key before rows refer to it.
+    """
+    if not result['tables'] and not result['dimensions']:
+        print("No updates in Studies data.")
+        if delta_path:
+            remove_files(delta_export.delta_table_path(delta_path, table, UPLOAD_FORMAT)
+                         for table in [*DIMENSION_TABLES, *TABLES])
+            os.rmdir(delta_path)
+        return None
+
+    if delta_path:
+        diff = result['diff']
+        files = delta_export.finish_delta(delta_path, {**DIMENSION_TABLES, **TABLES}, UPLOAD_FORMAT,
+                                          result['delta_rows'], diff['added'] + diff['changed'], diff['removed'],
+                                          snapshot, base_snapshot)
+        return {'files': files[:-1], 'manifest': files[-1]}
+    if upload_mode == 'delta' and snapshot:
+        return snapshot_batch(snapshot)
+    return {'files': [table_path(table, UPLOAD_FORMAT) for table in result['dimensions'] + result['tables']],
+            'manifest': None}
+
+
+def update_eligibility_matrix(result):
+    """Brings the eligibility matrix up to date when the eligibility table changed or
+    the matrix is missing; see eligibility_matrix.py.
+
+    After an incremental sync only the entries of the studies it changed are
+    replaced, from the rows it produced; otherwise the matrix is rebuilt from the
+    latest eligibility table.
+    """
+    if 'eligibility' not in result['tables'] and os.path.exists(ELIGIBILITY_MATRIX_PATH):
+        return
+    if not numpy_support.has_numpy():
+        print("numpy is not installed; not building the eligibility matrix.")
+        return
+    matrix = None
+    if 'eligibility_rows' in result and os.path.exists(ELIGIBILITY_MATRIX_PATH):
+        try:
+            matrix = eligibility_matrix.EligibilityMatrix.load(ELIGIBILITY_MATRIX_PATH)
+        except KeyError:
+            print("The eligibility matrix was written by an older version; rebuilding it.")
+    if matrix is not None:
+        diff = result['diff']
+        matrix = matrix.updated(diff['added'] + diff['changed'] + diff['removed'], result['eligibility_rows'])
+        print(f"Updated the eligibility matrix for {len(diff['added']) + len(diff['changed'])} studies.")
+    else:
+        matrix = eligibility_matrix.EligibilityMatrix.from_table(table_path('eligibility'))
+        print(f"Built the eligibility matrix for {len(matrix)} studies.")
+    matrix.save(ELIGIBILITY_MATRIX_PATH)
+
+
+def save_version_data(version_data):
+    """Saves and uploads the version info if it differs from the latest copy."""
+    latest_version_path = os.path.join(DATA_PATH, 'latest_version_data.csv')
+    version_row = {field: str(version_data.get(field, '')) for field in VERSION_FIELDNAMES}
+
+    existing_version_data = get_existing_data(latest_version_path)
+
+    # Check if the fetched data is different from existing data
+    if existing_version_data != [version_row]:
+        save_data([version_row], latest_version_path, VERSION_FIELDNAMES)
+
+        upload_data(latest_version_path, TARGET_URL)
+    else:
+        print("No updates in version data.")
+
+
+def process_data(mode=SYNC_MODE, upload_mode=UPLOAD_MODE):
+    """Main function to process data from both endpoints.
+
+    The cheap /version endpoint is checked first and the run is skipped when its
+    dataTimestamp matches the last successful sync. In 'incremental' mode only
+    studies posted since that sync are fetched; the first run is always full. In
+    'delta' upload mode only the rows of changed studies are uploaded, with a
+    manifest naming the snapshot they apply to; upload_snapshot() sends everything.
+
+    Every run writes a report of its stage timings, rows, bytes and retries; see
+    metrics.py. Returns how the run ended (see sync_and_publish()).
+    """
+    metrics.start_run(mode)
+    outcome = 'failed'
+    try:
+        outcome = sync_and_publish(mode, upload_mode)
+    finally:
+        metrics.finish_run(outcome)
+    return outcome
+
+
+def sync_and_publish(mode, upload_mode):
+    """Runs one sync for process_data() and returns how it ended: 'skipped',
+    'incomplete' or 'synced'."""
+    state = load_sync_state()
+    pending_uploads = state.get('pending_uploads', [])
+    if pending_uploads:
+        # Uploads that failed last time go first, in order
+        print(f"Retrying {len(pending_uploads)} pending upload batch(es).")
+        with metrics.stage('upload'):
+            state['pending_uploads'] = pending_uploads = upload_batches(pending_uploads, TARGET_URL)
+        save_sync_state(state)
+
+    version_data = fetch_version(VERSION_URL)
+    data_timestamp = version_data.get('dataTimestamp') if version_data else None
+
+    if data_timestamp and data_timestamp == state.get('dataTimestamp'):
+        print(f"No new data published since {data_timestamp}. Skipping run.")
+        return 'skipped'
+
+    # Tables written under an older schema are rebuilt by a full sync, and without a
+    # previous snapshot there is nothing for a delta to apply on top of
+    has_base = bool(state.get('dataTimestamp')) and tables_match_schema()
+    delta_path = None
+    if upload_mode == 'delta' and has_base and data_timestamp:
+        delta_path = delta_export.delta_dir(data_timestamp)
+
+    # The SQLite target is loaded in step with the latest tables, in one
+    # transaction committed once they are
+    target = None
+    if SQLITE_TARGET_PATH:
+        target = sqlite_target.SqliteLoader(SQLITE_TARGET_PATH, TABLES, DIMENSION_TABLES, COLUMN_TYPES,
+                                            state.get('dataTimestamp') if has_base else None)
+    try:
+        if mode == 'incremental' and has_base:
+            # dataTimestamp is when the last synced snapshot was published, so anything
+            # posted on or after that day may be missing from our tables
+            result = sync_incremental(state['dataTimestamp'][:10], delta_path, target)
         else:
-            print("No updates in version data.")
+            result = sync_full(delta_path, data_timestamp, target)
+        if result is not None and target:
+            with metrics.stage('load'):
+                target.commit(data_timestamp)
+    finally:
+        if target:
+            target.close()
+
+    if result is None:
+        # Leave the sync state alone so the next run fetches the same range again
+        print("Studies fetch did not complete; not recording this sync.")
+        return 'incomplete'
 
+    diff = result['diff']
+    metrics.annotate(studies={'added': len(diff['added']), 'changed': len(diff['changed']),
+                              'removed': len(diff['removed']), 'unchanged': diff['unchanged']},
+                     changed_tables=result['tables'])
+    with metrics.stage('index'):
+        update_eligibility_matrix(result)
+    with metrics.stage('write'):
+        batch = publish_changes(result, upload_mode, delta_path, data_timestamp, state.get('dataTimestamp'))
+    if batch:
+        with metrics.stage('upload'):
+            pending_uploads = upload_batches(pending_uploads + [batch], TARGET_URL)
+
+    if version_data:
+        with metrics.stage('upload'):
+            save_version_data(version_data)
+    if data_timestamp:
+        state = {
+            'dataTimestamp': data_timestamp,
+            'mode': mode,
+            'synced_at': datetime.now().isoformat(timespec='seconds'),
+        }
+    state['pending_uploads'] = pending_uploads
+    save_sync_state(state)
+    return 'synced'
 
-def run_scheduled_job():
-    """Runs the scheduled job."""
-    print("Running scheduled job...")
-    process_data()
 
 def main():
-    # Run the job immediately
-    run_scheduled_job()
-    
-    # Schedule the job to run every 1 hour
-    schedule.every(1).hours.do(run_scheduled_job)
-    
-    # Run the scheduled jobs
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    if METRICS_PORT:
+        metrics.serve()
+    # The scheduler drives process_data(), so it is imported only when run as a service
+    import scheduler
+    scheduler.run()
+
 
 if __name__ == "__main__":
-    
-    
-    main()
\ No newline at end of file
+    main()
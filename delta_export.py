@@ -0,0 +1,91 @@
+import os
+import csv
+import json
+from datetime import datetime
+import table_writers
+from config import DELTA_PATH
+
+DELTA_STUDIES_FIELDNAMES = ['study_id', 'action']
+MANIFEST_NAME = 'manifest.json'
+
+
+def delta_dir(snapshot):
+    """Returns the directory holding the delta (or snapshot manifest) for a dataTimestamp."""
+    return os.path.join(DELTA_PATH, snapshot.replace('-', '').replace(':', ''))
+
+
+def delta_table_path(directory, table, fmt):
+    """Returns the path of a table's delta file inside a delta directory."""
+    return os.path.join(directory, f'delta_{table}_data.{table_writers.file_extension(fmt)}')
+
+
+def open_delta_writers(stack, directory, tables, fmt, column_types):
+    """Opens a writer for each table's delta file on an ExitStack."""
+    os.makedirs(directory, exist_ok=True)
+    writers = {}
+    for table, fieldnames in tables.items():
+        writers[table] = stack.enter_context(
+            table_writers.open_table_writer(delta_table_path(directory, table, fmt), fieldnames, fmt, column_types))
+    return writers
+
+
+def write_delta_studies(directory, upserted, deleted):
+    """Writes the list of studies the delta replaces ('upsert') or removes ('delete')."""
+    path = os.path.join(directory, 'delta_studies.csv')
+    with open(path, mode='w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(DELTA_STUDIES_FIELDNAMES)
+        writer.writerows((study_id, 'upsert') for study_id in upserted)
+        writer.writerows((study_id, 'delete') for study_id in deleted)
+    return path
+
+
+def write_manifest(directory, manifest):
+    """Writes manifest.json into a delta directory and returns its path."""
+    manifest = dict(manifest, created_at=datetime.now().isoformat(timespec='seconds'))
+    path = os.path.join(directory, MANIFEST_NAME)
+    with open(path, mode='w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2)
+    return path
+
+
+def finish_delta(directory, tables, fmt, table_rows, upserted, deleted, snapshot, base_snapshot):
+    """Completes a delta directory and returns the files to upload, manifest last.
+
+    Delta files for tables without rows are dropped. Consumers apply a delta on top
+    of base_snapshot by deleting every row of each listed study from all tables and
+    then inserting the delta rows. Dimension tables have no study rows; their delta
+    rows are new keys, to be inserted first.
+    """
+    files = []
+    for table in tables:
+        path = delta_table_path(directory, table, fmt)
+        if table_rows.get(table):
+            files.append(path)
+        elif os.path.exists(path):
+            os.remove(path)
+    files.append(write_delta_studies(directory, upserted, deleted))
+    files.append(write_manifest(directory, {
+        'type': 'delta',
+        'snapshot': snapshot,
+        'base_snapshot': base_snapshot,
+        'format': fmt,
+        'tables': {table: {'file': os.path.basename(delta_table_path(directory, table, fmt)), 'rows': table_rows[table]}
+                   for table in tables if table_rows.get(table)},
+        'studies_file': 'delta_studies.csv',
+        'upserted_studies': len(upserted),
+        'deleted_studies': len(deleted),
+    }))
+    return files
+
+
+def snapshot_manifest(directory, table_files, fmt, snapshot):
+    """Writes the manifest for a full snapshot upload of the given table files."""
+    os.makedirs(directory, exist_ok=True)
+    return write_manifest(directory, {
+        'type': 'snapshot',
+        'snapshot': snapshot,
+        'format': fmt,
+        'tables': {table: {'file': os.path.basename(path), 'bytes': os.path.getsize(path)}
+                   for table, path in table_files.items()},
+    })
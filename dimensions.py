@@ -0,0 +1,59 @@
+import sqlite3
+from config import DIMENSIONS_PATH
+
+
+class DimensionKeys(dict):
+    """Maps the names of one dimension to their keys, handing out the next unused
+    key to new names. Names given keys since loading are kept in added."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.next_key = max(self.values(), default=0) + 1
+        self.added = {}
+
+    def __missing__(self, name):
+        self[name] = self.added[name] = self.next_key
+        self.next_key += 1
+        return self[name]
+
+
+def open_store(path=DIMENSIONS_PATH):
+    """Opens the dimension key store, creating it if needed.
+
+    The store holds every name each dimension has ever given a key to, so keys
+    stay the same across runs and snapshots; names are never removed or renumbered.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE IF NOT EXISTS dimension_keys (dimension TEXT NOT NULL, name TEXT, '
+                 'key INTEGER NOT NULL, PRIMARY KEY (dimension, name))')
+    return conn
+
+
+def load_keys(conn, dimensions):
+    """Returns {dimension: DimensionKeys} for the given dimension names."""
+    keys = {dimension: {} for dimension in dimensions}
+    for dimension, name, key in conn.execute('SELECT dimension, name, key FROM dimension_keys'):
+        if dimension in keys:
+            keys[dimension][name] = key
+    return {dimension: DimensionKeys(names) for dimension, names in keys.items()}
+
+
+def commit_keys(conn, keys):
+    """Stores the keys given out since loading, in one transaction.
+
+    Returns {dimension: [(key, name), ...]} for the dimensions that gained any.
+    """
+    added = {dimension: sorted((key, name) for name, key in dimension_keys.added.items())
+             for dimension, dimension_keys in keys.items() if dimension_keys.added}
+    with conn:
+        for dimension, rows in added.items():
+            conn.executemany('INSERT INTO dimension_keys (dimension, name, key) VALUES (?, ?, ?)',
+                             ((dimension, name, key) for key, name in rows))
+    for dimension_keys in keys.values():
+        dimension_keys.added.clear()
+    return added
+
+
+def rows(conn, dimension):
+    """Yields (key, name) for every name of a dimension, in key order."""
+    yield from conn.execute('SELECT key, name FROM dimension_keys WHERE dimension = ? ORDER BY key', (dimension,))
@@ -0,0 +1,214 @@
+import os
+import re
+import csv
+import numpy_support
+from config import ELIGIBILITY_MATCH_BLOCK_CELLS
+
+# Days per unit of a registry age such as "18 Years"
+AGE_UNIT_DAYS = {
+    'year': 365.25, 'month': 365.25 / 12, 'week': 7, 'day': 1, 'hour': 1 / 24, 'minute': 1 / 1440,
+}
+
+# Bounds used when a study sets no minimum or maximum age
+NO_MINIMUM_AGE = 0
+NO_MAXIMUM_AGE = 2 ** 31 - 1
+
+# Enum codes stored in the matrix
+SEX_CODES = {'ALL': 0, 'FEMALE': 1, 'MALE': 2}
+HEALTHY_VOLUNTEERS_CODES = {'': -1, 'False': 0, 'True': 1}
+
+CRITERIA_HEADING = re.compile(r'^[\W_]*(?:key\s+|main\s+)?(inclusion|exclusion)\s+criteria\b.*$',
+                              re.IGNORECASE | re.MULTILINE)
+
+
+def age_in_days(age, upper=False):
+    """Converts a registry age ("18 Years", "6 Months") to days, or None if it is unset.
+
+    An upper bound covers the whole last unit, so a maximum of "65 Years" admits
+    someone aged 65 years and 11 months.
+    """
+    match = re.match(r'\s*(\d+(?:\.\d+)?)\s*([a-z]+?)s?\s*$', age or '', re.IGNORECASE)
+    if not match or match.group(2).lower() not in AGE_UNIT_DAYS:
+        return None
+    value, unit_days = float(match.group(1)), AGE_UNIT_DAYS[match.group(2).lower()]
+    if upper:
+        return int((value + 1) * unit_days) - 1 if unit_days >= 1 else int(value * unit_days)
+    return int(value * unit_days)
+
+
+def split_criteria(criteria):
+    """Splits eligibility criteria text into (inclusion, exclusion) at their headings.
+
+    Text before the first heading counts as inclusion criteria, as does the whole
+    text when it has no headings; repeated sections (e.g. per cohort) are joined.
+    """
+    if not criteria:
+        return None, None
+    headings = list(CRITERIA_HEADING.finditer(criteria))
+    if not headings:
+        return criteria.strip(), None
+    sections = {'inclusion': [criteria[:headings[0].start()].strip()], 'exclusion': []}
+    for heading, following in zip(headings, headings[1:] + [None]):
+        end = following.start() if following else len(criteria)
+        sections[heading.group(1).lower()].append(criteria[heading.end():end].strip())
+    inclusion, exclusion = ('\n\n'.join(part for part in sections[kind] if part) or None
+                            for kind in ('inclusion', 'exclusion'))
+    return inclusion, exclusion
+
+
+def age_bound(value, default):
+    """Returns an age bound in days from a row (an int, or a string read from CSV)."""
+    return default if value in (None, '') else int(value)
+
+
+def pack_texts(np, texts):
+    """Packs strings into one array of UTF-8 bytes and the offsets of each, text i
+    spanning offsets[i]:offsets[i + 1]; None packs as an empty string."""
+    encoded = [(text or '').encode('utf-8') for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(text) for text in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def take_texts(np, data, offsets, positions):
+    """Repacks the packed texts at positions."""
+    starts, ends = offsets[:-1][positions].tolist(), offsets[1:][positions].tolist()
+    view = memoryview(data)
+    new_offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+    new_offsets[1:] = np.cumsum(np.subtract(ends, starts, dtype=np.int64))
+    return np.frombuffer(b''.join(view[start:end] for start, end in zip(starts, ends)), dtype=np.uint8), new_offsets
+
+
+class EligibilityMatrix:
+    """Per-study eligibility as parallel NumPy arrays, one entry per study.
+
+    Ages are bounds in days (inclusive), sex is a SEX_CODES code and
+    healthy_volunteers a HEALTHY_VOLUNTEERS_CODES code. The inclusion and exclusion
+    criteria split from each study's criteria text are packed by pack_texts(); see
+    criteria(). They are kept here rather than in the eligibility table, which
+    already holds the whole text.
+    """
+
+    ARRAYS = ['study_ids', 'min_age_days', 'max_age_days', 'sex', 'healthy_volunteers',
+              'inclusion_text', 'inclusion_offsets', 'exclusion_text', 'exclusion_offsets']
+
+    # Arrays with one entry per study, as opposed to packed text
+    ENTRY_ARRAYS = ARRAYS[:5]
+
+    def __init__(self, study_ids, min_age_days, max_age_days, sex, healthy_volunteers,
+                 inclusion_text, inclusion_offsets, exclusion_text, exclusion_offsets):
+        self.np = numpy_support.import_numpy('The eligibility matrix')
+        self.study_ids = study_ids
+        self.min_age_days = min_age_days
+        self.max_age_days = max_age_days
+        self.sex = sex
+        self.healthy_volunteers = healthy_volunteers
+        self.inclusion_text = inclusion_text
+        self.inclusion_offsets = inclusion_offsets
+        self.exclusion_text = exclusion_text
+        self.exclusion_offsets = exclusion_offsets
+
+    def __len__(self):
+        return len(self.study_ids)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Builds the matrix from eligibility rows, as flattened or read from the CSV."""
+        np = numpy_support.import_numpy('The eligibility matrix')
+        columns = {name: [] for name in cls.ENTRY_ARRAYS}
+        criteria = []
+        for row in rows:
+            columns['study_ids'].append(row['study_id'])
+            columns['min_age_days'].append(age_bound(row['minimum_age_days'], NO_MINIMUM_AGE))
+            columns['max_age_days'].append(age_bound(row['maximum_age_days'], NO_MAXIMUM_AGE))
+            columns['sex'].append(SEX_CODES.get(row['sex'], SEX_CODES['ALL']))
+            healthy_volunteers = row['healthy_volunteers']
+            columns['healthy_volunteers'].append(
+                HEALTHY_VOLUNTEERS_CODES.get('' if healthy_volunteers is None else str(healthy_volunteers), -1))
+            criteria.append(split_criteria(row['description']))
+        inclusion_text, inclusion_offsets = pack_texts(np, [inclusion for inclusion, _ in criteria])
+        exclusion_text, exclusion_offsets = pack_texts(np, [exclusion for _, exclusion in criteria])
+        return cls(np.array(columns['study_ids'], dtype=str),
+                   np.array(columns['min_age_days'], dtype=np.int32),
+                   np.array(columns['max_age_days'], dtype=np.int32),
+                   np.array(columns['sex'], dtype=np.int8),
+                   np.array(columns['healthy_volunteers'], dtype=np.int8),
+                   inclusion_text, inclusion_offsets, exclusion_text, exclusion_offsets)
+
+    @classmethod
+    def from_table(cls, path):
+        """Builds the matrix from an eligibility CSV."""
+        with open(path, mode='r', encoding='utf-8') as file:
+            return cls.from_rows(csv.DictReader(file))
+
+    def updated(self, study_ids, rows):
+        """Returns a copy with the entries of study_ids replaced by those built from
+        rows, the studies' current eligibility rows (none for removed studies)."""
+        np = self.np
+        keep = np.flatnonzero(~np.isin(self.study_ids, list(study_ids)))
+        new = self.from_rows(rows)
+        arrays = {name: np.concatenate([getattr(self, name)[keep], getattr(new, name)])
+                  for name in self.ENTRY_ARRAYS}
+        for kind in ('inclusion', 'exclusion'):
+            text, offsets = take_texts(np, getattr(self, f'{kind}_text'), getattr(self, f'{kind}_offsets'), keep)
+            new_text, new_offsets = getattr(new, f'{kind}_text'), getattr(new, f'{kind}_offsets')
+            arrays[f'{kind}_text'] = np.concatenate([text, new_text])
+            arrays[f'{kind}_offsets'] = np.concatenate([offsets, new_offsets[1:] + offsets[-1]])
+        return EligibilityMatrix(**arrays)
+
+    def save(self, path):
+        """Writes the matrix to an .npz file, replacing it atomically."""
+        with open(f"{path}.tmp", 'wb') as file:
+            self.np.savez(file, **{name: getattr(self, name) for name in self.ARRAYS})
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a matrix written by save(). Raises KeyError for a file written before
+        the matrix held the criteria."""
+        np = numpy_support.import_numpy('The eligibility matrix')
+        with np.load(path) as arrays:
+            return cls(*(arrays[name] for name in cls.ARRAYS))
+
+    def criteria(self, position):
+        """Returns the (inclusion, exclusion) criteria of the study at position, each
+        None if the study has none."""
+        texts = []
+        for kind in ('inclusion', 'exclusion'):
+            data, offsets = getattr(self, f'{kind}_text'), getattr(self, f'{kind}_offsets')
+            texts.append(data[offsets[position]:offsets[position + 1]].tobytes().decode('utf-8') or None)
+        return tuple(texts)
+
+    def match(self, age_days, sex, healthy, trial_mask=None):
+        """Screens a batch of patients against every study at once.
+
+        age_days, sex (SEX_CODES 'FEMALE' or 'MALE' codes) and healthy (whether the
+        patient would join as a healthy volunteer) are arrays with one entry per
+        patient. trial_mask optionally restricts the studies considered. Returns one
+        array of eligible study positions per patient; index study_ids with it to get
+        the IDs. Patients are processed in blocks so that no intermediate array
+        exceeds ELIGIBILITY_MATCH_BLOCK_CELLS entries.
+        """
+        np = self.np
+        age_days = np.asarray(age_days, dtype=np.int32)[:, None]
+        sex = np.asarray(sex, dtype=np.int8)[:, None]
+        healthy = np.asarray(healthy, dtype=bool)[:, None]
+        trials = np.arange(len(self), dtype=np.int32)
+        if trial_mask is not None:
+            trials = trials[np.asarray(trial_mask, dtype=bool)]
+        min_age, max_age = self.min_age_days[trials], self.max_age_days[trials]
+        trial_sex = self.sex[trials]
+        refuses_healthy = self.healthy_volunteers[trials] == HEALTHY_VOLUNTEERS_CODES['False']
+
+        matches = []
+        block = max(1, ELIGIBILITY_MATCH_BLOCK_CELLS // max(len(trials), 1))
+        for start in range(0, len(age_days), block):
+            ages = age_days[start:start + block]
+            eligible = (min_age <= ages) & (ages <= max_age)
+            eligible &= (trial_sex == SEX_CODES['ALL']) | (trial_sex == sex[start:start + block])
+            eligible &= ~(healthy[start:start + block] & refuses_healthy)
+            # Eligible pairs come out grouped by patient, so split them per patient
+            patients, positions = np.nonzero(eligible)
+            bounds = np.searchsorted(patients, np.arange(1, len(ages)))
+            matches.extend(np.split(trials[positions], bounds))
+        return matches
@@ -0,0 +1,136 @@
+import math
+from array import array
+import numpy_support
+from config import GEO_CELL_DEGREES
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(np, lat, lon, lats, lons):
+    """Returns the great-circle distances in km from (lat, lon) to arrays of points."""
+    lat, lon, lats, lons = math.radians(lat), math.radians(lon), np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + math.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def split_lon_range(min_lon, max_lon):
+    """Splits a longitude range that crosses the antimeridian into ranges within [-180, 180]."""
+    if max_lon - min_lon >= 360:
+        return [(-180.0, 180.0)]
+    min_lon = (min_lon + 180) % 360 - 180
+    max_lon = (max_lon + 180) % 360 - 180
+    if min_lon <= max_lon:
+        return [(min_lon, max_lon)]
+    return [(min_lon, 180.0), (-180.0, max_lon)]
+
+
+class SiteIndexBuilder:
+    """Collects trial sites into compact arrays while the locations table is scanned."""
+
+    def __init__(self):
+        self.lats = array('d')
+        self.lons = array('d')
+        self.study_codes = array('i')
+        self.status_codes = array('b')
+        self.spans = array('q')
+        self.studies = {}
+        self.statuses = {}
+
+    def add(self, lat, lon, study_id, status, span):
+        """Adds a site; span is the (start, end) of its row in the locations table."""
+        self.lats.append(lat)
+        self.lons.append(lon)
+        self.study_codes.append(self.studies.setdefault(study_id, len(self.studies)))
+        self.status_codes.append(self.statuses.setdefault(status, len(self.statuses)))
+        self.spans.extend(span)
+
+    def build(self, cell_degrees=GEO_CELL_DEGREES):
+        return SiteIndex(self, cell_degrees)
+
+
+class SiteIndex:
+    """A uniform lat/lon grid over trial sites, stored as NumPy arrays sorted by cell.
+
+    Sites of one grid row are contiguous, so a query selects candidates with one
+    binary search per grid row it covers and then filters them exactly.
+    """
+
+    def __init__(self, builder, cell_degrees=GEO_CELL_DEGREES):
+        np = self.np = numpy_support.import_numpy('Site search')
+        self.cell_degrees = cell_degrees
+        self.columns = math.ceil(360 / cell_degrees) + 1
+        self.study_ids = list(builder.studies)
+        self.codes_by_study = builder.studies
+        self.statuses = builder.statuses
+
+        lats = np.frombuffer(builder.lats, dtype=np.float64)
+        lons = np.frombuffer(builder.lons, dtype=np.float64)
+        keys = self.cell_rows(lats) * self.columns + self.cell_columns(lons)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.lats = lats[order]
+        self.lons = lons[order]
+        self.study_codes = np.frombuffer(builder.study_codes, dtype=np.int32)[order]
+        self.status_codes = np.frombuffer(builder.status_codes, dtype=np.int8)[order]
+        self.spans = np.frombuffer(builder.spans, dtype=np.int64).reshape(-1, 2)[order]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def cell_rows(self, lats):
+        return self.np.floor((self.np.clip(lats, -90, 90) + 90) / self.cell_degrees).astype(self.np.int64)
+
+    def cell_columns(self, lons):
+        return self.np.floor((self.np.clip(lons, -180, 180) + 180) / self.cell_degrees).astype(self.np.int64)
+
+    def candidates(self, min_lat, max_lat, lon_ranges):
+        """Returns the indexes of sites in grid cells overlapping the given box."""
+        np = self.np
+        rows = np.arange(self.cell_rows(min_lat), self.cell_rows(max_lat) + 1)
+        starts, ends = [], []
+        for min_lon, max_lon in lon_ranges:
+            starts.append(np.searchsorted(self.keys, rows * self.columns + self.cell_columns(min_lon), 'left'))
+            ends.append(np.searchsorted(self.keys, rows * self.columns + self.cell_columns(max_lon), 'right'))
+        starts, ends = np.concatenate(starts), np.concatenate(ends)
+        return np.concatenate([np.arange(start, end) for start, end in zip(starts, ends) if end > start] or
+                              [np.empty(0, dtype=np.int64)])
+
+    def select(self, indexes, study_codes=None, status=None):
+        """Keeps the sites of the given studies (codes) and with the given site status."""
+        np = self.np
+        if study_codes is not None:
+            indexes = indexes[np.isin(self.study_codes[indexes], study_codes)]
+        if status is not None:
+            indexes = indexes[self.status_codes[indexes] == self.statuses.get(status, -1)]
+        return indexes
+
+    def study_codes_for(self, study_ids):
+        """Returns the codes of those study_ids that have sites."""
+        codes = self.codes_by_study
+        return self.np.array([codes[study_id] for study_id in study_ids if study_id in codes], dtype=self.np.int32)
+
+    def within_radius(self, lat, lon, radius_km, study_codes=None, status=None):
+        """Returns (indexes, distances_km) of sites within radius_km of a point, nearest first."""
+        np = self.np
+        angle = radius_km / EARTH_RADIUS_KM
+        min_lat, max_lat = lat - math.degrees(angle), lat + math.degrees(angle)
+        if min_lat <= -90 or max_lat >= 90 or math.sin(angle) >= math.cos(math.radians(lat)):
+            lon_ranges = [(-180.0, 180.0)]
+        else:
+            spread = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(lat))))
+            lon_ranges = split_lon_range(lon - spread, lon + spread)
+        indexes = self.select(self.candidates(max(min_lat, -90), min(max_lat, 90), lon_ranges), study_codes, status)
+        distances = haversine_km(np, lat, lon, self.lats[indexes], self.lons[indexes])
+        inside = distances <= radius_km
+        indexes, distances = indexes[inside], distances[inside]
+        order = np.argsort(distances, kind='stable')
+        return indexes[order], distances[order]
+
+    def within_bbox(self, min_lat, min_lon, max_lat, max_lon, study_codes=None, status=None):
+        """Returns the indexes of sites inside a box; min_lon > max_lon crosses the antimeridian."""
+        lon_ranges = split_lon_range(min_lon, max_lon if max_lon >= min_lon else max_lon + 360)
+        indexes = self.select(self.candidates(min_lat, max_lat, lon_ranges), study_codes, status)
+        lats, lons = self.lats[indexes], self.lons[indexes]
+        inside = (lats >= min_lat) & (lats <= max_lat)
+        inside &= self.np.logical_or.reduce([(lons >= low) & (lons <= high) for low, high in lon_ranges])
+        return indexes[inside]
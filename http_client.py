@@ -0,0 +1,193 @@
+import time
+import random
+import threading
+from collections import Counter, deque
+from email.utils import parsedate_to_datetime
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+from config import FETCH_CONCURRENCY_START, FETCH_LATENCY_TOLERANCE, FETCH_RETRIES, FETCH_BACKOFF
+
+# Responses worth retrying: throttling and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Seconds of completed requests the reported throughput is averaged over
+THROUGHPUT_WINDOW = 30
+
+
+def retry_after_seconds(response):
+    """Returns the wait a Retry-After header asks for (seconds or an HTTP date), or None."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter:
+    """Caps concurrent requests with additive-increase/multiplicative-decrease (AIMD).
+
+    Every successful request raises the limit by 1/limit, so it grows by one per
+    round of requests, up to max_limit. A 429 or a smoothed latency above tolerance
+    times the fastest seen halves it, at most once per round trip, and a Retry-After
+    pauses every request until it has passed.
+    """
+
+    def __init__(self, max_limit, start=FETCH_CONCURRENCY_START, tolerance=FETCH_LATENCY_TOLERANCE):
+        self.max_limit = max(1, max_limit)
+        self.limit = float(max(1, min(start, self.max_limit)))
+        self.tolerance = tolerance
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.min_latency = None
+        self.latency = None
+        self.completed = deque()
+        self.counts = Counter()
+
+    def acquire(self):
+        """Waits for a free request slot (and for any Retry-After pause to end)."""
+        with self.condition:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    self.condition.wait(pause)
+                elif self.in_flight < int(self.limit):
+                    break
+                else:
+                    self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def decrease(self, now):
+        # Responses already in flight reflect the old limit; cut once per round trip
+        if now - self.last_decrease >= (self.latency or 0.0):
+            self.limit = max(1.0, self.limit / 2)
+            self.last_decrease = now
+            self.counts['decreases'] += 1
+
+    def on_success(self, latency, size):
+        with self.condition:
+            now = time.monotonic()
+            self.counts['requests'] += 1
+            self.completed.append((now, size))
+            self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            if self.latency > self.min_latency * self.tolerance:
+                self.decrease(now)
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def on_throttle(self, delay):
+        with self.condition:
+            now = time.monotonic()
+            self.counts['throttled'] += 1
+            self.decrease(now)
+            self.paused_until = max(self.paused_until, now + delay)
+            self.condition.notify_all()
+
+    def on_error(self):
+        with self.condition:
+            self.counts['errors'] += 1
+            self.decrease(time.monotonic())
+
+    def stats(self):
+        """Returns the current limit, requests in flight, any pause, latency and the
+        throughput of the last THROUGHPUT_WINDOW seconds."""
+        with self.condition:
+            now = time.monotonic()
+            while self.completed and self.completed[0][0] < now - THROUGHPUT_WINDOW:
+                self.completed.popleft()
+            window = min(THROUGHPUT_WINDOW, now - self.completed[0][0]) if self.completed else 0
+            return {
+                'limit': int(self.limit),
+                'max_limit': self.max_limit,
+                'in_flight': self.in_flight,
+                'paused_seconds': round(max(self.paused_until - now, 0.0), 3),
+                'latency_seconds': round(self.latency, 4) if self.latency is not None else None,
+                'min_latency_seconds': round(self.min_latency, 4) if self.min_latency is not None else None,
+                'requests_per_second': round(len(self.completed) / window, 2) if window else None,
+                'bytes_per_second': round(sum(size for _, size in self.completed) / window) if window else None,
+                **self.counts,
+            }
+
+
+class AdaptiveSession(requests.Session):
+    """A session whose requests go through an AdaptiveLimiter and are retried when
+    throttled or transiently failing.
+
+    A 429 or 5xx response (or a connection error) is retried up to `retries` times,
+    after its Retry-After or else a jittered exponential backoff from `backoff`
+    seconds. The last response is returned (or the error raised) once retries run
+    out, so callers still see the failure and never mistake it for a last page.
+    """
+
+    def __init__(self, limiter, retries=FETCH_RETRIES, backoff=FETCH_BACKOFF):
+        super().__init__()
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+
+    def request(self, method, url, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            start = time.monotonic()
+            response, error = None, None
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except requests.exceptions.RequestException as e:
+                error = e
+            finally:
+                self.limiter.release()
+
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                self.limiter.on_success(time.monotonic() - start, len(response.content))
+                return response
+            if attempt == self.retries:
+                if error:
+                    raise error
+                return response
+
+            delay = retry_after_seconds(response) if response is not None else None
+            if response is not None:
+                # Read the (short) error body so the connection goes back to the pool
+                # for the retry to reuse, rather than being held while we wait
+                try:
+                    response.content
+                except requests.exceptions.RequestException:
+                    pass
+                response.close()
+            if response is not None and (response.status_code == 429 or delay is not None):
+                # The limiter holds every request back until Retry-After has passed
+                self.limiter.on_throttle(delay if delay is not None else self.backoff * 2 ** attempt)
+            else:
+                self.limiter.on_error()
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+            metrics.count('fetch_retries')
+            print(f"Retrying request ({error or f'status code {response.status_code}'}); "
+                  f"concurrency limit now {int(self.limiter.limit)}.")
+
+
+def create_session(pool_size, limiter=None):
+    """Creates a keep-alive HTTP session with a connection pool for pool_size threads.
+
+    With a limiter, it is an AdaptiveSession whose requests share that limiter and
+    are retried when throttled.
+    """
+    session = AdaptiveSession(limiter) if limiter else requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -0,0 +1,380 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import METRICS_REPORT_PATH, METRICS_HISTORY_PATH, METRICS_HOST, METRICS_PORT
+
+# Upper bounds (seconds) of the HTTP request latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Writing 5 here clears this process's memory high-water mark (Linux only)
+CLEAR_REFS_PATH = '/proc/self/clear_refs'
+# Whether reset_peak_rss() may try it; cleared after the first failure
+can_reset_peak = sys.platform.startswith('linux')
+
+
+def process_status_bytes(field):
+    """Returns a memory field of /proc/self/status ('VmRSS', 'VmHWM') in bytes, or
+    None where there is no /proc."""
+    try:
+        with open('/proc/self/status', mode='r', encoding='ascii') as file:
+            for line in file:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def max_rss_bytes():
+    """Returns the peak resident set size of this process over its whole life."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def rss_bytes():
+    """Returns the current resident set size of this process (or, without /proc, its
+    lifetime peak)."""
+    return process_status_bytes('VmRSS') or max_rss_bytes()
+
+
+def peak_rss_bytes():
+    """Returns the peak resident set size of this process since reset_peak_rss() last
+    succeeded, or over its whole life."""
+    return process_status_bytes('VmHWM') or max_rss_bytes()
+
+
+def reset_peak_rss():
+    """Restarts peak_rss_bytes() from the current size, where the OS allows it (Linux
+    clears the high-water mark on writing 5 to clear_refs). Returns whether it did.
+
+    Elsewhere, or where /proc is missing or read-only, it fails once and is not tried
+    again: stages then report the process's lifetime peak.
+    """
+    global can_reset_peak
+    if not can_reset_peak:
+        return False
+    try:
+        with open(CLEAR_REFS_PATH, mode='w', encoding='ascii') as file:
+            file.write('5')
+        return True
+    except OSError:
+        can_reset_peak = False
+        return False
+
+
+def percentile(values, fraction):
+    """Returns the value below which `fraction` of the sorted values fall."""
+    if not values:
+        return None
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class RunMetrics:
+    """Measurements of one sync run; fetch and upload threads may update them concurrently.
+
+    Stage times are exclusive: time spent in a stage nested inside another (such as
+    waiting for a fetched page while transforming) is only counted for the inner one.
+    Peak memory is this process's own for the run and for each stage, including the
+    stages nested inside it, where the OS lets the high-water mark be reset (see
+    reset_peak_rss()); elsewhere it is the process's lifetime peak. Transform workers
+    report their own peak through record_worker_rss().
+    """
+
+    def __init__(self, mode=None):
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stages = {}
+        self.requests = {}
+        self.rows = Counter()
+        self.counts = Counter()
+        self.info = {}
+        reset_peak_rss()
+        self.peak_rss = peak_rss_bytes()
+        self.worker_peak_rss = None
+
+    def sample_peak(self, stack):
+        """Folds the high-water mark since the last reset into the run's peak and the
+        peaks of the stages in progress."""
+        peak = peak_rss_bytes()
+        with self.lock:
+            self.peak_rss = max(self.peak_rss, peak)
+        for frame in stack:
+            frame[1] = max(frame[1], peak)
+
+    @contextmanager
+    def stage(self, name):
+        stack = self.local.__dict__.setdefault('stack', [])
+        # The enclosing stages keep the peak so far; this one starts from here
+        self.sample_peak(stack)
+        reset_peak_rss()
+        nested = [0.0, 0]
+        stack.append(nested)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.sample_peak(stack)
+            stack.pop()
+            if stack:
+                stack[-1][0] += elapsed
+            with self.lock:
+                stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'peak_rss_bytes': 0})
+                stage['seconds'] += elapsed - nested[0]
+                stage['calls'] += 1
+                stage['peak_rss_bytes'] = max(stage['peak_rss_bytes'], nested[1])
+
+    def iterate(self, name, iterable):
+        """Yields the items of iterable, counting the time spent producing them as a stage."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def record_request(self, endpoint, seconds, size=0, error=False):
+        with self.lock:
+            requests = self.requests.setdefault(endpoint, {'requests': 0, 'errors': 0, 'bytes': 0, 'latencies': []})
+            requests['requests'] += 1
+            requests['errors'] += bool(error)
+            requests['bytes'] += size
+            requests['latencies'].append(seconds)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] += value
+
+    def record_worker_rss(self, peak):
+        with self.lock:
+            self.worker_peak_rss = max(self.worker_peak_rss or 0, peak)
+
+    def count_rows(self, table, rows):
+        with self.lock:
+            self.rows[table] += rows
+
+    def report(self, outcome):
+        """Returns the run's measurements as a JSON-serializable dict."""
+        self.sample_peak(self.local.__dict__.get('stack', []))
+        with self.lock:
+            requests = {}
+            for endpoint, stats in self.requests.items():
+                latencies = sorted(stats['latencies'])
+                requests[endpoint] = {
+                    'requests': stats['requests'], 'errors': stats['errors'], 'bytes': stats['bytes'],
+                    'seconds': round(sum(latencies), 4), 'p50_seconds': round(percentile(latencies, 0.5) or 0, 4),
+                    'p95_seconds': round(percentile(latencies, 0.95) or 0, 4),
+                    'max_seconds': round(latencies[-1] if latencies else 0, 4),
+                    'buckets': [sum(latency <= bound for latency in latencies) for bound in LATENCY_BUCKETS],
+                }
+            return {
+                'started_at': self.started_at.isoformat(timespec='seconds'),
+                'finished_at': datetime.now().isoformat(timespec='seconds'),
+                'mode': self.mode,
+                'outcome': outcome,
+                'seconds': round(time.perf_counter() - self.start, 4),
+                'rss_bytes': rss_bytes(),
+                'peak_rss_bytes': self.peak_rss,
+                'workers_peak_rss_bytes': self.worker_peak_rss,
+                'stages': {name: dict(stage, seconds=round(stage['seconds'], 4))
+                           for name, stage in self.stages.items()},
+                'http': requests,
+                'rows': dict(self.rows),
+                'counts': dict(self.counts),
+                **self.info,
+            }
+
+
+# The run being measured; calls made outside process_data() land in a throwaway one
+current = RunMetrics()
+# Totals over every finished run of this process, and the last run's report, for /metrics
+totals = Counter()
+last_report = None
+totals_lock = threading.Lock()
+
+
+def start_run(mode=None):
+    """Starts measuring a new run."""
+    global current
+    current = RunMetrics(mode)
+    return current
+
+
+def stage(name):
+    """Times a block as (part of) a stage of the current run."""
+    return current.stage(name)
+
+
+def iterate(name, iterable):
+    """Times the production of each item of iterable as a stage of the current run."""
+    return current.iterate(name, iterable)
+
+
+def record_request(endpoint, seconds, size=0, error=False):
+    """Records an HTTP request's latency, response or body size, and whether it failed."""
+    current.record_request(endpoint, seconds, size, error)
+
+
+def count(name, value=1):
+    """Adds to a named counter of the current run (bytes, pages, retries...)."""
+    current.count(name, value)
+
+
+def count_rows(table, rows):
+    """Adds to the rows written to a table in the current run."""
+    current.count_rows(table, rows)
+
+
+def record_worker_rss(peak):
+    """Records the peak memory a worker process reported for its part of the current run."""
+    current.record_worker_rss(peak)
+
+
+def annotate(**info):
+    """Adds top-level entries (such as the study diff) to the current run's report."""
+    current.info.update(info)
+
+
+def metered(blocks, name, sizes=None):
+    """Yields blocks of bytes, counting their total size under name (and appending
+    each block's size to the sizes list, if given)."""
+    for block in blocks:
+        count(name, len(block))
+        if sizes is not None:
+            sizes.append(len(block))
+        yield block
+
+
+def accumulate(report):
+    """Adds a finished run's report to the process-wide totals."""
+    with totals_lock:
+        totals['runs', ('outcome', report['outcome'])] += 1
+        for name, stage in report['stages'].items():
+            totals['stage_seconds', ('stage', name)] = round(totals['stage_seconds', ('stage', name)] + stage['seconds'], 4)
+        for table, rows in report['rows'].items():
+            totals['rows_written', ('table', table)] += rows
+        for name, value in report['counts'].items():
+            totals[name, None] += value
+        for endpoint, requests in report['http'].items():
+            for key in ('requests', 'errors', 'bytes', 'seconds'):
+                totals[f'http_{key}', ('endpoint', endpoint)] = round(
+                    totals[f'http_{key}', ('endpoint', endpoint)] + requests[key], 4)
+            for bound, observations in zip(LATENCY_BUCKETS, requests['buckets']):
+                totals['http_bucket', ('endpoint', endpoint, bound)] += observations
+
+
+def finish_run(outcome, report_path=METRICS_REPORT_PATH, history_path=METRICS_HISTORY_PATH):
+    """Writes the current run's report to report_path, appends it to history_path and
+    returns it. outcome says how the run ended ('synced', 'skipped', ...)."""
+    global last_report
+    report = current.report(outcome)
+    os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+    with open(f"{report_path}.tmp", mode='w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    os.replace(f"{report_path}.tmp", report_path)
+    with open(history_path, mode='a', encoding='utf-8') as file:
+        file.write(json.dumps(report) + '\n')
+
+    accumulate(report)
+    last_report = report
+    stages = ', '.join(f"{name} {stage['seconds']:.1f}s"
+                       for name, stage in sorted(report['stages'].items(), key=lambda item: -item[1]['seconds']))
+    workers = report['workers_peak_rss_bytes']
+    print(f"Run {outcome} in {report['seconds']:.1f}s ({stages or 'no stages'}); "
+          f"peak memory {report['peak_rss_bytes'] / 2 ** 20:.0f} MB"
+          f"{f', transform workers up to {workers / 2 ** 20:.0f} MB each' if workers else ''}.")
+    return report
+
+
+def render_metrics():
+    """Renders the totals and the last run in the Prometheus text exposition format."""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.extend([f'# HELP clinical_sync_{name} {help_text}', f'# TYPE clinical_sync_{name} {kind}'])
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{value}"' for key, value in labels)
+            lines.append(f'clinical_sync_{name}{{{label_text}}} {value}' if labels else f'clinical_sync_{name} {value}')
+
+    def labelled(key):
+        return sorted(([labels[:2]], value) for (name, labels), value in totals.items() if name == key)
+
+    with totals_lock:
+        metric('runs_total', 'counter', 'Finished sync runs by outcome.', labelled('runs'))
+        metric('stage_seconds_total', 'counter', 'Time spent in each pipeline stage.', labelled('stage_seconds'))
+        metric('rows_written_total', 'counter', 'Rows written per table.', labelled('rows_written'))
+        for name in sorted(name for name, labels in totals if labels is None):
+            metric(f'{name}_total', 'counter', f'Total {name.replace("_", " ")}.', [([], totals[name, None])])
+        metric('http_requests_total', 'counter', 'HTTP requests per endpoint.', labelled('http_requests'))
+        metric('http_request_errors_total', 'counter', 'Failed HTTP requests per endpoint.', labelled('http_errors'))
+        metric('http_bytes_total', 'counter', 'Bytes received or sent per endpoint.', labelled('http_bytes'))
+
+        lines.extend(['# HELP clinical_sync_http_request_duration_seconds HTTP request latency per endpoint.',
+                      '# TYPE clinical_sync_http_request_duration_seconds histogram'])
+        for (_, (key, endpoint)), requests in sorted(
+                (item for item in totals.items() if item[0][0] == 'http_requests')):
+            histogram = 'clinical_sync_http_request_duration_seconds'
+            for bound in LATENCY_BUCKETS:
+                lines.append(f'{histogram}_bucket{{endpoint="{endpoint}",le="{bound}"}} '
+                             f'{totals["http_bucket", (key, endpoint, bound)]}')
+            lines.append(f'{histogram}_bucket{{endpoint="{endpoint}",le="+Inf"}} {requests}')
+            lines.append(f'{histogram}_sum{{endpoint="{endpoint}"}} {totals["http_seconds", (key, endpoint)]}')
+            lines.append(f'{histogram}_count{{endpoint="{endpoint}"}} {requests}')
+
+        if last_report:
+            finished_at = datetime.fromisoformat(last_report['finished_at']).timestamp()
+            metric('last_run_timestamp_seconds', 'gauge', 'When the last run finished.', [([], finished_at)])
+            metric('last_run_seconds', 'gauge', 'Duration of the last run.', [([], last_report['seconds'])])
+            metric('last_run_stage_seconds', 'gauge', 'Time spent in each stage in the last run.',
+                   [([('stage', name)], stage['seconds']) for name, stage in sorted(last_report['stages'].items())])
+            fetch_limits = last_report.get('fetch_limits')
+            if fetch_limits:
+                metric('fetch_concurrency_limit', 'gauge', 'Concurrent page requests allowed at the end of the last fetch.',
+                       [([], fetch_limits['limit'])])
+                metric('fetch_requests_per_second', 'gauge', 'Page request throughput at the end of the last fetch.',
+                       [([], fetch_limits['requests_per_second'] or 0)])
+            metric('last_run_peak_rss_bytes', 'gauge', 'Peak resident memory of the sync process in the last run.',
+                   [([], last_report['peak_rss_bytes'])])
+            if last_report['workers_peak_rss_bytes']:
+                metric('last_run_workers_peak_rss_bytes', 'gauge',
+                       'Peak resident memory of any transform worker in the last run.',
+                       [([], last_report['workers_peak_rss_bytes'])])
+        metric('rss_bytes', 'gauge', 'Resident memory of the sync process.', [([], rss_bytes())])
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host=METRICS_HOST, port=METRICS_PORT):
+    """Serves /metrics on host:port from a background thread and returns the server."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
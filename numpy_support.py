@@ -0,0 +1,15 @@
+def import_numpy(feature):
+    """Imports NumPy, which only some features (named by feature in the error) need."""
+    try:
+        import numpy
+    except ImportError as e:
+        raise ImportError(f"{feature} requires numpy (pip install numpy).") from e
+    return numpy
+
+
+def has_numpy():
+    try:
+        import_numpy('This feature')
+    except ImportError:
+        return False
+    return True
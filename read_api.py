@@ -0,0 +1,449 @@
+import io
+import os
+import ast
+import csv
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import geo_index
+import numpy_support
+import text_index
+from data_fetcher import TABLES, DIMENSION_TABLES, table_path
+from config import (SYNC_STATE_PATH, TEXT_INDEX_PATH, READ_API_HOST, READ_API_PORT, READ_API_CACHE_SIZE,
+                    READ_API_RELOAD_INTERVAL)
+
+# Query parameter -> (table, column, normalizer). A study matches a filter when any
+# of its rows in that table has the value; list columns match on any element.
+FILTERS = {
+    'condition': ('conditions', 'condition_key', str.casefold),
+    'status': ('statuses', 'overall_status', str.upper),
+    'phase': ('designs', 'phases', str.upper),
+    'sponsor': ('sponsors', 'sponsor_organization_id', str.casefold),
+    'country': ('locations', 'country', str.casefold),
+}
+
+# Key columns -> (dimension table, column the name is returned in). Responses and
+# filters see names; the tables only hold the keys.
+DECODED_COLUMNS = {
+    'organization_id': ('organizations_dimension', 'organization_name'),
+    'sponsor_organization_id': ('organizations_dimension', 'sponsor_name'),
+    'collaborator_organization_id': ('organizations_dimension', 'collaborator_name'),
+    'condition_key': ('conditions_dimension', 'condition_name'),
+    'intervention_key': ('interventions_dimension', 'name'),
+}
+
+LIST_COLUMNS = {'phases'}
+
+
+def cell_values(value, column):
+    """Returns the values a CSV cell holds; list columns are stored as Python list literals."""
+    if column not in LIST_COLUMNS:
+        return [value] if value else []
+    try:
+        return [str(item) for item in ast.literal_eval(value)] if value else []
+    except (ValueError, SyntaxError):
+        return [value]
+
+
+def load_names(table):
+    """Returns {key: name} from a dimension table, as the strings the CSVs hold."""
+    if not os.path.exists(table_path(table)):
+        return {}
+    with open(table_path(table), mode='r', encoding='utf-8', newline='') as file:
+        reader = csv.reader(file)
+        next(reader, None)
+        return {key: name for key, name in reader}
+
+
+def csv_records(file):
+    """Yields (offset, record bytes) for each CSV record after the header.
+
+    Quoted fields may contain newlines, so a record ends at the first line break
+    where the number of quote characters seen so far is even.
+    """
+    offset = len(file.readline())
+    record, quotes = b'', 0
+    for line in file:
+        record += line
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            yield offset, record
+            offset += len(record)
+            record, quotes = b'', 0
+
+
+class TableFile:
+    """One latest table, indexed by the byte ranges each study's rows occupy.
+
+    The file stays open, so lookups keep reading the version that was indexed even
+    after process_data() replaces it.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.fieldnames = next(csv.reader([self.file.readline().decode('utf-8')]))
+        self.file.seek(0)
+        self.spans = {}
+
+    def index(self, columns=()):
+        """Records each study's byte ranges, yielding (study_id, (start, end),
+        {column: value}) with the requested columns of every row."""
+        study_column = self.fieldnames.index('study_id')
+        wanted = [(column, self.fieldnames.index(column)) for column in columns]
+        for offset, record in csv_records(self.file):
+            row = next(csv.reader([record.decode('utf-8')]))
+            spans = self.spans.setdefault(row[study_column], [])
+            if spans and spans[-1][1] == offset:
+                spans[-1][1] = offset + len(record)
+            else:
+                spans.append([offset, offset + len(record)])
+            if wanted:
+                yield (row[study_column], (offset, offset + len(record)),
+                       {column: row[position] for column, position in wanted})
+
+    def read_span(self, start, end):
+        """Reads back the rows stored between two byte offsets."""
+        text = os.pread(self.file.fileno(), end - start, start).decode('utf-8')
+        return list(csv.DictReader(io.StringIO(text, newline=''), fieldnames=self.fieldnames))
+
+    def rows(self, study_id):
+        """Reads back the rows of one study."""
+        return [row for start, end in self.spans.get(study_id, ()) for row in self.read_span(start, end)]
+
+    def close(self):
+        self.file.close()
+
+
+def sync_version():
+    """Identifies the last completed sync, or None before the first one."""
+    if not os.path.exists(SYNC_STATE_PATH):
+        return None
+    with open(SYNC_STATE_PATH, mode='r', encoding='utf-8') as file:
+        state = json.load(file)
+    return state.get('dataTimestamp'), state.get('synced_at')
+
+
+class Snapshot:
+    """Indexes over one set of latest tables, with an LRU cache for its queries.
+
+    A snapshot is never modified once built, so a reload builds a new one and
+    swaps it in; queries in flight keep using the one they started with. Queries
+    hold the snapshot with acquire() and release(), and a retired snapshot closes
+    its files once the last of them is done.
+    """
+
+    def __init__(self, cache_size=READ_API_CACHE_SIZE):
+        self.lock = threading.Lock()
+        self.users = 0
+        self.retired = False
+        self.version = sync_version()
+        self.loaded_at = datetime.now().isoformat(timespec='seconds')
+        self.tables = {table: TableFile(table_path(table)) for table in TABLES if os.path.exists(table_path(table))}
+        # Names are only ever added, so loading them after opening the tables covers every key they hold
+        self.names = {table: load_names(table) for table in DIMENSION_TABLES}
+        self.postings = {name: {} for name in FILTERS}
+        sites = geo_index.SiteIndexBuilder() if numpy_support.has_numpy() else None
+        for table, table_file in self.tables.items():
+            filters = [(name, column, normalize) for name, (filter_table, column, normalize) in FILTERS.items()
+                       if filter_table == table]
+            columns = [column for _, column, _ in filters]
+            if table == 'locations' and sites:
+                columns += ['lat', 'lon', 'status']
+            for study_id, span, values in table_file.index(columns):
+                for name, column, normalize in filters:
+                    for value in cell_values(self.decode_value(column, values[column]), column):
+                        self.postings[name].setdefault(normalize(value), set()).add(study_id)
+                if table == 'locations' and sites and values['lat'] and values['lon']:
+                    sites.add(float(values['lat']), float(values['lon']), study_id, values['status'].upper(), span)
+        # Site search needs numpy; without it the rest of the API still works
+        self.sites = sites.build() if sites else None
+        self.get_study = lru_cache(maxsize=cache_size)(self._get_study)
+        self.search = lru_cache(maxsize=cache_size)(self._search)
+        self.find_sites = lru_cache(maxsize=cache_size)(self._find_sites)
+        self.search_text = lru_cache(maxsize=cache_size)(self._search_text)
+
+    def is_current(self):
+        """Checks that no sync completed and no table was replaced while building."""
+        if sync_version() != self.version:
+            return False
+        for table, table_file in self.tables.items():
+            try:
+                if os.stat(table_path(table)).st_ino != os.fstat(table_file.file.fileno()).st_ino:
+                    return False
+            except FileNotFoundError:
+                return False
+        return True
+
+    def decode_value(self, column, value):
+        """Returns the name a key column's value stands for (other columns' values as they are)."""
+        if column not in DECODED_COLUMNS or not value:
+            return value
+        return self.names[DECODED_COLUMNS[column][0]].get(value, '')
+
+    def decode(self, row):
+        """Adds the name of each key in a row next to it."""
+        decoded = {}
+        for column, value in row.items():
+            decoded[column] = value
+            if column in DECODED_COLUMNS:
+                decoded[DECODED_COLUMNS[column][1]] = self.decode_value(column, value)
+        return decoded
+
+    def _get_study(self, study_id):
+        """Returns {table: rows} for a study, or None if it is not in the snapshot.
+        Cached results are shared, so callers must not modify them."""
+        if 'studies' not in self.tables or study_id not in self.tables['studies'].spans:
+            return None
+        return {table: [self.decode(row) for row in table_file.rows(study_id)]
+                for table, table_file in self.tables.items()}
+
+    def _search(self, filters):
+        """Returns the sorted IDs of studies matching every (name, value) filter."""
+        if not filters:
+            return tuple(sorted(self.tables['studies'].spans)) if 'studies' in self.tables else ()
+        matches = sorted((self.postings[name].get(FILTERS[name][2](value), set()) for name, value in filters), key=len)
+        return tuple(sorted(matches[0].intersection(*matches[1:])))
+
+    def _find_sites(self, area, filters, site_status, limit):
+        """Returns (total, sites) for the sites inside an area, nearest first for a radius.
+
+        area is ('radius', lat, lon, km) or ('bbox', min_lat, min_lon, max_lat, max_lon).
+        filters restrict the sites to studies matching search(filters), which joins
+        site search to study status, condition and so on. Each returned site is its
+        locations row plus 'distance_km' for radius queries.
+        """
+        study_codes = self.sites.study_codes_for(self._search(filters)) if filters else None
+        status = site_status.upper() if site_status else None
+        if area[0] == 'radius':
+            indexes, distances = self.sites.within_radius(*area[1:], study_codes=study_codes, status=status)
+        else:
+            indexes, distances = self.sites.within_bbox(*area[1:], study_codes=study_codes, status=status), None
+        results = []
+        for position, (start, end) in enumerate(self.sites.spans[indexes[:limit]].tolist()):
+            site = self.tables['locations'].read_span(start, end)[0]
+            if distances is not None:
+                site['distance_km'] = round(float(distances[position]), 3)
+            results.append(site)
+        return len(indexes), tuple(results)
+
+    def _search_text(self, query, limit):
+        """Returns ((study_id, score), ...) for a full-text query, best BM25 score first."""
+        if not os.path.exists(TEXT_INDEX_PATH):
+            raise RuntimeError("The full-text index has not been built yet.")
+        conn = text_index.open_reader()
+        try:
+            return tuple(text_index.search(conn, query, limit))
+        finally:
+            conn.close()
+
+    def acquire(self):
+        with self.lock:
+            self.users += 1
+
+    def release(self):
+        with self.lock:
+            self.users -= 1
+            unused = self.retired and not self.users
+        if unused:
+            self.close()
+
+    def retire(self):
+        """Closes the snapshot now, or when the last query using it releases it."""
+        with self.lock:
+            self.retired = True
+            unused = not self.users
+        if unused:
+            self.close()
+
+    def close(self):
+        for table_file in self.tables.values():
+            table_file.close()
+
+
+class StudyReader:
+    """Serves lookups from the current Snapshot and reloads it when a sync completes."""
+
+    def __init__(self, cache_size=READ_API_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.snapshot = None
+        self.reload_lock = threading.Lock()
+        self.snapshot_lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """Builds a new snapshot and swaps it in once it matches the files on disk,
+        retiring the previous one."""
+        with self.reload_lock:
+            for attempt in range(3):
+                snapshot = Snapshot(self.cache_size)
+                if snapshot.is_current():
+                    break
+                if attempt == 2:
+                    print("Latest tables kept changing while indexing; serving the last build.")
+                    break
+                snapshot.close()
+            with self.snapshot_lock:
+                previous, self.snapshot = self.snapshot, snapshot
+            if previous:
+                previous.retire()
+            studies = len(snapshot.tables['studies'].spans) if 'studies' in snapshot.tables else 0
+            print(f"Loaded snapshot {snapshot.version} with {studies} studies.")
+
+    def reload_if_changed(self):
+        if sync_version() != self.snapshot.version:
+            self.reload()
+
+    def watch(self, interval=READ_API_RELOAD_INTERVAL):
+        """Starts a daemon thread that reloads after each completed sync."""
+        def poll():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload_if_changed()
+                except (OSError, ValueError) as e:
+                    print(f"Error reloading latest tables: {e}")
+        threading.Thread(target=poll, daemon=True).start()
+
+    @contextmanager
+    def current(self):
+        """Yields the current snapshot, keeping its files open until the caller is done."""
+        with self.snapshot_lock:
+            snapshot = self.snapshot
+            snapshot.acquire()
+        try:
+            yield snapshot
+        finally:
+            snapshot.release()
+
+    def get_study(self, study_id):
+        with self.current() as snapshot:
+            return snapshot.get_study(study_id)
+
+    def search(self, **filters):
+        """Returns the sorted IDs of studies matching all given FILTERS."""
+        unknown = set(filters) - set(FILTERS)
+        if unknown:
+            raise ValueError(f"Unknown filter(s): {', '.join(sorted(unknown))}")
+        with self.current() as snapshot:
+            return snapshot.search(tuple(sorted(filters.items())))
+
+    def search_text(self, query, limit=20):
+        """Ranks studies by how well their summary, description and eligibility text
+        match query; see text_index.search()."""
+        with self.current() as snapshot:
+            return snapshot.search_text(query, limit)
+
+    def find_sites(self, lat=None, lon=None, radius_km=None, bbox=None, site_status=None, limit=100, **filters):
+        """Finds trial sites within radius_km of (lat, lon), or inside bbox given as
+        (min_lat, min_lon, max_lat, max_lon); see Snapshot._find_sites()."""
+        unknown = set(filters) - set(FILTERS)
+        if unknown:
+            raise ValueError(f"Unknown filter(s): {', '.join(sorted(unknown))}")
+        if bbox is not None:
+            area = ('bbox', *map(float, bbox))
+        elif None not in (lat, lon, radius_km):
+            area = ('radius', float(lat), float(lon), float(radius_km))
+        else:
+            raise ValueError("Give lat, lon and radius_km, or bbox.")
+        with self.current() as snapshot:
+            if snapshot.sites is None:
+                raise RuntimeError("Site search needs numpy and a locations table.")
+            return snapshot.find_sites(area, tuple(sorted(filters.items())), site_status, limit)
+
+
+def make_handler(reader):
+    """Returns a request handler serving the read API from reader.
+
+    GET /studies/<study_id>    every table's rows for one study
+    GET /studies?<filters>     matching study IDs; limit and offset page through them
+    GET /sites?lat=&lon=&radius_km=&<filters>    sites near a point, nearest first
+    GET /sites?bbox=min_lat,min_lon,max_lat,max_lon&<filters>    sites inside a box
+                               site_status filters on the site's own status
+    GET /search?q=             study IDs ranked by full-text relevance
+    GET /health                the loaded snapshot
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            if url.path.startswith('/studies/'):
+                study = reader.get_study(url.path[len('/studies/'):])
+                if study is None:
+                    self.send_json(404, {'error': 'Study not found'})
+                else:
+                    self.send_json(200, study)
+            elif url.path == '/studies':
+                try:
+                    limit = int(params.pop('limit', 100))
+                    offset = int(params.pop('offset', 0))
+                    study_ids = reader.search(**params)
+                except ValueError as e:
+                    self.send_json(400, {'error': str(e)})
+                    return
+                self.send_json(200, {'total': len(study_ids), 'study_ids': list(study_ids[offset:offset + limit])})
+            elif url.path == '/sites':
+                try:
+                    limit = int(params.pop('limit', 100))
+                    if 'bbox' in params:
+                        params['bbox'] = params['bbox'].split(',')
+                        if len(params['bbox']) != 4:
+                            raise ValueError("bbox needs min_lat,min_lon,max_lat,max_lon")
+                    total, sites = reader.find_sites(limit=limit, **params)
+                except ValueError as e:
+                    self.send_json(400, {'error': str(e)})
+                    return
+                except RuntimeError as e:
+                    self.send_json(503, {'error': str(e)})
+                    return
+                self.send_json(200, {'total': total, 'sites': list(sites)})
+            elif url.path == '/search':
+                try:
+                    results = reader.search_text(params.get('q', ''), int(params.get('limit', 20)))
+                except ValueError as e:
+                    self.send_json(400, {'error': str(e)})
+                    return
+                except RuntimeError as e:
+                    self.send_json(503, {'error': str(e)})
+                    return
+                self.send_json(200, {'results': [{'study_id': study_id, 'score': score} for study_id, score in results]})
+            elif url.path == '/health':
+                snapshot = reader.snapshot
+                self.send_json(200, {'version': snapshot.version, 'loaded_at': snapshot.loaded_at})
+            else:
+                self.send_json(404, {'error': 'Not found'})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(host=READ_API_HOST, port=READ_API_PORT):
+    """Loads the latest tables and serves the read API until interrupted."""
+    reader = StudyReader()
+    reader.watch()
+    server = ThreadingHTTPServer((host, port), make_handler(reader))
+    print(f"Serving clinical data on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,194 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import random
+import signal
+import statistics
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import data_fetcher
+from config import (VERSION_URL, SYNC_MODE, SCHEDULER_LOCK_PATH, SCHEDULER_STATE_PATH,
+                    SCHEDULER_MIN_POLL_INTERVAL, SCHEDULER_MAX_POLL_INTERVAL, SCHEDULER_FULL_SYNC_DAYS,
+                    SCHEDULER_RETRY_BACKOFF, SCHEDULER_MAX_RETRY_BACKOFF)
+
+# How many publications the publish period is estimated from
+PUBLISH_HISTORY = 10
+
+
+@contextmanager
+def run_lock(path=SCHEDULER_LOCK_PATH):
+    """Takes an exclusive lock on path for the duration of a run.
+
+    Yields whether the lock was acquired; another process holding it means a run is
+    already in progress there. The lock is released when the process exits, however
+    it exits.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, mode='a+', encoding='utf-8') as file:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            file.truncate(0)
+            file.write(f"{os.getpid()}\n")
+            file.flush()
+            yield True
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def load_state(path=SCHEDULER_STATE_PATH):
+    """Returns what the scheduler learned so far: when each recent dataTimestamp was
+    first seen, when the last full sync ran and the current run of failures."""
+    if not os.path.exists(path):
+        return {'published': [], 'last_full_sync': None, 'failures': 0}
+    with open(path, mode='r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def save_state(state, path=SCHEDULER_STATE_PATH):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, mode='w', encoding='utf-8') as file:
+        json.dump(state, file)
+    os.replace(tmp_path, path)
+
+
+def record_publication(state, data_timestamp, now):
+    """Notes the first time a dataTimestamp was seen; returns whether it is new."""
+    published = state['published']
+    if published and published[-1][0] == data_timestamp:
+        return False
+    published.append([data_timestamp, now])
+    del published[:-PUBLISH_HISTORY]
+    return True
+
+
+def publish_period(state):
+    """Estimates seconds between publications from when new ones were first seen, or
+    None until there are enough of them."""
+    seen = [first_seen for _, first_seen in state['published']]
+    if len(seen) < 3:
+        return None
+    return statistics.median(later - earlier for earlier, later in zip(seen, seen[1:]))
+
+
+def poll_delay(state, unchanged_polls, now):
+    """Returns the seconds to wait before checking /version again.
+
+    Once the publish period is known, polling waits until the next publication is
+    due. Before that, or once it is overdue, the interval doubles with every poll
+    that finds nothing new, between the configured minimum and maximum.
+    """
+    period = publish_period(state)
+    if period and state['published']:
+        due = state['published'][-1][1] + period
+        if now < due:
+            return min(max(due - now, SCHEDULER_MIN_POLL_INTERVAL), SCHEDULER_MAX_POLL_INTERVAL)
+    return min(SCHEDULER_MIN_POLL_INTERVAL * 2 ** unchanged_polls, SCHEDULER_MAX_POLL_INTERVAL)
+
+
+def retry_delay(failures):
+    """Returns a jittered exponential backoff after the given number of failed runs."""
+    delay = min(SCHEDULER_RETRY_BACKOFF * 2 ** (failures - 1), SCHEDULER_MAX_RETRY_BACKOFF)
+    return delay * random.uniform(0.5, 1.5)
+
+
+def full_sync_due(state, now):
+    """Checks whether the periodic full sync that picks up removed studies is due."""
+    if SYNC_MODE == 'full' or not state['last_full_sync']:
+        return True
+    return now - state['last_full_sync'] >= timedelta(days=SCHEDULER_FULL_SYNC_DAYS).total_seconds()
+
+
+def run_sync(state, now):
+    """Runs process_data() under the run lock and updates state from its outcome.
+
+    Returns the outcome, or 'locked' if another process is running a sync.
+    """
+    mode = 'full' if full_sync_due(state, now) else SYNC_MODE
+    with run_lock() as acquired:
+        if not acquired:
+            print("Another sync is running; checking again later.")
+            return 'locked'
+        try:
+            outcome = data_fetcher.process_data(mode)
+        except Exception as e:
+            print(f"Sync failed: {e!r}")
+            outcome = 'failed'
+
+    if outcome in ('synced', 'skipped'):
+        state['failures'] = 0
+        if outcome == 'synced' and mode == 'full':
+            state['last_full_sync'] = now
+    else:
+        state['failures'] += 1
+    return outcome
+
+
+def check(state, now):
+    """Checks /version and runs a sync if there is something to do.
+
+    A sync is needed when a snapshot newer than the last synced one was published or
+    uploads are still pending. Returns whether a new snapshot was published and the
+    sync outcome, or None if no sync was needed.
+    """
+    version_data = data_fetcher.fetch_version(VERSION_URL)
+    if not version_data:
+        state['failures'] += 1
+        return False, 'failed'
+    data_timestamp = version_data.get('dataTimestamp')
+    new = record_publication(state, data_timestamp, now)
+    if new:
+        print(f"New data published at {data_timestamp}.")
+    sync_state = data_fetcher.load_sync_state()
+    if data_timestamp == sync_state.get('dataTimestamp') and not sync_state.get('pending_uploads'):
+        state['failures'] = 0
+        return new, None
+    return new, run_sync(state, now)
+
+
+def run(once=False):
+    """Polls for new data and syncs it until SIGINT or SIGTERM; with once, checks
+    and syncs a single time (for running from cron).
+
+    Only one sync runs at a time, here or in any other process sharing the lock file.
+    On the first signal an in-progress fetch stops after the pages in flight are
+    checkpointed, so the next run resumes from them; a second signal exits at once.
+    """
+    def request_shutdown(signum, frame):
+        if data_fetcher.shutdown_requested.is_set():
+            raise KeyboardInterrupt
+        print("Shutting down after checkpointing the pages in flight (signal again to exit now)...")
+        data_fetcher.shutdown_requested.set()
+
+    signal.signal(signal.SIGINT, request_shutdown)
+    signal.signal(signal.SIGTERM, request_shutdown)
+
+    state = load_state()
+    unchanged_polls = 0
+    while not data_fetcher.shutdown_requested.is_set():
+        now = time.time()
+        new, outcome = check(state, now)
+        save_state(state)
+        if once:
+            break
+
+        if data_fetcher.shutdown_requested.is_set():
+            break
+        unchanged_polls = 0 if new else unchanged_polls + 1
+        if outcome in (None, 'synced', 'skipped', 'locked'):
+            delay = poll_delay(state, unchanged_polls, now)
+        else:
+            delay = retry_delay(state['failures'])
+            print(f"Retrying in {delay:.0f}s after {state['failures']} failed attempt(s).")
+        print(f"Next check at {datetime.fromtimestamp(now + delay).isoformat(timespec='seconds')}.")
+        data_fetcher.shutdown_requested.wait(delay)
+    print("Scheduler stopped.")
+
+
+if __name__ == "__main__":
+    run(once='--once' in sys.argv[1:])
@@ -0,0 +1,176 @@
+import os
+import ast
+import csv
+import json
+import sqlite3
+from collections import Counter
+from datetime import date
+from itertools import islice
+import table_writers
+from config import SQLITE_TARGET_PATH, SQLITE_BATCH_SIZE
+
+# Column type (see table_writers.COLUMN_CONVERTERS) -> SQLite column type; dates
+# are ISO strings, partial ones ('2023-05') kept as published, and lists JSON arrays
+SQL_TYPES = {'string': 'TEXT', 'date': 'TEXT', 'bool': 'INTEGER', 'int': 'INTEGER', 'float': 'REAL', 'list': 'TEXT'}
+
+
+def sql_value(value, column_type):
+    """Converts a row value, as flattened or as read back from CSV, for storage."""
+    if value is None or value == '':
+        return None
+    if column_type == 'date':
+        # Not parse_date(), which would turn '2023-05' into a made-up '2023-05-01'
+        return value.isoformat() if isinstance(value, date) else str(value)
+    if column_type == 'bool':
+        return int(table_writers.parse_bool(value))
+    if column_type in ('int', 'float'):
+        return table_writers.parse_number(int if column_type == 'int' else float)(value)
+    if column_type == 'list':
+        # The CSVs hold lists as Python literals
+        return json.dumps(value if isinstance(value, list) else ast.literal_eval(value))
+    return str(value)
+
+
+def open_reader(path=SQLITE_TARGET_PATH):
+    """Opens the target read-only; readers see the last committed load."""
+    return sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+
+
+class SqliteLoader:
+    """Loads one run's changes into the SQLite target, in a single transaction.
+
+    tables maps the study tables to their columns, each with a study_id column
+    indexed for the deletes; dimension_tables maps the dimension tables to their
+    key and name columns. The target remembers the snapshot it was last loaded
+    with: unless that is base_snapshot (the one the run's changes apply on top of)
+    and the tables still have the same columns, every table is recreated and
+    reload is set, and the run must load every study instead of the changed ones.
+
+    Rows and deletes are staged in a private temporary database while the run
+    goes on, so the target is only locked for writing by commit(), which applies
+    them in one transaction. Nothing is visible to readers before then; closing
+    without committing discards the load.
+    """
+
+    def __init__(self, path, tables, dimension_tables, column_types, base_snapshot):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.tables = tables
+        self.dimension_tables = dimension_tables
+        self.column_types = column_types
+        self.base_snapshot = base_snapshot
+        self.rows = Counter()
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS load_state (key TEXT PRIMARY KEY, value TEXT)')
+        self.reload = not self.is_base()
+        # An empty file name makes a temporary database only this connection sees
+        self.conn.execute("ATTACH DATABASE '' AS staging")
+        self.create_tables('staging')
+        self.conn.execute('CREATE TABLE staging.removed (study_id TEXT PRIMARY KEY)')
+        self.conn.execute('BEGIN')
+
+    def all_tables(self):
+        return {**self.dimension_tables, **self.tables}
+
+    def is_base(self):
+        """Checks that the target holds base_snapshot, with the current columns."""
+        loaded = self.conn.execute("SELECT value FROM main.load_state WHERE key = 'snapshot'").fetchone()
+        return bool(self.base_snapshot) and loaded == (self.base_snapshot,) and self.matches_schema()
+
+    def matches_schema(self):
+        for table, columns in self.all_tables().items():
+            if [row[1] for row in self.conn.execute(f'PRAGMA main.table_info("{table}")')] != columns:
+                return False
+        return True
+
+    def create_tables(self, schema):
+        """Recreates every table of a schema empty; the study_id indexes are added
+        to the target on commit, after the bulk load."""
+        for table, columns in self.all_tables().items():
+            self.conn.execute(f'DROP TABLE IF EXISTS {schema}."{table}"')
+            if table in self.dimension_tables:
+                key_column, name_column = columns
+                definition = f'"{key_column}" INTEGER PRIMARY KEY, "{name_column}" TEXT'
+            else:
+                definition = ', '.join(f'"{column}" {SQL_TYPES[self.column_types.get(column, "string")]}'
+                                       for column in columns)
+            self.conn.execute(f'CREATE TABLE {schema}."{table}" ({definition})')
+
+    def insert(self, table, rows, replace=False):
+        """Stages rows (dicts) SQLITE_BATCH_SIZE at a time; with replace, rows with
+        an existing primary key replace it."""
+        columns = self.all_tables()[table]
+        types = [self.column_types.get(column, 'string') for column in columns]
+        column_list = ', '.join(f'"{column}"' for column in columns)
+        placeholders = ', '.join('?' for _ in columns)
+        sql = f'INSERT {"OR REPLACE " if replace else ""}INTO staging."{table}" ({column_list}) VALUES ({placeholders})'
+        values = ([sql_value(row.get(column), column_type) for column, column_type in zip(columns, types)]
+                  for row in rows)
+        while batch := list(islice(values, SQLITE_BATCH_SIZE)):
+            self.conn.executemany(sql, batch)
+            self.rows[table] += len(batch)
+
+    def delete_studies(self, study_ids):
+        """Stages deleting every row of the given studies from the study tables."""
+        self.conn.executemany('INSERT OR IGNORE INTO staging.removed (study_id) VALUES (?)',
+                              ((study_id,) for study_id in study_ids))
+
+    def replace_studies(self, rows_by_table, study_ids):
+        """Replaces the rows of the given studies with rows_by_table."""
+        if not self.reload:
+            self.delete_studies(study_ids)
+        for table, rows in rows_by_table.items():
+            self.insert(table, rows)
+
+    def load_dimension(self, table, rows):
+        """Adds or updates dimension rows."""
+        self.insert(table, rows, replace=True)
+
+    def load_csv(self, table, path):
+        """Loads every row of a latest table's CSV."""
+        if os.path.exists(path):
+            with open(path, mode='r', encoding='utf-8', newline='') as file:
+                self.insert(table, csv.DictReader(file))
+
+    def apply(self):
+        """Moves the staged rows and deletes into the target's tables."""
+        if self.reload:
+            self.create_tables('main')
+        else:
+            for table in self.tables:
+                self.conn.execute(f'DELETE FROM main."{table}" WHERE study_id IN (SELECT study_id FROM staging.removed)')
+        for table, columns in self.all_tables().items():
+            column_list = ', '.join(f'"{column}"' for column in columns)
+            self.conn.execute(f'INSERT {"OR REPLACE " if table in self.dimension_tables else ""}'
+                              f'INTO main."{table}" ({column_list}) SELECT {column_list} FROM staging."{table}"')
+        for table in self.tables:
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS main."{table}_study_id" ON "{table}" (study_id)')
+
+    def commit(self, snapshot):
+        """Applies the staged load and makes it visible to readers, in one write
+        transaction. Returns whether it was applied.
+
+        A load of changes is dropped if the target no longer holds base_snapshot
+        by then (another process loaded it meanwhile); the next run reloads it.
+        """
+        self.conn.execute('COMMIT')
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            if not self.reload and not self.is_base():
+                self.conn.execute('ROLLBACK')
+                print("The SQLite target changed during the run; it will be reloaded in full next run.")
+                return False
+            self.apply()
+            self.conn.execute("INSERT OR REPLACE INTO main.load_state (key, value) VALUES ('snapshot', ?)",
+                              (snapshot,))
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        print(f"Loaded {sum(self.rows.values())} rows into the SQLite target"
+              f"{' (full reload)' if self.reload else ''}.")
+        return True
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import sqlite3
+from config import STUDY_INDEX_PATH
+
+# Bytes of each per-table digest; a study's entry holds one digest per table
+DIGEST_SIZE = 8
+
+
+def table_digest(rows):
+    """Hashes the flattened rows of one study for one table."""
+    return hashlib.blake2b(json.dumps(rows, default=str).encode('utf-8'), digest_size=DIGEST_SIZE).digest()
+
+
+def study_digests(rows_by_table, tables):
+    """Concatenates the per-table digests of one study's rows in tables order."""
+    return b''.join(table_digest(rows_by_table.get(table, [])) for table in tables)
+
+
+def open_index(path=STUDY_INDEX_PATH):
+    """Opens the study hash index, creating it if needed.
+
+    The index maps each nctId to the per-table digests of its rows as of the last
+    successful sync. Digests seen during the current run are staged in a temporary
+    table until commit_run().
+    """
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE IF NOT EXISTS study_hashes (nct_id TEXT PRIMARY KEY, digests BLOB NOT NULL)')
+    conn.execute('CREATE TEMP TABLE run_hashes (nct_id TEXT PRIMARY KEY, digests BLOB NOT NULL)')
+    return conn
+
+
+def stage_studies(conn, digests_by_study):
+    """Stages the digests of studies seen in this run ({nct_id: digests})."""
+    conn.executemany('INSERT OR REPLACE INTO run_hashes (nct_id, digests) VALUES (?, ?)',
+                     digests_by_study.items())
+
+
+def lookup(conn, nct_ids, chunk_size=500):
+    """Returns the indexed digests of the given studies ({nct_id: digests})."""
+    nct_ids = list(nct_ids)
+    digests = {}
+    for i in range(0, len(nct_ids), chunk_size):
+        chunk = nct_ids[i:i + chunk_size]
+        placeholders = ','.join('?' * len(chunk))
+        digests.update(conn.execute(f'SELECT nct_id, digests FROM study_hashes WHERE nct_id IN ({placeholders})', chunk))
+    return digests
+
+
+def changed_tables(old, new, tables):
+    """Returns the tables whose digest differs between two digest blobs."""
+    return {table for i, table in enumerate(tables)
+            if old[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE] != new[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]}
+
+
+def diff_run(conn, tables, full):
+    """Classifies the staged studies against the index.
+
+    Returns a dict with the 'added', 'changed' and 'removed' nctIds, the number of
+    'unchanged' studies and the set of 'tables' whose rows changed. Removals are only
+    detected on a full run, where every study in the registry has been staged.
+    """
+    empty = study_digests({}, tables)
+    diff = {'added': [], 'changed': [], 'removed': [], 'unchanged': 0, 'tables': set()}
+
+    rows = conn.execute('SELECT r.nct_id, s.digests, r.digests FROM run_hashes r '
+                        'LEFT JOIN study_hashes s ON s.nct_id = r.nct_id')
+    for nct_id, old, new in rows:
+        if old is None:
+            diff['added'].append(nct_id)
+            diff['tables'] |= changed_tables(empty, new, tables)
+        elif old != new:
+            diff['changed'].append(nct_id)
+            diff['tables'] |= changed_tables(old, new, tables)
+        else:
+            diff['unchanged'] += 1
+
+    if full:
+        rows = conn.execute('SELECT nct_id, digests FROM study_hashes '
+                            'WHERE nct_id NOT IN (SELECT nct_id FROM run_hashes)')
+        for nct_id, old in rows:
+            diff['removed'].append(nct_id)
+            diff['tables'] |= changed_tables(old, empty, tables)
+
+    return diff
+
+
+def commit_run(conn, full):
+    """Records the staged digests as the new index; a full run also drops removed studies."""
+    with conn:
+        if full:
+            conn.execute('DELETE FROM study_hashes WHERE nct_id NOT IN (SELECT nct_id FROM run_hashes)')
+        conn.execute('INSERT OR REPLACE INTO study_hashes (nct_id, digests) '
+                     'SELECT nct_id, digests FROM run_hashes')
+        conn.execute('DELETE FROM run_hashes')
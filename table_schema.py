@@ -0,0 +1,430 @@
+import operator
+import functools
+from collections import namedtuple
+import eligibility_matrix
+
+# Column sources. A plain string is a dotted path into the row's item (or into the
+# study, for tables with one row per study); '' is the item itself and a numeric
+# part indexes a list.
+Field = namedtuple('Field', ['path', 'default'], defaults=[None])   # A path with a default other than None
+Study = namedtuple('Study', ['path'])                               # A path into the study from any table
+Value = namedtuple('Value', ['value'])                              # A constant
+RowId = namedtuple('RowId', ['key'])                                # A stable row ID (see row_id_factory())
+Key = namedtuple('Key', ['name', 'source'])                         # The ID of a value in a named key map
+Last = namedtuple('Last', ['table', 'column'])                      # A column of an earlier table's last row
+Derived = namedtuple('Derived', ['function', 'sources', 'item'], defaults=[None])  # function(*sources)[item]
+
+# The name of the list a row's item was taken from (for tables read from several)
+SOURCE = object()
+
+NCT_ID = Study('protocolSection.identificationModule.nctId')
+STATUS = 'protocolSection.statusModule'
+SPONSORS = 'protocolSection.sponsorCollaboratorsModule'
+OVERSIGHT = 'protocolSection.oversightModule'
+DESIGN = 'protocolSection.designModule'
+ELIGIBILITY = 'protocolSection.eligibilityModule'
+CONTACTS = 'protocolSection.contactsLocationsModule'
+ARMS_INTERVENTIONS = 'protocolSection.armsInterventionsModule'
+
+OUTCOME_TYPES = {'primaryOutcomes': 'primary', 'secondaryOutcomes': 'secondary'}
+
+# Dimensions: names given stable integer keys across runs (see dimensions.py), which
+# Key columns of the tables below refer to. Each is published as a table of its
+# key and name columns.
+DIMENSIONS = {
+    'organizations': ['organization_id', 'organization_name'],
+    'conditions': ['condition_key', 'condition_name'],
+    'interventions': ['intervention_key', 'intervention_name'],
+}
+
+
+def suffixed(suffix):
+    """Returns a function building '<value>_<suffix>' IDs, such as '<nctId>_status'."""
+    return f'{{}}_{suffix}'.format
+
+
+# Output tables, in the order they are written. Each maps its columns, in order, to
+# their sources; 'rows' lists the study arrays holding one item per row, and a table
+# without them has one row per study.
+SCHEMA = {
+    'studies': {
+        'columns': {
+            'study_id': NCT_ID,
+            'brief_title': 'protocolSection.identificationModule.briefTitle',
+            'official_title': 'protocolSection.identificationModule.officialTitle',
+            'acronym': 'protocolSection.identificationModule.orgStudyIdInfo.id',
+            'start_date': f'{STATUS}.startDateStruct.date',
+            'primary_completion_date': f'{STATUS}.primaryCompletionDateStruct.date',
+            'completion_date': f'{STATUS}.completionDateStruct.date',
+            'study_first_submit_date': f'{STATUS}.studyFirstSubmitDate',
+            'study_first_submit_qc_date': f'{STATUS}.studyFirstSubmitQcDate',
+            'study_first_post_date': f'{STATUS}.studyFirstPostDateStruct.date',
+            'last_update_submit_date': f'{STATUS}.lastUpdateSubmitDate',
+            'last_update_post_date': f'{STATUS}.lastUpdatePostDateStruct.date',
+            'oversight_has_dmc': f'{OVERSIGHT}.oversightHasDmc',
+            'is_fda_regulated_drug': f'{OVERSIGHT}.isFdaRegulatedDrug',
+            'is_fda_regulated_device': f'{OVERSIGHT}.isFdaRegulatedDevice',
+            'is_us_export': f'{OVERSIGHT}.isUsExport',
+            'brief_summary': 'protocolSection.descriptionModule.briefSummary',
+            'detailed_description': 'protocolSection.descriptionModule.detailedDescription',
+        },
+    },
+    'organizations': {
+        'rows': [f'{SPONSORS}.collaborators'],
+        'columns': {
+            'organization_id': Key('organizations', 'name'),
+            'organization_class': 'class',
+            'study_id': NCT_ID,
+        },
+    },
+    'statuses': {
+        'columns': {
+            'status_id': Derived(suffixed('status'), [NCT_ID]),
+            'study_id': NCT_ID,
+            'status_verified_date': f'{STATUS}.statusVerifiedDate',
+            'overall_status': f'{STATUS}.overallStatus',
+            'has_expanded_access': f'{STATUS}.expandedAccessInfo.hasExpandedAccess',
+        },
+    },
+    'sponsors': {
+        'columns': {
+            'sponsor_id': Derived(suffixed('sponsor'), [NCT_ID]),
+            'study_id': NCT_ID,
+            'sponsor_organization_id': Key('organizations', f'{SPONSORS}.leadSponsor.name'),
+            'sponsor_class': f'{SPONSORS}.leadSponsor.class',
+            'responsible_party_type': f'{SPONSORS}.responsibleParty.type',
+        },
+    },
+    'collaborators': {
+        'rows': [f'{SPONSORS}.collaborators'],
+        'columns': {
+            'collaborator_id': RowId(['name']),
+            'sponsor_id': Derived(suffixed('sponsor'), [NCT_ID]),
+            'collaborator_organization_id': Key('organizations', 'name'),
+            'collaborator_class': 'class',
+            'study_id': NCT_ID,
+        },
+    },
+    'conditions': {
+        'rows': ['protocolSection.conditionsModule.conditions'],
+        'columns': {
+            'condition_id': RowId(['']),
+            'study_id': NCT_ID,
+            'condition_key': Key('conditions', ''),
+        },
+    },
+    'designs': {
+        'columns': {
+            'design_id': Derived(suffixed('design'), [NCT_ID]),
+            'study_id': NCT_ID,
+            'study_type': f'{DESIGN}.studyType',
+            'phases': Field(f'{DESIGN}.phases', []),
+            'allocation': f'{DESIGN}.designInfo.allocation',
+            'intervention_model': f'{DESIGN}.designInfo.interventionModel',
+            'intervention_model_description': f'{DESIGN}.designInfo.interventionModelDescription',
+            'primary_purpose': f'{DESIGN}.designInfo.primaryPurpose',
+            'masking': f'{DESIGN}.designInfo.maskingInfo.masking',
+            'enrollment_count': f'{DESIGN}.enrollmentInfo.count',
+            'enrollment_type': f'{DESIGN}.enrollmentInfo.type',
+        },
+    },
+    'arms': {
+        'rows': [f'{ARMS_INTERVENTIONS}.armGroups'],
+        'columns': {
+            'arm_id': RowId(['label']),
+            'study_id': NCT_ID,
+            'label': 'label',
+            'type': 'type',
+        },
+    },
+    # Interventions are attached to the last arm; a study without arms has none
+    'interventions': {
+        'rows': [f'{ARMS_INTERVENTIONS}.interventions'],
+        'columns': {
+            'intervention_id': Derived('{}_{}'.format, [Last('arms', 'arm_id'), 'name']),
+            'arm_id': Last('arms', 'arm_id'),
+            'type': 'type',
+            'intervention_key': Key('interventions', 'name'),
+            'description': 'description',
+            'other_names': 'otherNames',
+            'study_id': NCT_ID,
+        },
+    },
+    'outcomes': {
+        'rows': ['protocolSection.outcomesModule.primaryOutcomes', 'protocolSection.outcomesModule.secondaryOutcomes'],
+        'columns': {
+            'outcome_id': RowId([SOURCE, 'measure', 'timeFrame']),
+            'study_id': NCT_ID,
+            'measure': 'measure',
+            'time_frame': 'timeFrame',
+            'outcome_type': Derived(OUTCOME_TYPES.get, [SOURCE]),
+        },
+    },
+    'eligibility': {
+        'columns': {
+            'eligibility_id': Derived(suffixed('eligibility'), [NCT_ID]),
+            'study_id': NCT_ID,
+            'criteria_type': Value('Inclusion/Exclusion'),
+            'description': f'{ELIGIBILITY}.eligibilityCriteria',
+            'healthy_volunteers': f'{ELIGIBILITY}.healthyVolunteers',
+            'sex': f'{ELIGIBILITY}.sex',
+            'gender_based': Value(None),  # Not in the registry data
+            'minimum_age': f'{ELIGIBILITY}.minimumAge',
+            'maximum_age': f'{ELIGIBILITY}.maximumAge',
+            'std_ages': Field(f'{ELIGIBILITY}.stdAges', []),
+            'minimum_age_days': Derived(eligibility_matrix.age_in_days, [f'{ELIGIBILITY}.minimumAge']),
+            'maximum_age_days': Derived(functools.partial(eligibility_matrix.age_in_days, upper=True),
+                                        [f'{ELIGIBILITY}.maximumAge']),
+        },
+    },
+    # Officials, with the phone and email of the first central contact
+    'contacts': {
+        'rows': [f'{CONTACTS}.overallOfficials'],
+        'columns': {
+            'contact_id': RowId(['name', 'role']),
+            'study_id': NCT_ID,
+            'name': 'name',
+            'role': 'role',
+            'phone': Study(f'{CONTACTS}.centralContacts.0.phone'),
+            'email': Study(f'{CONTACTS}.centralContacts.0.email'),
+        },
+    },
+    'locations': {
+        'rows': [f'{CONTACTS}.locations'],
+        'columns': {
+            'location_id': RowId(['facility', 'city', 'zip', 'country']),
+            'study_id': NCT_ID,
+            'facility': 'facility',
+            'status': 'status',
+            'city': 'city',
+            'state': 'state',
+            'zip': 'zip',
+            'country': 'country',
+            'lat': 'geoPoint.lat',
+            'lon': 'geoPoint.lon',
+        },
+    },
+}
+
+
+def table_columns(schema):
+    """Returns each table's column names, in order."""
+    return {table: list(spec['columns']) for table, spec in schema.items()}
+
+
+def source_paths(source, rows_path=None):
+    """Yields the study paths a column source reads; rows_path is the array its
+    table's items come from."""
+    if isinstance(source, str):
+        path = source if rows_path is None else '.'.join(part for part in (rows_path, source) if part)
+        yield '.'.join(part for part in path.split('.') if not part.isdigit())
+    elif isinstance(source, Field):
+        yield from source_paths(source.path, rows_path)
+    elif isinstance(source, Study):
+        yield from source_paths(source.path)
+    elif isinstance(source, (RowId, Derived)):
+        for part in source.key if isinstance(source, RowId) else source.sources:
+            yield from source_paths(part, rows_path)
+    elif isinstance(source, Key):
+        yield from source_paths(source.source, rows_path)
+
+
+def api_fields(schema):
+    """Returns the API field paths the schema reads, for the 'fields' parameter.
+
+    Paths that only lead to other listed paths are left out.
+    """
+    fields = set()
+    for spec in schema.values():
+        for rows_path in spec.get('rows', [None]):
+            for source in spec['columns'].values():
+                fields.update(source_paths(source, rows_path))
+    return sorted(field for field in fields if not any(other.startswith(f'{field}.') for other in fields))
+
+
+# The fixed slots at the start of an extractor's frame (see ExtractorBuilder)
+FRAME_SLOTS = {name: slot for slot, name in enumerate(['study', 'item', 'source', 'row_id', 'keys', 'rows'])}
+
+# Stands in for a missing object along a path
+EMPTY = {}
+
+
+def lookup_step(parent, part, kind, fallback):
+    """Returns a step reading one path part below the value in slot parent: a list
+    index, an intermediate object or list, or a final value."""
+    # Each row gets its own empty list or dict
+    make = type(fallback) if kind == 'value' and fallback in ([], {}) else lambda: fallback
+    if part.isdigit():
+        index = int(part)
+        return lambda frame: frame[parent][index] if len(frame[parent]) > index else make()
+    if kind != 'value':
+        return lambda frame: frame[parent].get(part) or fallback
+    if fallback in ([], {}):
+        return lambda frame: frame[parent][part] if part in frame[parent] else make()
+    return lambda frame: frame[parent].get(part, fallback)
+
+
+class ExtractorBuilder:
+    """Builds a function flattening one study by a schema, out of closures.
+
+    The extractor works on a frame: a list holding the study, the current item, the
+    name of the list it came from, row_id, keys, the rows built so far and a slot
+    for every value a column needs. Each slot is filled by a step, a closure over the
+    slots it reads, run once per study (or per item), so a path prefix is looked up
+    once and shared by all the columns reading below it. A row is then just its
+    columns' slots.
+    """
+
+    def __init__(self):
+        self.slots = len(FRAME_SLOTS)
+        self.tables = set()
+
+    def step(self, scope, key, function):
+        """Returns the slot holding key in scope, first adding the step filling it
+        with function(frame) if needed; a key of None is never shared."""
+        if key is not None and key in scope['slots']:
+            return scope['slots'][key]
+        slot = self.slots
+        self.slots += 1
+        scope['steps'].append((slot, function))
+        if key is not None:
+            scope['slots'][key] = slot
+        return slot
+
+    def lookup(self, scope, path, default):
+        """Returns the slot holding path below the scope's root, or default."""
+        parts = path.split('.') if path else []
+        slot = scope['root']
+        for depth, part in enumerate(parts):
+            if depth == len(parts) - 1:
+                kind, fallback = 'value', default
+            elif parts[depth + 1].isdigit():
+                kind, fallback = 'list', ()
+            else:
+                kind, fallback = 'object', EMPTY
+            slot = self.step(scope, (tuple(parts[:depth + 1]), kind, repr(fallback)),
+                             lookup_step(slot, part, kind, fallback))
+        return slot
+
+    def column(self, source, table, scopes):
+        """Returns the slot holding a column source's value, adding the steps it needs."""
+        study_scope, item_scope = scopes
+        scope = item_scope or study_scope
+        if isinstance(source, str):
+            return self.lookup(scope, source, None)
+        if isinstance(source, Field):
+            return self.lookup(scope, source.path, source.default)
+        if isinstance(source, Study):
+            return self.lookup(study_scope, source.path, None)
+        if isinstance(source, Value):
+            value = source.value
+            if value in ([], {}):
+                # Each row gets its own
+                return self.step(scope, None, lambda frame: type(value)())
+            return self.step(study_scope, ('value', id(value)), lambda frame: value)
+        if source is SOURCE:
+            return FRAME_SLOTS['source']
+        if isinstance(source, RowId):
+            parts = [self.column(part, table, scopes) for part in source.key]
+            row_id = FRAME_SLOTS['row_id']
+            return self.step(scope, None, lambda frame: frame[row_id](table, *[frame[part] for part in parts]))
+        if isinstance(source, Key):
+            value, name, keys = self.column(source.source, table, scopes), source.name, FRAME_SLOTS['keys']
+            return self.step(scope, None, lambda frame: frame[keys][name][frame[value]])
+        if isinstance(source, Last):
+            if source.table not in self.tables:
+                raise ValueError(f"Table {table!r} refers to table {source.table!r}, which must come before it.")
+            earlier, column, rows = source.table, source.column, FRAME_SLOTS['rows']
+            return self.step(scope, ('last', earlier, column),
+                             lambda frame: frame[rows][earlier][-1][column] if frame[rows][earlier] else None)
+        if isinstance(source, Derived):
+            # Columns taking different items of the same result share one call
+            function, arguments = source.function, [self.column(part, table, scopes) for part in source.sources]
+            result = self.step(scope, ('call', function, tuple(arguments)),
+                               lambda frame: function(*[frame[argument] for argument in arguments]))
+            if source.item is None:
+                return result
+            item = source.item
+            return self.step(scope, ('item', result, item), lambda frame: frame[result][item])
+        raise TypeError(f"Unknown column source {source!r} in table {table!r}.")
+
+    def table(self, table, spec, study_scope):
+        """Returns (arrays, item steps, column names, columns getter) for one table;
+        arrays is None for a table with one row per study, else the name and slot
+        of each list holding its items."""
+        arrays, item_scope = None, None
+        if 'rows' in spec:
+            arrays = [(path.rsplit('.', 1)[-1], self.lookup(study_scope, path, None)) for path in spec['rows']]
+            item_scope = {'root': FRAME_SLOTS['item'], 'slots': {}, 'steps': []}
+        slots = [self.column(source, table, (study_scope, item_scope)) for source in spec['columns'].values()]
+        self.tables.add(table)
+        # itemgetter() of a single slot returns the value itself rather than a tuple
+        values = operator.itemgetter(*slots) if len(slots) > 1 else lambda frame: (frame[slots[0]],)
+        return arrays, item_scope['steps'] if item_scope else [], list(spec['columns']), values
+
+    def build(self, schema):
+        """Returns the extract() function for a schema."""
+        study_scope = {'root': FRAME_SLOTS['study'], 'slots': {}, 'steps': []}
+        plan = []
+        for table, spec in schema.items():
+            first_step = len(study_scope['steps'])
+            arrays, item_steps, names, values = self.table(table, spec, study_scope)
+            # The study steps a table added run just before its rows are built, so
+            # keys are given out in the order the rows are
+            plan.append((table, study_scope['steps'][first_step:], arrays, item_steps, names, values))
+        slots = self.slots
+        item_slot, source_slot = FRAME_SLOTS['item'], FRAME_SLOTS['source']
+
+        def extract(study, row_id, keys):
+            rows = {}
+            frame = [None] * slots
+            frame[:len(FRAME_SLOTS)] = study, None, None, row_id, keys, rows
+            for table, study_steps, arrays, item_steps, names, values in plan:
+                for slot, function in study_steps:
+                    frame[slot] = function(frame)
+                if arrays is None:
+                    rows[table] = [dict(zip(names, values(frame)))]
+                    continue
+                table_rows = rows[table] = []
+                for source, array_slot in arrays:
+                    frame[source_slot] = source
+                    for item in frame[array_slot] or ():
+                        frame[item_slot] = item
+                        for slot, function in item_steps:
+                            frame[slot] = function(frame)
+                        table_rows.append(dict(zip(names, values(frame))))
+            return rows
+
+        return extract
+
+
+def compile_schema(schema):
+    """Compiles a schema into extract(study, row_id, keys), which returns a study's
+    rows for each table.
+
+    row_id builds stable row IDs (see data_fetcher.row_id_factory()) and keys maps
+    the name of each Key source to the map of values to IDs it looks up in (and adds to).
+    """
+    return ExtractorBuilder().build(schema)
+
+
+def compile_key_values(schema):
+    """Compiles a schema into a function returning the values a study's Key sources
+    look up, by key name, in the order extract() looks them up."""
+    key_schema, key_names = {}, {}
+    for table, spec in schema.items():
+        keys = {column: source for column, source in spec['columns'].items() if isinstance(source, Key)}
+        if keys:
+            key_schema[table] = dict(spec, columns={column: key.source for column, key in keys.items()})
+            key_names[table] = {column: key.name for column, key in keys.items()}
+    extract = compile_schema(key_schema)
+
+    def key_values(study):
+        values = {}
+        for table, rows in extract(study, None, None).items():
+            for row in rows:
+                for column, value in row.items():
+                    values.setdefault(key_names[table][column], []).append(value)
+        return values
+
+    return key_values
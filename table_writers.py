@@ -0,0 +1,167 @@
+import os
+import csv
+from datetime import date
+from config import PARQUET_ROW_GROUP_SIZE, PARQUET_COMPRESSION
+
+
+def import_pyarrow():
+    """Imports pyarrow, which is only needed for the Parquet backend."""
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Writing Parquet output requires pyarrow (pip install pyarrow).") from e
+    return pyarrow
+
+
+def parse_date(value):
+    """Parses a registry date ('YYYY-MM-DD', 'YYYY-MM' or 'YYYY'); partial dates map to
+    the first day of the month or year."""
+    if value in (None, ''):
+        return None
+    if isinstance(value, date):
+        return value
+    parts = [int(part) for part in str(value).split('-')]
+    return date(parts[0], parts[1] if len(parts) > 1 else 1, parts[2] if len(parts) > 2 else 1)
+
+
+def parse_bool(value):
+    """Parses a boolean that may have been round-tripped through CSV."""
+    if value in (None, ''):
+        return None
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() == 'true'
+
+
+def parse_number(cast):
+    """Returns a parser for an int or float column that maps '' and None to null."""
+    def parse(value):
+        return None if value in (None, '') else cast(value)
+    return parse
+
+
+def parse_list(value):
+    """Parses a list of strings; None stays null."""
+    if value is None:
+        return None
+    return [str(item) for item in value]
+
+
+def parse_string(value):
+    """Parses a string column; None stays null."""
+    return None if value is None else str(value)
+
+
+# Column type name -> (arrow type factory, value parser)
+COLUMN_CONVERTERS = {
+    'string': (lambda pa: pa.string(), parse_string),
+    'date': (lambda pa: pa.date32(), parse_date),
+    'bool': (lambda pa: pa.bool_(), parse_bool),
+    'int': (lambda pa: pa.int64(), parse_number(int)),
+    'float': (lambda pa: pa.float64(), parse_number(float)),
+    'list': (lambda pa: pa.list_(pa.string()), parse_list),
+}
+
+
+class CsvTableWriter:
+    """Writes table rows to a CSV file with a header row."""
+
+    extension = 'csv'
+
+    def __init__(self, path, fieldnames, column_types=None):
+        self.file = open(path, mode='w', newline='', encoding='utf-8')
+        self.writer = csv.DictWriter(self.file, fieldnames=fieldnames, extrasaction='ignore')
+        self.writer.writeheader()
+
+    def writerows(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ParquetTableWriter:
+    """Writes table rows to a compressed Parquet file with typed columns.
+
+    column_types maps column names to a COLUMN_CONVERTERS key (default 'string'),
+    so dates, booleans, numbers and lists are stored natively. Rows are buffered and
+    written one row group at a time.
+    """
+
+    extension = 'parquet'
+
+    def __init__(self, path, fieldnames, column_types=None):
+        self.pa = import_pyarrow()
+        column_types = column_types or {}
+        self.fieldnames = fieldnames
+        self.parsers = [COLUMN_CONVERTERS[column_types.get(field, 'string')][1] for field in fieldnames]
+        self.schema = self.pa.schema([(field, COLUMN_CONVERTERS[column_types.get(field, 'string')][0](self.pa))
+                                      for field in fieldnames])
+        self.writer = self.pa.parquet.ParquetWriter(path, self.schema, compression=PARQUET_COMPRESSION)
+        self.columns = [[] for _ in fieldnames]
+
+    def writerows(self, rows):
+        for row in rows:
+            for column, field, parse in zip(self.columns, self.fieldnames, self.parsers):
+                column.append(parse(row.get(field)))
+        if len(self.columns[0]) >= PARQUET_ROW_GROUP_SIZE:
+            self.flush()
+
+    def write_batch(self, batch):
+        """Writes an Arrow record batch that already has this writer's schema."""
+        self.flush()
+        self.writer.write_batch(batch)
+
+    def flush(self):
+        if self.columns[0]:
+            self.writer.write_table(self.pa.Table.from_arrays(self.columns, schema=self.schema))
+            self.columns = [[] for _ in self.fieldnames]
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+WRITERS = {
+    'csv': CsvTableWriter,
+    'parquet': ParquetTableWriter,
+}
+
+
+def file_extension(fmt):
+    """Returns the file extension used for an output format."""
+    return WRITERS[fmt].extension
+
+
+def open_table_writer(path, fieldnames, fmt, column_types=None):
+    """Opens a writer for one table in the given output format."""
+    return WRITERS[fmt](path, fieldnames, column_types)
+
+
+def merge_parquet(latest_path, tmp_path, new_rows, changed_study_ids, fieldnames, column_types):
+    """Writes latest_path without the rows of changed_study_ids, plus new_rows, to tmp_path.
+
+    The existing file is streamed one record batch at a time.
+    """
+    pa = import_pyarrow()
+    with ParquetTableWriter(tmp_path, fieldnames, column_types) as writer:
+        if os.path.exists(latest_path):
+            changed = pa.array(sorted(changed_study_ids), type=pa.string())
+            for batch in pa.parquet.ParquetFile(latest_path).iter_batches():
+                keep = pa.compute.invert(pa.compute.is_in(batch.column('study_id'), value_set=changed))
+                writer.write_batch(batch.filter(keep))
+        writer.writerows(new_rows)
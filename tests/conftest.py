@@ -0,0 +1,61 @@
+import os
+import sys
+import threading
+import pytest
+
+# The pipeline modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def receiver(tmp_path):
+    """Serves upload_receiver on a free local port; yields (app, url, receive_dir)."""
+    from werkzeug.serving import make_server
+    import upload_receiver
+
+    receive_dir = tmp_path / 'received'
+    receive_dir.mkdir()
+    app = upload_receiver.create_app(str(receive_dir))
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield app, f'http://127.0.0.1:{server.server_port}/api/upload', receive_dir
+    finally:
+        server.shutdown()
+
+
+@pytest.fixture
+def latest_tables(tmp_path, monkeypatch):
+    """Points DATA_PATH at an empty directory; yields write(studies), which replaces
+    its latest tables (dimension tables included) with those of the given studies
+    and returns their rows. Dimension keys are kept from one write to the next."""
+    import data_fetcher
+    import dimensions
+    import table_schema
+    import table_writers
+
+    data_path = tmp_path / 'data'
+    data_path.mkdir()
+    monkeypatch.setattr(data_fetcher, 'DATA_PATH', str(data_path))
+
+    keys = {dimension: dimensions.DimensionKeys() for dimension in table_schema.DIMENSIONS}
+
+    def write(studies):
+        tables = {table: [] for table in data_fetcher.TABLES}
+        for processed, _ in data_fetcher.flatten_pages([studies], keys, workers=1):
+            for table, rows in processed.items():
+                tables[table].extend(rows)
+        for dimension, (key_column, name_column) in table_schema.DIMENSIONS.items():
+            tables[f'{dimension}_dimension'] = [{key_column: key, name_column: name}
+                                                for name, key in keys[dimension].items()]
+        columns = {**data_fetcher.TABLES, **data_fetcher.DIMENSION_TABLES}
+        for table, rows in tables.items():
+            path = data_fetcher.table_path(table)
+            with table_writers.open_table_writer(f'{path}.tmp', columns[table], 'csv',
+                                                 data_fetcher.COLUMN_TYPES) as writer:
+                writer.writerows(rows)
+            os.replace(f'{path}.tmp', path)
+        return tables
+
+    return write
@@ -0,0 +1,74 @@
+import random
+import time
+from contextlib import ExitStack
+import data_fetcher
+import dimensions
+import table_schema
+import table_writers
+from benchmarks.fixtures import SyntheticSource
+
+
+def test_shard_pages_come_in_a_fixed_order(monkeypatch):
+    # Shards of different lengths whose pages take random times to arrive
+    lengths = [5, 1, 0, 7, 3, 4]
+
+    def fetch_shard(session, url, query, checkpoint_path=None):
+        for index in range(lengths[query]):
+            time.sleep(random.uniform(0, 0.01))
+            yield [(query, index)]
+
+    monkeypatch.setattr(data_fetcher, 'fetch_shard', fetch_shard)
+    orders = [list(data_fetcher.fetch_shards(None, None, list(range(len(lengths))), workers, [None] * len(lengths)))
+              for workers in [3, 3, 8]]
+
+    assert orders[0] == orders[1]
+    assert sorted(orders[0]) == sorted([(shard, index)] for shard, length in enumerate(lengths)
+                                       for index in range(length))
+    # With a thread per shard, pages simply take turns
+    assert orders[2][:6] == [[(0, 0)], [(1, 0)], [(3, 0)], [(4, 0)], [(5, 0)], [(0, 1)]]
+
+
+def test_new_dimension_keys_follow_name_order():
+    studies = [SyntheticSource(40, seed=5).study(i) for i in range(40)]
+    assigned = []
+    for page in [studies, studies[::-1]]:
+        keys = {dimension: dimensions.DimensionKeys() for dimension in table_schema.DIMENSIONS}
+        list(data_fetcher.flatten_pages([page], keys, workers=1))
+        assigned.append(keys)
+
+    assert assigned[0] == assigned[1]
+    for dimension_keys in assigned[0].values():
+        names = sorted(dimension_keys, key=lambda name: (name is not None, name or ''))
+        assert [dimension_keys[name] for name in names] == list(range(1, len(names) + 1))
+
+
+def test_tables_are_reproducible(tmp_path, monkeypatch):
+    source = SyntheticSource(240, seed=11)
+    shards = [[source.study(i) for i in range(shard, len(source), 6)] for shard in range(6)]
+
+    def fetch_shard(session, url, query, checkpoint_path=None):
+        studies = shards[query]
+        for start in range(0, len(studies), 15):
+            # Pages arrive at random times, their studies in random order
+            time.sleep(random.uniform(0, 0.01))
+            yield random.sample(studies[start:start + 15], len(studies[start:start + 15]))
+
+    monkeypatch.setattr(data_fetcher, 'fetch_shard', fetch_shard)
+
+    def run(workers):
+        keys = {dimension: dimensions.DimensionKeys() for dimension in table_schema.DIMENSIONS}
+        pages = data_fetcher.fetch_shards(None, None, list(range(len(shards))), 4, [None] * len(shards))
+        output = tmp_path / f'run{workers}'
+        output.mkdir(exist_ok=True)
+        with ExitStack() as stack:
+            writers = {table: stack.enter_context(table_writers.open_table_writer(
+                output / f'{table}.csv', columns, 'csv', data_fetcher.COLUMN_TYPES))
+                for table, columns in data_fetcher.TABLES.items()}
+            for processed, _ in data_fetcher.flatten_pages(pages, keys, workers):
+                for table, writer in writers.items():
+                    writer.writerows(processed[table])
+        return {path.name: path.read_bytes() for path in output.iterdir()}, keys
+
+    first = run(1)
+    assert run(1) == first
+    assert run(3) == first
@@ -0,0 +1,54 @@
+import copy
+import pytest
+import data_fetcher
+import eligibility_matrix
+from benchmarks.fixtures import make_study
+
+pytest.importorskip('numpy')
+
+
+def edited(study, **changes):
+    study = copy.deepcopy(study)
+    study['protocolSection']['eligibilityModule'].update(changes)
+    return study
+
+
+def entries(matrix):
+    """Maps each study ID to its values in the matrix, criteria included."""
+    return {str(study_id): (tuple(int(getattr(matrix, name)[position]) for name in matrix.ENTRY_ARRAYS[1:]),
+                            matrix.criteria(position))
+            for position, study_id in enumerate(matrix.study_ids)}
+
+
+def test_incremental_update_matches_rebuild(latest_tables, tmp_path, monkeypatch, capsys):
+    matrix_path = str(tmp_path / 'eligibility_matrix.npz')
+    monkeypatch.setattr(data_fetcher, 'ELIGIBILITY_MATRIX_PATH', matrix_path)
+    studies = {data_fetcher.study_nct_id(study): study for study in (make_study(i, seed=5) for i in range(1, 41))}
+    latest_tables(list(studies.values()))
+    data_fetcher.update_eligibility_matrix({'tables': ['eligibility']})
+
+    def sync(changed, removed, added):
+        """Applies an incremental sync of the given studies the way process_data() does."""
+        studies.update({data_fetcher.study_nct_id(study): study for study in changed + added})
+        for study_id in removed:
+            del studies[study_id]
+        tables = latest_tables(list(studies.values()))
+        diff = {'added': [data_fetcher.study_nct_id(study) for study in added],
+                'changed': [data_fetcher.study_nct_id(study) for study in changed], 'removed': removed}
+        rows = [row for row in tables['eligibility'] if row['study_id'] in diff['added'] + diff['changed']]
+        data_fetcher.update_eligibility_matrix({'tables': ['eligibility'], 'diff': diff, 'eligibility_rows': rows})
+
+        rebuilt = eligibility_matrix.EligibilityMatrix.from_table(data_fetcher.table_path('eligibility'))
+        assert entries(eligibility_matrix.EligibilityMatrix.load(matrix_path)) == entries(rebuilt)
+
+    first, third, seventh = (studies[f'NCT{i:08d}'] for i in [1, 3, 7])
+    sync(changed=[edited(third, minimumAge='2 Months', sex='MALE', healthyVolunteers=True),
+                  # Multi-byte text shifts the byte offsets of every entry after it
+                  edited(seventh, eligibilityCriteria='Inclusion Criteria:\n\n* Âge ≥ 18 ans\n\n'
+                                                      'Exclusion Criteria:\n\n* Grossesse en cours'),
+                  edited(first, eligibilityCriteria='Adults able to consent.', maximumAge=None)],
+         removed=['NCT00000005', 'NCT00000020'], added=[make_study(i, seed=5) for i in [50, 51, 52]])
+    sync(changed=[edited(seventh, eligibilityCriteria='Exclusion Criteria:\n\n* None')],
+         removed=['NCT00000050', 'NCT00000003'], added=[make_study(60, seed=5)])
+
+    assert 'Updated the eligibility matrix for 2 studies.' in capsys.readouterr().out
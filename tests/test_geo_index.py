@@ -0,0 +1,101 @@
+import math
+import random
+import pytest
+import geo_index
+
+pytest.importorskip('numpy')
+
+
+def build_index(sites, cell_degrees=0.5):
+    """Indexes (lat, lon, study_id, status) sites; the span of site i is (i, i + 1)."""
+    builder = geo_index.SiteIndexBuilder()
+    for i, (lat, lon, study_id, status) in enumerate(sites):
+        builder.add(lat, lon, study_id, status, (i, i + 1))
+    return builder.build(cell_degrees)
+
+
+def site_numbers(index, indexes):
+    """Maps index positions back to the order the sites were added in."""
+    return [int(index.spans[i][0]) for i in indexes]
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    a = (math.sin(math.radians(lat2 - lat1) / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2))
+         * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * geo_index.EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def test_radius_reaches_into_neighbouring_cells():
+    # The query point sits just below and left of the corner of four 0.5 degree
+    # cells at (40.5, -74.0); the sites around it fall in all four
+    sites = [(40.49, -74.01, 'NCT00000001', 'RECRUITING'),   # the point's own cell
+             (40.51, -74.01, 'NCT00000002', 'RECRUITING'),   # the cell above
+             (40.49, -73.99, 'NCT00000003', 'COMPLETED'),    # the cell to the right
+             (40.52, -73.98, 'NCT00000004', 'RECRUITING'),   # diagonally across the corner
+             (40.49, -73.90, 'NCT00000005', 'RECRUITING'),   # next cell, out of range
+             (41.20, -74.01, 'NCT00000006', 'RECRUITING')]   # far away
+    index = build_index(sites)
+
+    indexes, distances = index.within_radius(40.49, -74.01, 5)
+
+    assert site_numbers(index, indexes) == [0, 2, 1, 3]
+    assert list(distances) == sorted(distances)
+    for number, distance in zip(site_numbers(index, indexes), distances):
+        assert distance == pytest.approx(distance_km(40.49, -74.01, *sites[number][:2]))
+
+    recruiting = index.within_radius(40.49, -74.01, 5, status='RECRUITING')[0]
+    assert site_numbers(index, recruiting) == [0, 1, 3]
+    some_studies = index.study_codes_for(['NCT00000003', 'NCT00000004', 'NCT09999999'])
+    assert site_numbers(index, index.within_radius(40.49, -74.01, 5, some_studies)[0]) == [2, 3]
+
+
+def test_bbox_spanning_cells_includes_its_edges():
+    sites = [(40.45, -74.05, 'NCT00000001', 'RECRUITING'),   # the lower left corner
+             (40.55, -73.95, 'NCT00000002', 'RECRUITING'),   # the upper right corner, two cells over
+             (40.50, -74.00, 'NCT00000003', 'RECRUITING'),   # on the cell corner inside
+             (40.56, -74.00, 'NCT00000004', 'RECRUITING'),   # just above, in a covered cell
+             (40.50, -73.94, 'NCT00000005', 'RECRUITING')]   # just right, in a covered cell
+    index = build_index(sites)
+
+    assert sorted(site_numbers(index, index.within_bbox(40.45, -74.05, 40.55, -73.95))) == [0, 1, 2]
+
+
+def test_queries_across_the_antimeridian():
+    sites = [(-17.7, 179.9, 'NCT00000001', 'RECRUITING'),
+             (-17.7, -179.9, 'NCT00000002', 'RECRUITING'),
+             (-17.7, 178.0, 'NCT00000003', 'RECRUITING')]
+    index = build_index(sites)
+
+    assert sorted(site_numbers(index, index.within_radius(-17.7, 179.95, 50)[0])) == [0, 1]
+    assert sorted(site_numbers(index, index.within_bbox(-18, 179.5, -17, -179.5))) == [0, 1]
+
+
+@pytest.mark.parametrize('cell_degrees', [0.5, 2.0])
+def test_matches_a_full_scan(cell_degrees):
+    rng = random.Random(12)
+    # Clustered sites, so that queries see many cells' worth of neighbours; the
+    # antimeridian is left to the test above
+    centres = [(rng.uniform(-60, 60), rng.uniform(-170, 170)) for _ in range(20)]
+    sites = []
+    for i in range(3000):
+        lat, lon = rng.choice(centres)
+        sites.append((lat + rng.gauss(0, 1), (lon + rng.gauss(0, 1) + 180) % 360 - 180,
+                      f'NCT{i % 700:08d}', rng.choice(['RECRUITING', 'COMPLETED'])))
+    index = build_index(sites, cell_degrees)
+
+    for _ in range(50):
+        lat, lon = rng.choice(centres)
+        lat, lon = lat + rng.gauss(0, 1), lon + rng.gauss(0, 1)
+        radius_km = rng.uniform(1, 300)
+        expected = {number for number, site in enumerate(sites) if distance_km(lat, lon, *site[:2]) <= radius_km}
+        # Points within rounding of the edge may go either way
+        edge = {number for number, site in enumerate(sites)
+                if abs(distance_km(lat, lon, *site[:2]) - radius_km) < 1e-6}
+        found = set(site_numbers(index, index.within_radius(lat, lon, radius_km)[0]))
+        assert found - edge == expected - edge
+
+        min_lat, min_lon = lat - rng.uniform(0, 3), lon - rng.uniform(0, 3)
+        max_lat, max_lon = lat + rng.uniform(0, 3), lon + rng.uniform(0, 3)
+        expected = {number for number, (site_lat, site_lon, _, _) in enumerate(sites)
+                    if min_lat <= site_lat <= max_lat and min_lon <= site_lon <= max_lon}
+        assert set(site_numbers(index, index.within_bbox(min_lat, min_lon, max_lat, max_lon))) == expected
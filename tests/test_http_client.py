@@ -0,0 +1,118 @@
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import data_fetcher
+import http_client
+import metrics
+from benchmarks import mock_server
+from benchmarks.fixtures import SyntheticSource
+
+
+def start_server(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def scripted_api():
+    """Serves scripted responses: each request takes the next (status, headers) from
+    server.script (200 once it runs out); its arrival time is kept in server.times
+    and the address it came from in server.clients."""
+    class ScriptedHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            with server.lock:
+                server.times.append(time.monotonic())
+                server.clients.append(self.client_address)
+                status, headers = server.script.pop(0) if server.script else (200, {})
+            body = b'{"studies": []}' if status == 200 else b'{"error": "try again"}'
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = start_server(ScriptedHandler)
+    server.lock, server.script, server.times, server.clients = threading.Lock(), [], [], []
+    server.url = f'http://127.0.0.1:{server.server_port}/api/v2/studies'
+    yield server
+    server.shutdown()
+
+
+def test_retry_waits_for_retry_after(scripted_api):
+    scripted_api.script = [(429, {'Retry-After': '1'})]
+    limiter = http_client.AdaptiveLimiter(4, start=4)
+    with http_client.create_session(4, limiter) as session:
+        response = session.get(scripted_api.url)
+
+    assert response.status_code == 200
+    first, retry = scripted_api.times
+    assert 1.0 <= retry - first < 1.5
+    assert limiter.stats()['throttled'] == 1
+
+
+def test_limit_halves_on_throttle_and_recovers(scripted_api):
+    scripted_api.script = [(429, {'Retry-After': '0'})]
+    # A high tolerance keeps local latency jitter from cutting the limit
+    limiter = http_client.AdaptiveLimiter(8, start=8, tolerance=1000)
+    with http_client.create_session(8, limiter) as session:
+        session.get(scripted_api.url)
+        assert limiter.stats()['limit'] == 4
+        limits = []
+        for _ in range(30):
+            session.get(scripted_api.url)
+            limits.append(limiter.stats()['limit'])
+
+    assert limits == sorted(limits)
+    assert limits[-1] == 8
+
+
+def test_transient_errors_are_retried(scripted_api):
+    scripted_api.script = [(503, {}), (502, {})]
+    limiter = http_client.AdaptiveLimiter(2, start=2)
+    with http_client.create_session(2, limiter) as session:
+        session.backoff = 0.01
+        assert session.get(scripted_api.url).status_code == 200
+    assert len(scripted_api.times) == 3
+    assert limiter.stats()['errors'] == 2
+
+
+def test_retried_responses_release_their_connection(scripted_api):
+    scripted_api.script = [(429, {'Retry-After': '0'}), (503, {})]
+    with http_client.create_session(1, http_client.AdaptiveLimiter(1, start=1)) as session:
+        session.backoff = 0.01
+        # A streamed response holds its connection until it is read or closed
+        response = session.get(scripted_api.url, stream=True)
+        assert response.status_code == 200
+        response.close()
+
+    # Each retry went out over the connection the failed attempt gave back
+    assert len(scripted_api.clients) == 3
+    assert len(set(scripted_api.clients)) == 1
+
+
+def test_throttled_fetch_returns_every_study():
+    source = SyntheticSource(600, seed=3)
+    registry = mock_server.MockRegistry(source, throttle=4)
+    server = start_server(mock_server.make_handler(registry))
+    try:
+        metrics.start_run()
+        url = f'http://127.0.0.1:{server.server_port}/api/v2/studies'
+        pages = list(data_fetcher.fetch_data(url, {'pageSize': 50}, shards=4, workers=8))
+    finally:
+        server.shutdown()
+
+    assert registry.stats['throttled'] > 0
+    study_ids = [data_fetcher.study_nct_id(study) for page in pages for study in page]
+    assert sorted(study_ids) == sorted(data_fetcher.study_nct_id(source.study(i)) for i in range(len(source)))
+    fetch_limits = metrics.current.info['fetch_limits']
+    assert fetch_limits['throttled'] > 0
+    assert fetch_limits.get('decreases', 0) > 0
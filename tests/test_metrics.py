@@ -0,0 +1,55 @@
+import json
+import pytest
+import metrics
+
+MB = 2 ** 20
+
+
+@pytest.fixture
+def peak_resets():
+    """Skips unless the high-water mark can be reset here."""
+    if not metrics.reset_peak_rss():
+        pytest.skip('the OS does not let the memory high-water mark be reset')
+
+
+def test_stages_report_their_own_peak_memory(tmp_path, peak_resets):
+    run = metrics.start_run('full')
+    with metrics.stage('outer'):
+        with metrics.stage('allocate'):
+            block = b'\x01' * (200 * MB)
+            del block
+        with metrics.stage('after'):
+            small = b'\x01' * MB
+            del small
+
+    report = metrics.finish_run('synced', str(tmp_path / 'report.json'), str(tmp_path / 'history.jsonl'))
+
+    stages = report['stages']
+    assert stages['allocate']['peak_rss_bytes'] >= 200 * MB
+    # The block was freed before the next stage started, so its peak is not carried over
+    assert stages['after']['peak_rss_bytes'] < stages['allocate']['peak_rss_bytes'] - 150 * MB
+    # An enclosing stage and the run include the peaks of the stages inside them
+    assert stages['outer']['peak_rss_bytes'] >= stages['allocate']['peak_rss_bytes']
+    assert report['peak_rss_bytes'] >= stages['allocate']['peak_rss_bytes']
+    assert run.peak_rss == report['peak_rss_bytes']
+    with open(tmp_path / 'report.json', encoding='utf-8') as file:
+        assert json.load(file)['stages'] == stages
+    assert 'clinical_sync_last_run_peak_rss_bytes ' in metrics.render_metrics()
+
+
+def test_peak_reset_gives_up_where_it_is_not_allowed(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'can_reset_peak', True)
+    # A missing /proc, like a read-only one, makes the write fail
+    clear_refs = tmp_path / 'proc' / 'clear_refs'
+    monkeypatch.setattr(metrics, 'CLEAR_REFS_PATH', str(clear_refs))
+
+    assert not metrics.reset_peak_rss()
+    clear_refs.parent.mkdir()
+    assert not metrics.reset_peak_rss()
+    assert not clear_refs.exists()
+
+    # Stages still report a peak, though not one of their own
+    metrics.start_run()
+    with metrics.stage('fetch'):
+        pass
+    assert metrics.current.report('synced')['stages']['fetch']['peak_rss_bytes'] > 0
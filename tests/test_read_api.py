@@ -0,0 +1,57 @@
+import os
+import json
+import pytest
+import read_api
+from benchmarks.fixtures import SyntheticSource
+
+
+@pytest.fixture
+def sync_state(tmp_path, monkeypatch):
+    """Returns a function recording a completed sync, as process_data() does."""
+    path = tmp_path / 'sync_state.json'
+    monkeypatch.setattr(read_api, 'SYNC_STATE_PATH', str(path))
+
+    def complete_sync(run):
+        path.write_text(json.dumps({'dataTimestamp': f'2025-12-{run % 28 + 1:02d}', 'synced_at': str(run)}))
+
+    return complete_sync
+
+
+def open_files():
+    return len(os.listdir('/proc/self/fd'))
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason="counts open files through /proc")
+def test_reloads_close_previous_snapshots(latest_tables, sync_state):
+    source = SyntheticSource(30, seed=2)
+    latest_tables([source.study(i) for i in range(30)])
+    sync_state(0)
+    reader = read_api.StudyReader(cache_size=16)
+    study_id = reader.search()[0]
+
+    baseline = open_files()
+    for run in range(1, 20):
+        latest_tables([source.study(i) for i in range(30)])
+        sync_state(run)
+        reader.reload_if_changed()
+        assert reader.get_study(study_id)['studies'][0]['study_id'] == study_id
+        assert open_files() == baseline
+
+
+def test_query_in_flight_keeps_its_snapshot_open(latest_tables, sync_state):
+    source = SyntheticSource(30, seed=2)
+    latest_tables([source.study(i) for i in range(20)])
+    sync_state(0)
+    reader = read_api.StudyReader(cache_size=16)
+    study_id = reader.search()[-1]
+
+    with reader.current() as snapshot:
+        latest_tables([source.study(i) for i in range(30)])
+        sync_state(1)
+        reader.reload()
+        assert reader.snapshot is not snapshot
+        # The retired snapshot still reads the rows it indexed
+        assert snapshot.get_study(study_id)['studies'][0]['study_id'] == study_id
+        assert not snapshot.tables['studies'].file.closed
+    assert snapshot.tables['studies'].file.closed
+    assert len(reader.search()) == 30
@@ -0,0 +1,73 @@
+"""The run lock, taken by separate scheduler processes as in production.
+
+Each instance is a fresh process with SCHEDULER_LOCK_PATH pointed into the test's
+directory; its process_data() announces itself and, for the first instance,
+holds the lock until the test lets it finish.
+"""
+import os
+import sys
+import signal
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INSTANCE = """
+import os
+import sys
+import time
+import config
+config.SCHEDULER_LOCK_PATH = sys.argv[1]
+import data_fetcher
+import scheduler
+
+def process_data(mode):
+    print('running', flush=True)
+    with open(sys.argv[2], 'a') as file:
+        file.write(f'{os.getpid()}\\n')
+    while sys.argv[3] != '-' and not os.path.exists(sys.argv[3]):
+        time.sleep(0.01)
+    return 'synced'
+
+data_fetcher.process_data = process_data
+print(scheduler.run_sync({'published': [], 'last_full_sync': None, 'failures': 0}, time.time()), flush=True)
+"""
+
+
+def start_instance(tmp_path, release='-'):
+    return subprocess.Popen([sys.executable, '-c', INSTANCE, str(tmp_path / 'sync.lock'), str(tmp_path / 'runs'),
+                             str(release)], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+
+def finish(instance):
+    stdout, stderr = instance.communicate(timeout=60)
+    assert instance.returncode == 0, stderr
+    return stdout.splitlines()
+
+
+def wait_until_running(instance):
+    assert instance.stdout.readline().strip() == 'running'
+
+
+def test_second_instance_skips_while_a_sync_runs(tmp_path):
+    first = start_instance(tmp_path, release=tmp_path / 'release')
+    wait_until_running(first)
+    with open(tmp_path / 'sync.lock', encoding='utf-8') as file:
+        assert file.read() == f'{first.pid}\n'
+
+    second = start_instance(tmp_path)
+    assert finish(second) == ['Another sync is running; checking again later.', 'locked']
+
+    (tmp_path / 'release').touch()
+    assert finish(first) == ['synced']
+    # With the lock given back, the next instance runs
+    assert finish(start_instance(tmp_path)) == ['running', 'synced']
+    with open(tmp_path / 'runs', encoding='utf-8') as file:
+        assert len(file.read().split()) == 2
+
+
+def test_lock_is_released_when_its_holder_is_killed(tmp_path):
+    first = start_instance(tmp_path, release=tmp_path / 'release')
+    wait_until_running(first)
+    first.send_signal(signal.SIGKILL)
+    first.communicate(timeout=60)
+
+    assert finish(start_instance(tmp_path)) == ['running', 'synced']
@@ -0,0 +1,106 @@
+import csv
+import sqlite3
+import data_fetcher
+import sqlite_target
+from benchmarks.fixtures import SyntheticSource
+
+ALL_TABLES = {**data_fetcher.DIMENSION_TABLES, **data_fetcher.TABLES}
+
+
+def open_loader(path, base_snapshot):
+    return sqlite_target.SqliteLoader(str(path), data_fetcher.TABLES, data_fetcher.DIMENSION_TABLES,
+                                      data_fetcher.COLUMN_TYPES, base_snapshot)
+
+
+def csv_rows(table):
+    """The rows of a latest table's CSV, as the target should store them."""
+    types = [data_fetcher.COLUMN_TYPES.get(column, 'string') for column in ALL_TABLES[table]]
+    with open(data_fetcher.table_path(table), mode='r', encoding='utf-8', newline='') as file:
+        return sorted((tuple(sqlite_target.sql_value(row[column], column_type)
+                             for column, column_type in zip(ALL_TABLES[table], types))
+                       for row in csv.DictReader(file)), key=repr)
+
+
+def target_rows(path, table):
+    conn = sqlite_target.open_reader(str(path))
+    try:
+        return sorted(conn.execute(f'SELECT * FROM "{table}"').fetchall(), key=repr)
+    finally:
+        conn.close()
+
+
+def test_load_and_reload_round_trip(tmp_path, latest_tables):
+    path = tmp_path / 'clinical.sqlite'
+    source = SyntheticSource(40, seed=8)
+    tables = latest_tables([source.study(i) for i in range(30)])
+
+    loader = open_loader(path, None)
+    assert loader.reload
+    for table in ALL_TABLES:
+        loader.load_csv(table, data_fetcher.table_path(table))
+    assert loader.commit('2025-12-30T12:00:00')
+    loader.close()
+    for table in ALL_TABLES:
+        assert target_rows(path, table) == csv_rows(table)
+    # Partial dates are stored as published
+    start_date = tables['studies'][0]['start_date']
+    assert len(start_date) == 7
+    assert (start_date,) in sqlite_target.open_reader(str(path)).execute(
+        'SELECT start_date FROM studies').fetchall()
+
+    # The next snapshot drops five studies, adds ten and changes one
+    studies = [source.study(i) for i in range(5, 40)]
+    studies[0]['protocolSection']['identificationModule']['briefTitle'] = 'Changed title'
+    new_tables = latest_tables(studies)
+    changed = {data_fetcher.study_nct_id(study) for study in studies[:1] + studies[25:]}
+    removed = {row['study_id'] for row in tables['studies']} - {row['study_id'] for row in new_tables['studies']}
+    loader = open_loader(path, '2025-12-30T12:00:00')
+    assert not loader.reload
+    loader.replace_studies({table: [row for row in rows if row['study_id'] in changed]
+                            for table, rows in new_tables.items() if table in data_fetcher.TABLES}, changed)
+    loader.delete_studies(removed)
+    for table in data_fetcher.DIMENSION_TABLES:
+        loader.load_dimension(table, new_tables[table])
+    # Until commit the target is neither changed nor locked for writing
+    assert target_rows(path, 'studies') != csv_rows('studies')
+    other = sqlite3.connect(str(path), timeout=0)
+    other.execute('BEGIN IMMEDIATE')
+    other.execute('ROLLBACK')
+    other.close()
+    assert loader.commit('2025-12-31T12:00:00')
+    loader.close()
+    for table in ALL_TABLES:
+        assert target_rows(path, table) == csv_rows(table)
+
+    # A run based on another snapshot reloads every table
+    loader = open_loader(path, '2025-12-01T12:00:00')
+    assert loader.reload
+    for table in ALL_TABLES:
+        loader.load_csv(table, data_fetcher.table_path(table))
+    assert loader.commit('2026-01-01T12:00:00')
+    loader.close()
+    for table in ALL_TABLES:
+        assert target_rows(path, table) == csv_rows(table)
+
+
+def test_changes_are_dropped_if_the_target_moved_on(tmp_path, latest_tables):
+    path = tmp_path / 'clinical.sqlite'
+    latest_tables([SyntheticSource(10, seed=8).study(i) for i in range(10)])
+    loader = open_loader(path, None)
+    for table in ALL_TABLES:
+        loader.load_csv(table, data_fetcher.table_path(table))
+    loader.commit('2025-12-30T12:00:00')
+    loader.close()
+
+    loader = open_loader(path, '2025-12-30T12:00:00')
+    loader.delete_studies(['NCT00000001'])
+    # Another process loads a newer snapshot while this run is staging
+    other = open_loader(path, '2025-12-30T12:00:00')
+    assert other.commit('2025-12-31T12:00:00')
+    other.close()
+    assert not loader.commit('2026-01-01T12:00:00')
+    loader.close()
+    conn = sqlite_target.open_reader(str(path))
+    assert conn.execute("SELECT COUNT(*) FROM studies WHERE study_id = 'NCT00000001'").fetchone() == (1,)
+    assert conn.execute("SELECT value FROM load_state WHERE key = 'snapshot'").fetchone() == ('2025-12-31T12:00:00',)
+    conn.close()
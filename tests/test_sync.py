@@ -0,0 +1,125 @@
+"""End-to-end runs of process_data() against benchmarks/mock_server.py.
+
+Each run is a fresh process, as pipeline modules copy config settings at import
+time. An incremental run rewrites a whole table when any of its studies changed:
+merge_table() streams the latest CSV into a new file, so one edited title costs a
+rewrite of the studies table (about 1.1 GB for the full registry). Tables none of
+whose studies changed are left untouched.
+"""
+import os
+import sys
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer
+import pytest
+import data_fetcher
+import text_index
+from benchmarks import mock_server
+from benchmarks.fixtures import SyntheticSource
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUN = """
+import sys
+from benchmarks.run import configure
+options = dict(page_size=40, fetch_shards=3, fetch_workers=3, transform_workers=1, upload_workers=1,
+               output_formats=None, no_projection=False)
+configure(options, sys.argv[1], int(sys.argv[2]))
+import data_fetcher
+print(data_fetcher.process_data())
+"""
+
+
+class EditedSource(SyntheticSource):
+    """SyntheticSource with new brief titles and summaries for some studies, updated
+    on `updated`."""
+
+    def __init__(self, count, seed, edited, updated):
+        super().__init__(count, seed)
+        self.edited = edited
+        self.updated = updated
+
+    def study(self, position):
+        study = super().study(position)
+        if position in self.edited:
+            protocol = study['protocolSection']
+            protocol['identificationModule']['briefTitle'] = f'Edited title {position}'
+            protocol['descriptionModule']['briefSummary'] = f'Edited summary {position} about zanubrutinib.'
+            protocol['statusModule']['lastUpdatePostDateStruct'] = {'date': self.updated, 'type': 'ACTUAL'}
+        return study
+
+    def last_update_date(self, position):
+        return self.updated if position in self.edited else super().last_update_date(position)
+
+
+@pytest.fixture
+def mock_api():
+    """Yields start(registry), which serves a MockRegistry and returns its port."""
+    servers = []
+
+    def start(registry):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), mock_server.make_handler(registry))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server.server_port
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def process_data(workdir, port):
+    result = subprocess.run([sys.executable, '-c', RUN, str(workdir), str(port)], cwd=ROOT,
+                            capture_output=True, text=True, timeout=300)
+    assert result.returncode == 0, result.stderr
+    return result.stdout.strip().splitlines()[-1]
+
+
+def table_files(workdir):
+    data_path = workdir / 'data' / 'clinicaldata'
+    return {path.name: (path.stat().st_mtime_ns, path.read_bytes())
+            for path in data_path.glob('latest_*_data.csv') if path.name != 'latest_version_data.csv'}
+
+
+def search_text(workdir, query):
+    conn = text_index.open_reader(str(workdir / 'data' / 'clinicaldata' / 'text_index.sqlite'))
+    try:
+        return [study_id for study_id, _ in text_index.search(conn, query, limit=200)]
+    finally:
+        conn.close()
+
+
+def test_runs_skip_unchanged_snapshots_and_merge_changed_studies(tmp_path, mock_api):
+    source = SyntheticSource(120, seed=4)
+    assert process_data(tmp_path, mock_api(mock_server.MockRegistry(source))) == 'synced'
+    first = table_files(tmp_path)
+    old_summary = source.study(60)['protocolSection']['descriptionModule']['briefSummary']
+    edited_ids = [data_fetcher.study_nct_id(source.study(position)) for position in [5, 60, 99]]
+    assert search_text(tmp_path, 'zanubrutinib') == []
+    assert edited_ids[1] in search_text(tmp_path, f'"{old_summary}"')
+
+    # The same dataTimestamp again: nothing is fetched or rewritten
+    registry = mock_server.MockRegistry(source)
+    assert process_data(tmp_path, mock_api(registry)) == 'skipped'
+    assert registry.stats['source_requests'] == 0
+    assert table_files(tmp_path) == first
+
+    # A new snapshot in which three studies got new titles
+    edited = EditedSource(120, 4, {5, 60, 99}, mock_server.DATA_TIMESTAMP[:10])
+    registry = mock_server.MockRegistry(edited, data_timestamp='2026-01-01T12:00:00')
+    assert process_data(tmp_path, mock_api(registry)) == 'synced'
+    # Only the studies updated since the last snapshot are fetched
+    assert registry.stats['source_requests'] == 1
+    second = table_files(tmp_path)
+
+    assert second['latest_studies_data.csv'] != first['latest_studies_data.csv']
+    studies = second['latest_studies_data.csv'][1].decode('utf-8')
+    assert studies.count('Edited title') == 3
+    assert studies.count('\n') == first['latest_studies_data.csv'][1].decode('utf-8').count('\n')
+    unchanged = {name for name in first if name != 'latest_studies_data.csv'}
+    assert {name: second[name] for name in unchanged} == {name: first[name] for name in unchanged}
+
+    # The full-text index dropped the old summaries and picked up the new ones
+    assert sorted(search_text(tmp_path, 'zanubrutinib')) == edited_ids
+    assert edited_ids[1] not in search_text(tmp_path, f'"{old_summary}"')
+    assert search_text(tmp_path, '"summary 60 about"') == [edited_ids[1]]
@@ -0,0 +1,36 @@
+import json
+import pathlib
+import pytest
+import data_fetcher
+import dimensions
+import table_schema
+
+FIXTURES = pathlib.Path(__file__).parent / 'fixtures'
+
+
+def load_fixture(name):
+    with open(FIXTURES / name, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def test_extractor_matches_fixture():
+    # flattened_studies.json was checked against the hand-written flatten_study()
+    # the schema replaced: the same rows once names are mapped to their keys. The
+    # studies cover missing modules, coordinates and arms, a repeated condition and
+    # a collaborator that is also the lead sponsor.
+    keys = {dimension: dimensions.DimensionKeys() for dimension in table_schema.DIMENSIONS}
+    rows = [data_fetcher.flatten_study(study, keys) for study in load_fixture('studies.json')]
+
+    expected = load_fixture('flattened_studies.json')
+    assert len(rows) == len(expected)
+    for study_rows, expected_rows in zip(rows, expected):
+        assert list(study_rows) == list(table_schema.SCHEMA)
+        for table, table_rows in study_rows.items():
+            assert json.loads(json.dumps(table_rows)) == expected_rows[table], table
+
+
+def test_later_table_must_come_first():
+    schema = {'first': {'columns': {'value': table_schema.Last('second', 'value')}},
+              'second': {'columns': {'value': 'protocolSection.identificationModule.nctId'}}}
+    with pytest.raises(ValueError):
+        table_schema.compile_schema(schema)
@@ -0,0 +1,88 @@
+import math
+import pytest
+import text_index
+
+DOCUMENTS = {
+    'NCT00000001': {'brief_summary': 'insulin insulin pump trial', 'detailed_description': 'pump settings by week',
+                    'eligibility': 'adults with type one diabetes'},
+    'NCT00000002': {'brief_summary': 'glucose monitoring trial', 'detailed_description': None,
+                    'eligibility': 'adults on insulin'},
+    'NCT00000003': {'brief_summary': 'insulin dosing in heart failure patients with chronic kidney disease',
+                    'detailed_description': 'a long description of heart failure care over many visits',
+                    'eligibility': 'adults'},
+    'NCT00000004': {'brief_summary': 'vaccine trial in children', 'detailed_description': 'failure of the heart',
+                    'eligibility': 'children aged two to five'},
+    'NCT00000005': {'brief_summary': 'placebo controlled trial', 'detailed_description': 'standard care',
+                    'eligibility': None},
+    'NCT00000006': {'brief_summary': 'exercise program for older adults', 'detailed_description': None,
+                    'eligibility': 'older adults'},
+    # Enough studies without the searched terms that their IDF stays positive
+    **{f'NCT0000001{i}': {'brief_summary': f'observational registry number {i}', 'detailed_description': None,
+                          'eligibility': 'anyone'} for i in range(4)},
+}
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = text_index.open_index(str(tmp_path / 'text_index.sqlite'))
+    text_index.update_studies(conn, DOCUMENTS)
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def bm25(documents, term, k1=1.2, b=0.75):
+    """Scores documents for one term the way FTS5's bm25() does: column weights
+    scale the term's frequency, and lengths count the tokens of every column."""
+    weights = text_index.TEXT_INDEX_WEIGHTS
+    words = {study_id: {field: (document[field] or '').split() for field in text_index.TEXT_FIELDS}
+             for study_id, document in documents.items()}
+    average_length = sum(len(field) for fields in words.values() for field in fields.values()) / len(words)
+    matching = [study_id for study_id, fields in words.items() if any(term in field for field in fields.values())]
+    idf = max(math.log((len(words) - len(matching) + 0.5) / (len(matching) + 0.5)), 1e-6)
+    scores = {}
+    for study_id in matching:
+        frequency = sum(weights[name] * field.count(term) for name, field in words[study_id].items())
+        length = sum(len(field) for field in words[study_id].values())
+        scores[study_id] = idf * frequency * (k1 + 1) / (frequency + k1 * (1 - b + b * length / average_length))
+    return scores
+
+
+def test_results_are_ranked_by_weighted_bm25(conn):
+    results = text_index.search(conn, 'insulin')
+
+    expected = bm25(DOCUMENTS, 'insulin')
+    assert [study_id for study_id, _ in results] == sorted(expected, key=expected.get, reverse=True)
+    for study_id, score in results:
+        assert score == pytest.approx(expected[study_id])
+    # Two mentions in the summary beat one in a long summary, which beats one in
+    # the lower-weighted eligibility text
+    assert [study_id for study_id, _ in results] == ['NCT00000001', 'NCT00000003', 'NCT00000002']
+
+
+def test_phrases_stems_and_limit(conn):
+    assert [study_id for study_id, _ in text_index.search(conn, '"heart failure"')] == ['NCT00000003']
+    # Both words appear in NCT00000004, just not as a phrase
+    assert {study_id for study_id, _ in text_index.search(conn, 'heart failure')} == {'NCT00000003', 'NCT00000004'}
+    assert [study_id for study_id, _ in text_index.search(conn, 'vaccines')] == ['NCT00000004']
+    assert len(text_index.search(conn, 'trial', limit=2)) == 2
+    assert text_index.search(conn, '" "') == []
+
+
+def test_updates_replace_and_remove_text(conn):
+    documents = dict(DOCUMENTS)
+    documents['NCT00000005'] = {'brief_summary': 'insulin insulin insulin', 'detailed_description': None,
+                                'eligibility': None}
+    text_index.update_studies(conn, {'NCT00000005': documents['NCT00000005']})
+    conn.commit()
+
+    assert text_index.search(conn, 'placebo') == []
+    results = text_index.search(conn, 'insulin')
+    assert results[0][0] == 'NCT00000005'
+    expected = bm25(documents, 'insulin')
+    assert dict(results) == pytest.approx(expected)
+
+    text_index.remove_studies(conn, ['NCT00000005', 'NCT00000001'])
+    conn.commit()
+    del documents['NCT00000005'], documents['NCT00000001']
+    assert dict(text_index.search(conn, 'insulin')) == pytest.approx(bm25(documents, 'insulin'))
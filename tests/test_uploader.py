@@ -0,0 +1,104 @@
+import os
+import pytest
+import requests
+import http_client
+import uploader
+
+CHUNK_SIZE = 64 * 1024
+
+
+@pytest.fixture(autouse=True)
+def upload_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploader, 'UPLOAD_STATE_PATH', str(tmp_path / 'uploads'))
+    monkeypatch.setattr(uploader, 'UPLOAD_RETRIES', 0)
+    return tmp_path / 'uploads'
+
+
+def write_table(path, rows):
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        file.write('study_id,row_id,value\n')
+        for i in range(rows):
+            file.write(f'NCT{i:08d},{i * 7919 % 100003},value {i * i}\n')
+    return str(path)
+
+
+def test_chunks_are_reassembled(tmp_path, receiver, upload_state):
+    app, url, receive_dir = receiver
+    path = write_table(tmp_path / 'latest_studies_data.csv', 20000)
+    assert os.path.getsize(path) > 5 * CHUNK_SIZE
+
+    with http_client.create_session(1) as session:
+        assert uploader.upload_file(session, path, url, chunk_size=CHUNK_SIZE)
+
+    with open(path, 'rb') as original, open(receive_dir / 'latest_studies_data.csv', 'rb') as received:
+        assert received.read() == original.read()
+    chunk_count = -(-os.path.getsize(path) // CHUNK_SIZE)
+    assert app.config['RECEIVED'] == [('latest_studies_data.csv', i) for i in range(chunk_count)]
+    assert not os.listdir(upload_state)
+
+
+def test_failed_chunk_resumes(tmp_path, receiver, upload_state):
+    app, url, receive_dir = receiver
+    path = write_table(tmp_path / 'latest_studies_data.csv', 20000)
+    app.config['FAIL_CHUNKS'].add(('latest_studies_data.csv', 3))
+
+    with http_client.create_session(1) as session:
+        assert not uploader.upload_file(session, path, url, chunk_size=CHUNK_SIZE)
+        assert not (receive_dir / 'latest_studies_data.csv').exists()
+        upload_id, _ = uploader.chunk_checksums(path, CHUNK_SIZE)
+        assert uploader.load_done_chunks(upload_id) == {0, 1, 2}
+
+        app.config['FAIL_CHUNKS'].clear()
+        app.config['RECEIVED'].clear()
+        assert uploader.upload_file(session, path, url, chunk_size=CHUNK_SIZE)
+
+    # Only the chunks that were not acknowledged are sent again
+    assert app.config['RECEIVED'][0] == ('latest_studies_data.csv', 3)
+    with open(path, 'rb') as original, open(receive_dir / 'latest_studies_data.csv', 'rb') as received:
+        assert received.read() == original.read()
+    assert not os.listdir(upload_state)
+
+
+def test_corrupt_chunk_is_rejected(tmp_path, receiver):
+    _, url, receive_dir = receiver
+    path = write_table(tmp_path / 'latest_outcomes_data.csv', 10)
+    _, (chunk_sha256,) = uploader.chunk_checksums(path, CHUNK_SIZE)
+    headers = {'X-Upload-Id': 'corrupt', 'X-File-Name': 'latest_outcomes_data.csv', 'X-File-Sha256': chunk_sha256,
+               'X-Chunk-Index': '0', 'X-Chunk-Count': '1', 'X-Chunk-Sha256': '0' * 64}
+    response = requests.post(url, data=b''.join(uploader.gzip_blocks(path, 0, CHUNK_SIZE)), headers=headers)
+    assert response.status_code == 400
+    assert not (receive_dir / 'latest_outcomes_data.csv').exists()
+
+
+def test_upload_files_reports_each_file(tmp_path, receiver):
+    _, url, receive_dir = receiver
+    paths = [write_table(tmp_path / f'latest_{table}_data.csv', 500) for table in ['studies', 'sponsors', 'outcomes']]
+    missing = str(tmp_path / 'latest_missing_data.csv')
+
+    results = uploader.upload_files(paths + [missing], url, workers=3)
+
+    assert results == {**{path: True for path in paths}, missing: False}
+    for path in paths:
+        with open(path, 'rb') as original, open(receive_dir / os.path.basename(path), 'rb') as received:
+            assert received.read() == original.read()
+
+
+def test_changed_file_discards_stale_state(tmp_path, receiver, upload_state):
+    app, url, _ = receiver
+    path = write_table(tmp_path / 'latest_studies_data.csv', 20000)
+    other = write_table(tmp_path / 'latest_sponsors_data.csv', 19000)
+    app.config['FAIL_CHUNKS'].update({('latest_studies_data.csv', 2), ('latest_sponsors_data.csv', 1)})
+
+    with http_client.create_session(1) as session:
+        assert not uploader.upload_file(session, path, url, chunk_size=CHUNK_SIZE)
+        assert not uploader.upload_file(session, other, url, chunk_size=CHUNK_SIZE)
+        stale_id, _ = uploader.chunk_checksums(path, CHUNK_SIZE)
+        other_id, _ = uploader.chunk_checksums(other, CHUNK_SIZE)
+
+        # The next sync rewrites the table before its upload ever completed
+        write_table(path, 20001)
+        assert not uploader.upload_file(session, path, url, chunk_size=CHUNK_SIZE)
+
+    upload_id, _ = uploader.chunk_checksums(path, CHUNK_SIZE)
+    assert sorted(os.listdir(upload_state)) == sorted([f'{upload_id}.json', f'{other_id}.json'])
+    assert not os.path.exists(uploader.upload_state_path(stale_id))
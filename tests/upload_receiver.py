@@ -0,0 +1,84 @@
+"""A local Flask stand-in for TARGET_URL that receives uploads the way uploader.py sends them.
+
+    python tests/upload_receiver.py ./received/
+
+then set TARGET_URL = 'http://127.0.0.1:5000/api/upload'. Each chunk is checked
+against its X-Chunk-Sha256 and kept until every chunk of the upload has arrived;
+the file is then reassembled, checked against X-File-Sha256 and stored under its
+X-File-Name in the receive directory.
+"""
+import os
+import sys
+import gzip
+import shutil
+import hashlib
+from flask import Flask, jsonify, request
+
+
+def parts_dir(receive_dir, upload_id, file_name):
+    return os.path.join(receive_dir, '.parts', f'{upload_id}-{file_name}')
+
+
+def reassemble(parts_path, chunk_count, file_sha256, file_path):
+    """Concatenates the chunks of an upload into file_path if their SHA-256 matches."""
+    tmp_path = f"{file_path}.tmp"
+    file_hash = hashlib.sha256()
+    with open(tmp_path, 'wb') as out_file:
+        for index in range(chunk_count):
+            with open(os.path.join(parts_path, str(index)), 'rb') as part:
+                data = part.read()
+            file_hash.update(data)
+            out_file.write(data)
+    if file_hash.hexdigest() != file_sha256:
+        os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, file_path)
+    return True
+
+
+def create_app(receive_dir):
+    """Returns the receiver app. For tests, app.config['FAIL_CHUNKS'] holds
+    (file name, chunk index) pairs to answer with a 503, and app.config['RECEIVED']
+    lists the (file name, chunk index) of every chunk accepted."""
+    app = Flask(__name__)
+    app.config['FAIL_CHUNKS'] = set()
+    app.config['RECEIVED'] = []
+
+    @app.post('/api/upload')
+    def upload():
+        file_name = os.path.basename(request.headers['X-File-Name'])
+        upload_id = request.headers['X-Upload-Id']
+        index = int(request.headers['X-Chunk-Index'])
+        chunk_count = int(request.headers['X-Chunk-Count'])
+        if (file_name, index) in app.config['FAIL_CHUNKS']:
+            return jsonify(error='chunk rejected for testing'), 503
+
+        try:
+            data = gzip.decompress(request.get_data())
+        except (OSError, EOFError):
+            return jsonify(error='chunk is not valid gzip'), 400
+        if hashlib.sha256(data).hexdigest() != request.headers['X-Chunk-Sha256']:
+            return jsonify(error='chunk checksum mismatch'), 400
+
+        parts_path = parts_dir(receive_dir, upload_id, file_name)
+        os.makedirs(parts_path, exist_ok=True)
+        with open(os.path.join(parts_path, str(index)), 'wb') as part:
+            part.write(data)
+        app.config['RECEIVED'].append((file_name, index))
+
+        if not all(os.path.exists(os.path.join(parts_path, str(i))) for i in range(chunk_count)):
+            return jsonify(received=index), 200
+        if not reassemble(parts_path, chunk_count, request.headers['X-File-Sha256'],
+                          os.path.join(receive_dir, file_name)):
+            shutil.rmtree(parts_path)
+            return jsonify(error='file checksum mismatch'), 422
+        shutil.rmtree(parts_path)
+        return jsonify(received=index, file=file_name), 201
+
+    return app
+
+
+if __name__ == '__main__':
+    directory = sys.argv[1] if len(sys.argv) > 1 else './received/'
+    os.makedirs(directory, exist_ok=True)
+    create_app(directory).run(host='127.0.0.1', port=5000, threaded=True)
@@ -0,0 +1,114 @@
+import csv
+import re
+import sqlite3
+from config import TEXT_INDEX_PATH, TEXT_INDEX_WEIGHTS
+
+# Indexed text fields, in the index's column order
+TEXT_FIELDS = ['brief_summary', 'detailed_description', 'eligibility']
+
+
+def open_index(path=TEXT_INDEX_PATH):
+    """Opens the full-text index, creating it if needed.
+
+    The index is an SQLite FTS5 table (porter-stemmed unicode61 tokens, positional
+    postings) over a documents table holding each study's text once. Updates made
+    during a run stay in an open transaction until the caller commits.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS documents (doc_id INTEGER PRIMARY KEY, study_id TEXT UNIQUE NOT NULL, '
+                 'brief_summary TEXT, detailed_description TEXT, eligibility TEXT)')
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS study_text USING fts5(brief_summary, detailed_description, "
+                 "eligibility, content='documents', content_rowid='doc_id', "
+                 "tokenize='porter unicode61 remove_diacritics 2')")
+    conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    conn.commit()
+    return conn
+
+
+def open_reader(path=TEXT_INDEX_PATH):
+    """Opens the full-text index read-only; readers see the last committed run."""
+    return sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+
+
+def is_built(conn):
+    """Checks whether the index was ever filled from the latest tables."""
+    return conn.execute("SELECT 1 FROM meta WHERE key = 'built'").fetchone() is not None
+
+
+def study_documents(rows_by_table, study_ids):
+    """Collects the indexed text of the given studies from their flattened rows."""
+    documents = {study_id: dict.fromkeys(TEXT_FIELDS) for study_id in study_ids}
+    for row in rows_by_table['studies']:
+        if row['study_id'] in documents:
+            documents[row['study_id']]['brief_summary'] = row['brief_summary']
+            documents[row['study_id']]['detailed_description'] = row['detailed_description']
+    for row in rows_by_table['eligibility']:
+        if row['study_id'] in documents:
+            documents[row['study_id']]['eligibility'] = row['description']
+    return documents
+
+
+def remove_studies(conn, study_ids):
+    """Removes studies from the index."""
+    for study_id in study_ids:
+        old = conn.execute('SELECT doc_id, brief_summary, detailed_description, eligibility FROM documents '
+                           'WHERE study_id = ?', (study_id,)).fetchone()
+        if old:
+            # An external-content FTS5 table needs the old text to drop its postings
+            conn.execute("INSERT INTO study_text (study_text, rowid, brief_summary, detailed_description, eligibility) "
+                         "VALUES ('delete', ?, ?, ?, ?)", old)
+            conn.execute('DELETE FROM documents WHERE doc_id = ?', (old[0],))
+
+
+def update_studies(conn, documents):
+    """Replaces the indexed text of studies ({study_id: {field: text}})."""
+    remove_studies(conn, documents)
+    for study_id, document in documents.items():
+        values = [document[field] for field in TEXT_FIELDS]
+        doc_id = conn.execute('INSERT INTO documents (study_id, brief_summary, detailed_description, eligibility) '
+                              'VALUES (?, ?, ?, ?)', [study_id] + values).lastrowid
+        conn.execute('INSERT INTO study_text (rowid, brief_summary, detailed_description, eligibility) '
+                     'VALUES (?, ?, ?, ?)', [doc_id] + values)
+
+
+def rebuild(conn, studies_path, eligibility_path):
+    """Re-indexes every study from the latest studies and eligibility CSVs and commits."""
+    print("Building the full-text index from the latest tables...")
+    conn.execute("INSERT INTO study_text (study_text) VALUES ('delete-all')")
+    conn.execute('DELETE FROM documents')
+    with open(studies_path, mode='r', encoding='utf-8') as file:
+        conn.executemany('INSERT OR REPLACE INTO documents (study_id, brief_summary, detailed_description) '
+                         'VALUES (?, ?, ?)',
+                         ((row['study_id'], row['brief_summary'], row['detailed_description'])
+                          for row in csv.DictReader(file)))
+    with open(eligibility_path, mode='r', encoding='utf-8') as file:
+        conn.executemany('UPDATE documents SET eligibility = ? WHERE study_id = ?',
+                         ((row['description'], row['study_id']) for row in csv.DictReader(file)))
+    conn.execute("INSERT INTO study_text (study_text) VALUES ('rebuild')")
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built', datetime('now'))")
+    conn.commit()
+
+
+def match_expression(query):
+    """Turns a search string into an FTS5 query: "quoted phrases" must appear as
+    phrases and every other word must appear somewhere."""
+    terms = [phrase or word for phrase, word in re.findall(r'"([^"]*)"|(\S+)', query)]
+    return ' '.join('"{}"'.format(term.replace('"', '')) for term in terms if term.strip(' "'))
+
+
+def search(conn, query, limit=20):
+    """Returns up to limit (study_id, score) pairs ranked by BM25, best first.
+
+    Field weights come from TEXT_INDEX_WEIGHTS.
+    """
+    expression = match_expression(query)
+    if not expression:
+        return []
+    weights = ', '.join(str(TEXT_INDEX_WEIGHTS[field]) for field in TEXT_FIELDS)
+    rows = conn.execute(f'SELECT d.study_id, m.score FROM '
+                        f'(SELECT rowid, bm25(study_text, {weights}) AS score FROM study_text '
+                        f'WHERE study_text MATCH ? ORDER BY score LIMIT ?) m '
+                        f'JOIN documents d ON d.doc_id = m.rowid ORDER BY m.score', (expression, limit))
+    # FTS5 reports BM25 negated so that better matches sort first
+    return [(study_id, -score) for study_id, score in rows]
@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import random
+import zlib
+import hashlib
+import requests
+from concurrent.futures import ThreadPoolExecutor
+import http_client
+import metrics
+from config import (UPLOAD_WORKERS, UPLOAD_CHUNK_SIZE, UPLOAD_RETRIES, UPLOAD_BACKOFF,
+                    UPLOAD_STATE_PATH)
+
+# Bytes read from disk (and handed to the compressor) at a time
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+def read_blocks(file_path, offset, length):
+    """Yields the bytes of file_path[offset:offset + length] in READ_BLOCK_SIZE blocks."""
+    with open(file_path, 'rb') as file:
+        file.seek(offset)
+        while length > 0:
+            block = file.read(min(READ_BLOCK_SIZE, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+
+
+def chunk_checksums(file_path, chunk_size):
+    """Returns the SHA-256 of the whole file and of each chunk_size chunk of it."""
+    file_hash = hashlib.sha256()
+    chunk_hashes = []
+    size = os.path.getsize(file_path)
+    for offset in range(0, max(size, 1), chunk_size):
+        chunk_hash = hashlib.sha256()
+        for block in read_blocks(file_path, offset, chunk_size):
+            file_hash.update(block)
+            chunk_hash.update(block)
+        chunk_hashes.append(chunk_hash.hexdigest())
+    return file_hash.hexdigest(), chunk_hashes
+
+
+def gzip_blocks(file_path, offset, length):
+    """Yields one chunk of the file as a gzip member, compressing block by block."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for block in read_blocks(file_path, offset, length):
+        compressed = compressor.compress(block)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def upload_state_path(upload_id):
+    """Returns the path recording which chunks of an upload were acknowledged."""
+    return os.path.join(UPLOAD_STATE_PATH, f'{upload_id}.json')
+
+
+def load_upload_state(path):
+    """Returns the state saved at path as {'file': path or None, 'chunks': [...]};
+    states written before the file was recorded are a bare list of chunks."""
+    with open(path, mode='r', encoding='utf-8') as file:
+        state = json.load(file)
+    return state if isinstance(state, dict) else {'file': None, 'chunks': state}
+
+
+def load_done_chunks(upload_id):
+    """Returns the chunk indexes already acknowledged for an upload."""
+    path = upload_state_path(upload_id)
+    if not os.path.exists(path):
+        return set()
+    return set(load_upload_state(path)['chunks'])
+
+
+def save_done_chunks(upload_id, file_path, done_chunks):
+    """Records the chunk indexes acknowledged so far for an upload of file_path."""
+    os.makedirs(UPLOAD_STATE_PATH, exist_ok=True)
+    tmp_path = f"{upload_state_path(upload_id)}.tmp"
+    with open(tmp_path, mode='w', encoding='utf-8') as file:
+        json.dump({'file': os.path.abspath(file_path), 'chunks': sorted(done_chunks)}, file)
+    os.replace(tmp_path, upload_state_path(upload_id))
+
+
+def discard_stale_uploads(file_path, upload_id):
+    """Removes the saved state of earlier uploads of file_path whose content has
+    since changed; they can never be resumed."""
+    if not os.path.isdir(UPLOAD_STATE_PATH):
+        return
+    file_path = os.path.abspath(file_path)
+    for name in os.listdir(UPLOAD_STATE_PATH):
+        if not name.endswith('.json') or name == f'{upload_id}.json':
+            continue
+        path = os.path.join(UPLOAD_STATE_PATH, name)
+        try:
+            if load_upload_state(path)['file'] == file_path:
+                os.remove(path)
+        except (OSError, ValueError):
+            # Removed by a concurrent upload, or a state file we cannot read
+            continue
+
+
+def post_chunk(session, url, file_path, headers, offset, length):
+    """POSTs one gzip-compressed chunk, retrying with jittered exponential backoff."""
+    for attempt in range(UPLOAD_RETRIES + 1):
+        if attempt:
+            metrics.count('upload_retries')
+            time.sleep(UPLOAD_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+        start, sizes = time.perf_counter(), []
+        try:
+            body = metrics.metered(gzip_blocks(file_path, offset, length), 'bytes_uploaded', sizes)
+            response = session.post(url, data=body, headers=headers)
+            succeeded = response.status_code in (200, 201, 204)
+            metrics.record_request('upload', time.perf_counter() - start, sum(sizes), error=not succeeded)
+            if succeeded:
+                return True
+            print(f"Failed to upload chunk {headers['X-Chunk-Index']} of {headers['X-File-Name']}. "
+                  f"Status code: {response.status_code}")
+        except requests.exceptions.RequestException as e:
+            metrics.record_request('upload', time.perf_counter() - start, sum(sizes), error=True)
+            print(f"Error uploading chunk {headers['X-Chunk-Index']} of {headers['X-File-Name']}: {e}")
+    return False
+
+
+def upload_file(session, file_path, url, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Uploads a file as gzip-compressed chunks and returns whether every chunk was accepted.
+
+    Each chunk is a separate POST whose body is a gzip member streamed from disk, so
+    concatenating the chunk bodies in order gives a valid gzip of the whole file.
+    Headers identify the upload (the file's SHA-256), the chunk's position and its
+    uncompressed SHA-256 for the receiver to verify. Acknowledged chunks are recorded
+    on disk, so uploading the same file again resumes after the last one; once the
+    file has changed, the record of its earlier upload is discarded.
+    """
+    try:
+        file_sha256, chunk_hashes = chunk_checksums(file_path, chunk_size)
+    except OSError as e:
+        print(f"Error reading {file_path} for upload: {e}")
+        return False
+    upload_id = file_sha256
+    discard_stale_uploads(file_path, upload_id)
+    done_chunks = load_done_chunks(upload_id)
+
+    for index, chunk_sha256 in enumerate(chunk_hashes):
+        if index in done_chunks:
+            continue
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'Content-Encoding': 'gzip',
+            'X-Upload-Id': upload_id,
+            'X-File-Name': os.path.basename(file_path),
+            'X-File-Sha256': file_sha256,
+            'X-Chunk-Index': str(index),
+            'X-Chunk-Count': str(len(chunk_hashes)),
+            'X-Chunk-Offset': str(index * chunk_size),
+            'X-Chunk-Sha256': chunk_sha256,
+        }
+        if not post_chunk(session, url, file_path, headers, index * chunk_size, chunk_size):
+            return False
+        done_chunks.add(index)
+        save_done_chunks(upload_id, file_path, done_chunks)
+
+    if os.path.exists(upload_state_path(upload_id)):
+        os.remove(upload_state_path(upload_id))
+    return True
+
+
+def upload_files(file_paths, url, workers=UPLOAD_WORKERS):
+    """Uploads files concurrently over one pooled session.
+
+    Returns {file_path: succeeded} and prints which files failed.
+    """
+    file_paths = list(file_paths)
+    if not file_paths:
+        return {}
+    print(f"Uploading {len(file_paths)} file(s) to {url}...")
+    with http_client.create_session(workers) as session, ThreadPoolExecutor(max_workers=workers) as executor:
+        results = dict(zip(file_paths, executor.map(lambda path: upload_file(session, path, url), file_paths)))
+
+    failed = [os.path.basename(path) for path, succeeded in results.items() if not succeeded]
+    print(f"Uploaded {len(file_paths) - len(failed)} of {len(file_paths)} file(s).")
+    if failed:
+        print(f"Failed uploads: {', '.join(failed)}")
+    return results